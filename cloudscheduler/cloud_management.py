@@ -20,16 +20,18 @@ import re
 import sys
 import json
 import time
+import itertools
 import shlex
 import string
+import socket
 import logging
+import tempfile
 import threading
 import subprocess
 import ConfigParser
 
 from suds.client import Client
 from urllib2 import URLError
-from decimal import *
 from lxml import etree
 from StringIO import StringIO
 from collections import defaultdict
@@ -60,6 +62,8 @@ from cloudscheduler.utilities import determine_path
 from cloudscheduler.utilities import get_or_none
 from cloudscheduler.utilities import ErrTrackQueue
 from cloudscheduler.utilities import splitnstrip
+from cloudscheduler.utilities import intern_str
+from cloudscheduler.state_store import StateStore
 import cloudscheduler.utilities as utilities
 
 ##
@@ -80,17 +84,518 @@ except ImportError:
 ## CLASSES
 ##
 
+class ClusterCapabilities:
+    """The static, configured capabilities of a cluster that
+    get_fitting_resources checks, with set lookups in place of list scans.
+    Built when the resource pool is set up and rebuilt on reconfig."""
+
+    def __init__(self, cluster):
+        self.kind = cluster.__class__.__name__
+        self.cpu_archs = frozenset(cluster.cpu_archs)
+        self.network_pools = frozenset(cluster.network_pools)
+        self.hypervisor = cluster.hypervisor
+        self.max_vm_mem = cluster.max_vm_mem
+        self.max_vm_storage = getattr(cluster, 'max_vm_storage', -1)
+
+class VMRegistry(object):
+    """Hash indexes over the VMs of the resource pool's clusters.
+
+    Each index maps a tuple of VM attribute values to the VMs that have
+    them. The registry is attached to each cluster's VMList, which reports
+    VMs appended to or removed from it, and to each VM, whose __setattr__
+    reports changes to the indexed attributes. The size of an index bucket
+    doubles as a live count, eg. of a user's VMs; core slots and resource
+    usage per uservmtype are totalled separately in slot_counts and usage.
+
+    If a VMJournal is set as journal, each VM added, removed or changed is
+    also recorded in it; VMs then report changes to all their attributes."""
+
+    # index name -> VM attributes making up its key
+    INDEXES = {
+        'condorname': ('condorname',),
+        'condoraddr': ('condoraddr',),
+        'user': ('user',),
+        'uservmtype': ('uservmtype',),
+        'status': ('status',),
+        'vmtype_status': ('vmtype', 'status'),
+        'uservmtype_status': ('uservmtype', 'status'),
+        'vmtype_override': ('vmtype', 'override_status'),
+        'uservmtype_override': ('uservmtype', 'override_status'),
+    }
+    # VM attributes deciding what a VM adds to slot_counts and usage
+    COUNTED_ATTRIBUTES = ('uservmtype', 'job_per_core', 'cpucores', 'memory', 'storage')
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.watched_attributes = frozenset(attribute
+                for attributes in self.INDEXES.values() + [self.COUNTED_ATTRIBUTES]
+                for attribute in attributes)
+        self.clusters = []
+        self.cluster_of_vm = {}
+        self.indexes = dict((name, {}) for name in self.INDEXES)
+        self.slot_counts = defaultdict(int)
+        # uservmtype -> [vms, memory, cpucores, storage]
+        self.usage = {}
+        self.journal = None
+
+    def attach(self, cluster):
+        """Index the VMs of cluster, and keep following its vms list."""
+        with self.lock:
+            if not isinstance(cluster.vms, cluster_tools.VMList):
+                cluster.vms = cluster_tools.VMList(cluster, cluster.vms)
+            cluster.vms.cluster = cluster
+            cluster.vms.registry = self
+            if cluster in self.clusters:
+                for vm, owner in self.cluster_of_vm.items():
+                    if owner is cluster:
+                        self._unindex(vm)
+                        if self.journal != None and vm not in cluster.vms:
+                            self.journal.record('remove', cluster.name, vm)
+            else:
+                self.clusters.append(cluster)
+            for vm in cluster.vms:
+                self.add(vm, cluster)
+
+    def rebuild(self, clusters):
+        """Drop all indexes and rebuild them from clusters, detaching
+        any cluster that is no longer among them. Only the VMs that were
+        added, removed or moved to another cluster name are journalled."""
+        with self.lock:
+            journal, self.journal = self.journal, None
+            previous = dict((vm, cluster.name) for vm, cluster in self.cluster_of_vm.iteritems())
+            for cluster in self.clusters:
+                if isinstance(cluster.vms, cluster_tools.VMList):
+                    cluster.vms.registry = None
+            for vm in self.cluster_of_vm.keys():
+                vm.__dict__.pop('_registry', None)
+            self.clusters = []
+            self.cluster_of_vm = {}
+            self.indexes = dict((name, {}) for name in self.INDEXES)
+            self.slot_counts = defaultdict(int)
+            self.usage = {}
+            for cluster in clusters:
+                self.attach(cluster)
+            self.journal = journal
+            if journal != None:
+                for vm, cluster in self.cluster_of_vm.iteritems():
+                    if previous.get(vm) != cluster.name:
+                        journal.record('add', cluster.name, vm, vm)
+                for vm, cluster_name in previous.iteritems():
+                    if vm not in self.cluster_of_vm:
+                        journal.record('remove', cluster_name, vm)
+
+    def detach(self, cluster):
+        """Stop following cluster's vms list, and drop its VMs from the
+        indexes."""
+        with self.lock:
+            if cluster not in self.clusters:
+                return
+            self.clusters.remove(cluster)
+            if isinstance(cluster.vms, cluster_tools.VMList):
+                cluster.vms.registry = None
+            for vm in list(cluster.vms):
+                if self.cluster_of_vm.get(vm) is cluster:
+                    self._unindex(vm)
+                    vm.__dict__.pop('_registry', None)
+                    if self.journal != None:
+                        self.journal.record('remove', cluster.name, vm)
+
+    def add(self, vm, cluster):
+        with self.lock:
+            if vm in self.cluster_of_vm:
+                self._unindex(vm)
+            self.cluster_of_vm[vm] = cluster
+            vm.__dict__['_registry'] = self
+            for name, attributes in self.INDEXES.iteritems():
+                key = tuple(getattr(vm, attribute, None) for attribute in attributes)
+                self.indexes[name].setdefault(key, {})[vm] = None
+            self._count(vm, 1)
+            if self.journal != None:
+                self.journal.record('add', cluster.name, vm, vm)
+
+    def discard(self, vm, cluster):
+        with self.lock:
+            if self.cluster_of_vm.get(vm) is cluster and vm not in cluster.vms:
+                self._unindex(vm)
+                vm.__dict__.pop('_registry', None)
+                if self.journal != None:
+                    self.journal.record('remove', cluster.name, vm)
+
+    def _unindex(self, vm):
+        del self.cluster_of_vm[vm]
+        self._count(vm, -1)
+        for name, attributes in self.INDEXES.iteritems():
+            key = tuple(getattr(vm, attribute, None) for attribute in attributes)
+            self._drop(name, key, vm)
+
+    def _count(self, vm, sign):
+        uservmtype = getattr(vm, 'uservmtype', None)
+        if getattr(vm, 'job_per_core', False):
+            self.slot_counts[uservmtype] += sign * getattr(vm, 'cpucores', 0)
+        else:
+            self.slot_counts[uservmtype] += sign
+        if self.slot_counts[uservmtype] == 0:
+            del self.slot_counts[uservmtype]
+        usage = self.usage.setdefault(uservmtype, [0, 0, 0, 0])
+        usage[0] += sign
+        usage[1] += sign * getattr(vm, 'memory', 0)
+        usage[2] += sign * getattr(vm, 'cpucores', 0)
+        usage[3] += sign * getattr(vm, 'storage', 0)
+        if usage[0] == 0:
+            del self.usage[uservmtype]
+
+    def _drop(self, name, key, vm):
+        bucket = self.indexes[name].get(key)
+        if bucket != None:
+            bucket.pop(vm, None)
+            if not bucket:
+                del self.indexes[name][key]
+
+    def vm_changed(self, vm, attribute, value):
+        """Set an attribute on vm, moving it between index keys if the
+        attribute is indexed, and journal the change."""
+        with self.lock:
+            cluster = self.cluster_of_vm.get(vm)
+            if cluster == None:
+                vm.__dict__[attribute] = value
+                return
+            if self.journal != None and attribute not in self.journal.UNJOURNALED_ATTRIBUTES:
+                if attribute not in vm.__dict__ or vm.__dict__[attribute] != value:
+                    self.journal.record('set', cluster.name, vm, (attribute, value))
+            if attribute not in self.watched_attributes:
+                vm.__dict__[attribute] = value
+                return
+            changed = [(name, attributes) for name, attributes in self.INDEXES.iteritems()
+                       if attribute in attributes]
+            counts_changed = attribute in self.COUNTED_ATTRIBUTES
+            for name, attributes in changed:
+                key = tuple(getattr(vm, a, None) for a in attributes)
+                self._drop(name, key, vm)
+            if counts_changed:
+                self._count(vm, -1)
+            vm.__dict__[attribute] = value
+            for name, attributes in changed:
+                key = tuple(getattr(vm, a, None) for a in attributes)
+                self.indexes[name].setdefault(key, {})[vm] = None
+            if counts_changed:
+                self._count(vm, 1)
+
+    def vm_touched(self, vm):
+        """Note that vm changed inside one of its attributes, so the journal
+        saves it again."""
+        with self.lock:
+            cluster = self.cluster_of_vm.get(vm)
+            if cluster != None and self.journal != None:
+                self.journal.mark_dirty(cluster.name, vm)
+
+    def find(self, index, *key):
+        """Return a list of the VMs whose index attributes equal key."""
+        with self.lock:
+            return self.indexes[index].get(key, {}).keys()
+
+    def find_one(self, index, *key):
+        """Return a VM whose index attributes equal key, or None."""
+        with self.lock:
+            bucket = self.indexes[index].get(key)
+            if bucket:
+                return iter(bucket).next()
+            return None
+
+    def count(self, index, *key):
+        with self.lock:
+            return len(self.indexes[index].get(key, ()))
+
+    def counts(self, index):
+        """Return a dictionary of the VM count for each value of a single
+        attribute index."""
+        with self.lock:
+            return defaultdict(int, ((key[0], len(bucket))
+                                     for key, bucket in self.indexes[index].iteritems()))
+
+    def get_slot_counts(self):
+        with self.lock:
+            return defaultdict(int, self.slot_counts)
+
+    def get_usage(self):
+        """Return the [memory, cpucores, storage] totals of each uservmtype."""
+        with self.lock:
+            return dict((uservmtype, usage[1:]) for uservmtype, usage in self.usage.iteritems())
+
+    def cluster_of(self, vm):
+        with self.lock:
+            return self.cluster_of_vm.get(vm)
+
+class VMJournal:
+    """Write-ahead journal of the resource pool's VMs, kept on top of a
+    pickled snapshot of the resources list.
+
+    The VMRegistry records each VM added to or removed from a cluster and
+    each attribute set on one. save() appends the records gathered since
+    its last call to the journal file, or, once the journal holds a few
+    records per VM or the snapshot is COMPACT_SECONDS old, writes a new
+    snapshot to a temporary file, renames it over the old one and starts
+    an empty journal. Changes made inside a VM attribute, such as an item
+    appended to a list, can't be recorded; VM.mark_changed marks the
+    journal dirty instead, and they are saved with the next snapshot.
+    Each snapshot ends with
+    a generation string which the journal repeats in its first record, so
+    a journal left behind by an earlier snapshot is never replayed."""
+
+    # VM attributes updated on every poll, left to the next snapshot
+    UNJOURNALED_ATTRIBUTES = frozenset(('lastpoll', 'journal_id'))
+    # compact once the journal holds more than this many records, and more
+    # than COMPACT_RECORDS_PER_VM records per VM
+    COMPACT_MIN_RECORDS = 1000
+    COMPACT_RECORDS_PER_VM = 4
+    # and, once marked dirty, within this many seconds of the last snapshot
+    COMPACT_SECONDS = 10 * 60
+
+    def __init__(self, snapshot_path, journal_path=None):
+        self.snapshot_path = snapshot_path
+        if journal_path == None:
+            journal_path = snapshot_path + ".journal"
+        self.journal_path = journal_path
+        self.lock = threading.Lock()
+        self.pending = []
+        self.journal_records = 0
+        self.needs_snapshot = True
+        self.last_snapshot = 0
+        self.dirty = False
+        self.id_prefix = "%x" % int(time.time() * 1000)
+        self.id_counter = itertools.count()
+
+    def record(self, op, cluster_name, vm, payload=None):
+        """Queue an 'add' (payload is the VM), 'remove' or 'set' (payload
+        is an (attribute, value) pair) record for vm."""
+        key = vm.__dict__.get('journal_id')
+        if key == None:
+            key = vm.__dict__['journal_id'] = "%s.%d" % (self.id_prefix, self.id_counter.next())
+        with self.lock:
+            self.pending.append((op, cluster_name, key, payload))
+
+    def mark_dirty(self, cluster_name, vm):
+        """Note that vm changed in a way no record describes."""
+        with self.lock:
+            self.dirty = True
+
+    def save(self, resources, vm_count, resources_lock, compact=False):
+        """Write the records queued since the last save, either to the
+        journal or as part of a new snapshot. Does nothing if no VM has
+        changed, unless compact asks for a new snapshot regardless or the
+        journal is dirty and the snapshot COMPACT_SECONDS old. The VMs are
+        pickled holding resources_lock."""
+        with self.lock:
+            pending, self.pending = self.pending, []
+            if self.dirty and time.time() - self.last_snapshot > self.COMPACT_SECONDS:
+                compact = True
+        if not pending and not compact:
+            return
+        try:
+            if compact or self.needs_snapshot or self.journal_records + len(pending) > \
+                    max(self.COMPACT_MIN_RECORDS, self.COMPACT_RECORDS_PER_VM * vm_count):
+                with resources_lock:
+                    self.write_snapshot(resources)
+            else:
+                # 'add' records carry the live VM, so pickle them before
+                # another thread can change it
+                with resources_lock:
+                    records = [pickle.dumps(record, pickle.HIGHEST_PROTOCOL)
+                               for record in pending]
+                self.append(records)
+        except (IOError, OSError), e:
+            log.error("Couldn't write persistence file to %s! \"%s\"" %
+                      (self.snapshot_path, e.strerror))
+            self.requeue(pending)
+        except:
+            log.exception("Unknown problem saving persistence file!")
+            self.requeue(pending)
+
+    def requeue(self, records):
+        # the journal may now end in a partial record, so start over
+        # from a snapshot
+        with self.lock:
+            self.pending[:0] = records
+        self.needs_snapshot = True
+
+    def append(self, records):
+        """Append already pickled records to the journal."""
+        journal_file = open(self.journal_path, "ab")
+        try:
+            for record in records:
+                journal_file.write(record)
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+        finally:
+            journal_file.close()
+        self.journal_records += len(records)
+
+    def write_snapshot(self, resources):
+        """Atomically replace the snapshot with one of resources, and start
+        a new journal for it."""
+        generation = "%x.%d" % (int(time.time() * 1000), self.id_counter.next())
+        # cleared first, so a VM marked while the snapshot is written is
+        # saved again; a failed snapshot is retried regardless
+        with self.lock:
+            self.dirty = False
+        directory = os.path.dirname(os.path.abspath(self.snapshot_path))
+        fd, temp_path = tempfile.mkstemp(prefix=os.path.basename(self.snapshot_path) + ".",
+                                         dir=directory)
+        try:
+            snapshot_file = os.fdopen(fd, "wb")
+            try:
+                pickle.dump(resources, snapshot_file, pickle.HIGHEST_PROTOCOL)
+                pickle.dump(generation, snapshot_file, pickle.HIGHEST_PROTOCOL)
+                snapshot_file.flush()
+                os.fsync(snapshot_file.fileno())
+            finally:
+                snapshot_file.close()
+            os.rename(temp_path, self.snapshot_path)
+        except:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        journal_file = open(self.journal_path, "wb")
+        try:
+            pickle.dump(('snapshot', None, generation, None), journal_file, pickle.HIGHEST_PROTOCOL)
+            journal_file.flush()
+            os.fsync(journal_file.fileno())
+        finally:
+            journal_file.close()
+        self.journal_records = 0
+        self.needs_snapshot = False
+        self.last_snapshot = time.time()
+
+    def replay(self):
+        """Return the clusters of the last snapshot, and the VMs of the last
+        run as a list of (cluster name, vm) pairs, or None if there is no
+        snapshot. Older persistence files, holding only the pickled
+        resources list, load as a snapshot without a journal."""
+        snapshot_file = open(self.snapshot_path, "rb")
+        try:
+            old_resources = pickle.load(snapshot_file)
+            try:
+                generation = pickle.load(snapshot_file)
+            except EOFError:
+                generation = None
+        finally:
+            snapshot_file.close()
+
+        vms = {}
+        order = []
+        for cluster in old_resources:
+            for vm in cluster.vms:
+                key = vm.__dict__.get('journal_id', id(vm))
+                vms[key] = (cluster.name, vm)
+                order.append(key)
+
+        try:
+            journal_file = open(self.journal_path, "rb")
+        except IOError:
+            journal_file = None
+        if journal_file != None:
+            replayed = 0
+            try:
+                try:
+                    header = pickle.load(journal_file)
+                    if generation == None or header != ('snapshot', None, generation, None):
+                        log.warning("Ignoring persistence journal %s written for another snapshot." %
+                                    self.journal_path)
+                    else:
+                        while True:
+                            try:
+                                op, cluster_name, key, payload = pickle.load(journal_file)
+                            except EOFError:
+                                break
+                            if op == 'add':
+                                vms[key] = (cluster_name, payload)
+                                order.append(key)
+                            elif op == 'remove':
+                                vms.pop(key, None)
+                            elif op == 'set' and key in vms:
+                                setattr(vms[key][1], payload[0], payload[1])
+                            replayed += 1
+                except EOFError:
+                    pass
+                except:
+                    log.exception("Problem reading persistence journal, "
+                                  "stopping after %d records." % replayed)
+            finally:
+                journal_file.close()
+            log.debug("Replayed %d persistence journal records." % replayed)
+
+        persisted = []
+        for key in order:
+            if key in vms:
+                persisted.append(vms.pop(key))
+        return old_resources, persisted
+
+class FairShareState:
+    """One cycle's fair-share picture: the current (VM) and desired (job)
+    uservmtype distributions, and their difference after user limits.
+
+    Built by ResourcePool.refresh_fair_share once per scheduler cycle and
+    shared read-only with Cleanup and the info server; generation counts
+    the refreshes."""
+
+    def __init__(self, resource_pool, job_pool, generation):
+        self.generation = generation
+        self.computed_at = time.time()
+        self.current_types = resource_pool.vmtype_distribution()
+        self.desired_types = job_pool.job_type_distribution()
+        # Negative difference means will need to create that type
+        self.unlimited_diff_types = utilities.diff_distributions(self.current_types, self.desired_types)
+        diff_types = dict(self.unlimited_diff_types)
+
+        # With user limiting will need to reset any users that are at their limits
+        # so they will not interfere with scheduling
+        # will need to redistribute negatives to the non-limited users
+        limited_users = []
+        userjoblimits = job_pool.get_usertype_limits()
+        for vmusertype in diff_types.keys():
+            user = vmusertype.split(':')[0]
+            if resource_pool.user_at_limit(user):
+                if vmusertype not in limited_users:
+                    limited_users.append(vmusertype)
+            if vmusertype in userjoblimits.keys():
+                if resource_pool.uservmtype_at_limit(vmusertype, userjoblimits[vmusertype]):
+                    if vmusertype not in limited_users:
+                        limited_users.append(vmusertype)
+        neg_total = 0
+        for usertype in limited_users:
+            if diff_types[usertype] < 0:
+                neg_total += diff_types[usertype]
+        splitby = len(diff_types) - len(limited_users)
+        adjustby = 0
+        if splitby > 0:
+            adjustby = neg_total / splitby
+        elif splitby == 0:
+            log.verbose("All users are limited.")
+        else:
+            log.error("More user vmtypes limited than what's in diff types, something weird here.")
+
+        for usertype in diff_types.keys():
+            if usertype not in limited_users:
+                diff_types[usertype] += adjustby # the 'extra' will be negative so add it
+        self.limited_users = limited_users
+        self.diff_types = diff_types
+
+def _hashable(value):
+    """Turn the list and dict arguments of a fit query into tuples, so the
+    query can key a dictionary."""
+    if isinstance(value, dict):
+        return tuple(sorted((key, _hashable(item)) for key, item in value.iteritems()))
+    if isinstance(value, (list, tuple)):
+        return tuple(_hashable(item) for item in value)
+    return value
+
 
 class ResourcePool:    
     
     """Stores and organises a list of Cluster resources."""
     ## Instance variables
     resources = []
-    machine_list = []
-    prev_machine_list = []
     vm_machine_list = []
     prev_vm_machine_list = []
-    master_list = []
     retired_resources = []
     config_file = ""
 
@@ -118,22 +623,57 @@ class ResourcePool:
         self.ban_lock = threading.Lock()
         self.banned_job_resource = {}
         self.user_vm_limits = {}
+        # image -> cluster name -> ErrTrackQueue of VM boot results
         self.failures = {}
+        # (image, cluster name) of the queues appended to since check_failures
+        self.failures_changed = set()
         self.setup_lock = threading.Lock()
         self.setup_queued = False
+        # cluster name -> ClusterCapabilities
+        self.capabilities = {}
+        # get_fitting_resources results by query, valid while
+        # _fit_memo_version() is unchanged
+        self.fit_memo = {}
+        self.fit_memo_version = None
+        self.fit_generation = 0
         self.non_cs_condor_machines = set()
         self.missing_vm_condor_machines = set()
+        # Lookup indexes over the VMs of self.resources
+        self.vm_registry = VMRegistry()
+        # Snapshot and journal of the VMs, see save_persistence; the
+        # state store takes the journal's place when configured
+        self.state_store = None
+        if config.state_store_file:
+            try:
+                self.state_store = StateStore(config.state_store_file)
+            except Exception, e:
+                log.error("Couldn't open state store %s, using the persistence file instead: %s" %
+                          (config.state_store_file, e))
+        if self.state_store != None:
+            self.vm_journal = self.state_store
+        else:
+            self.vm_journal = VMJournal(config.persistence_file)
+        self.vm_registry.journal = self.vm_journal
+        # MachineIndex of the machine list last indexed
+        self.machine_index = None
+        # Latest FairShareState, see refresh_fair_share
+        self.fair_share = None
+        self.fair_share_generation = 0
+        self.fair_share_lock = threading.Lock()
 
         if not condor_query_type:
             condor_query_type = config.condor_retrieval_method
 
         if condor_query_type.lower() == "local":
             self.resource_query = self.resource_query_local
+            self.vm_machine_query = self.vm_machine_query_local
         elif condor_query_type.lower() == "soap":
             self.resource_query = self.resource_query_SOAP
+            self.vm_machine_query = self.vm_machine_query_SOAP
         else:
             log.error("Can't use '%s' retrieval method. Using SOAP method." % condor_query_type)
             self.resource_query = self.resource_query_SOAP
+            self.vm_machine_query = self.vm_machine_query_SOAP
             
         if config.scheduling_metric.lower() == "slot":
             self.vmtype_distribution = self.vmtype_slot_distribution
@@ -147,11 +687,15 @@ class ResourcePool:
             log.error("Can't use '%s' distribution method, not valid" % config.scheduling_metric)
             self.vmtype_distribution = self.vmtype_slot_distribution
 
+        # cluster name -> (cloud_resources.conf options, configured
+        # capacity) the cluster was last set up from
+        self.cluster_definitions = {}
         self.setup()
         
         if config.user_limit_file:
             self.user_vm_limits = self.load_user_limits(config.user_limit_file)
         if config.ban_tracking:
+            self.load_failure_history()
             self.load_banned_job_resource()
         self.load_persistence()
 
@@ -167,6 +711,7 @@ class ResourcePool:
             return
 
         new_resources = []
+        new_definitions = {}
 
         try:
             cloud_config = ConfigParser.ConfigParser()
@@ -183,81 +728,99 @@ class ResourcePool:
             new_cluster = self._cluster_from_config(cloud_config, cluster)
             if new_cluster:
                 new_resources.append(new_cluster)
+                new_definitions[cluster] = (dict(cloud_config.items(cluster)),
+                                            self._configured_capacity(new_cluster))
 
-        # Check to see if we are removing any clusters. If so,
-        # shut down all the VMs of the cluster we're removing
-        original_resource_names = [cluster.name for cluster in self.resources]
+        # Sort the clusters into those to remove, add, leave alone, resize
+        # in place (only their capacity options changed) and rebuild
+        original_resources = dict((cluster.name, cluster) for cluster in self.resources)
         new_resource_names = [cluster.name for cluster in new_resources]
 
-        removed_names = set(original_resource_names) - set(new_resource_names)
-        added_names = set(new_resource_names) - set(original_resource_names)
-        updated_names = set(original_resource_names) & set(new_resource_names)
+        removed_names = set(original_resources) - set(new_resource_names)
+        added_names = set(new_resource_names) - set(original_resources)
+        unchanged_names = set()
+        resized_names = set()
+        rebuilt_names = set()
+        for name in set(original_resources) & set(new_resource_names):
+            old_options, old_capacity = self.cluster_definitions.get(name, (None, None))
+            new_options, new_capacity = new_definitions[name]
+            if old_options == new_options:
+                unchanged_names.add(name)
+            elif old_options != None and \
+                    self._without_capacity(old_options) == self._without_capacity(new_options) and \
+                    self._resize_cluster(original_resources[name], old_capacity, new_capacity):
+                resized_names.add(name)
+            else:
+                rebuilt_names.add(name)
 
         if removed_names:
             log.debug("Removing clusters: %s" % removed_names)
         if added_names:
             log.debug("Adding clusters: %s" % added_names)
-        if updated_names:
-            log.debug("Updating clusters: %s" % updated_names)
-
-        # Set resources list to empty to make sure no VMs are started
-        # while we're shuffling things around.
-        old_resources = []
-        for cluster in reversed(self.resources):
+        if resized_names:
+            log.debug("Resizing clusters: %s" % resized_names)
+        if rebuilt_names:
+            log.debug("Rebuilding clusters: %s" % rebuilt_names)
+
+        # Make sure no VMs are started on the clusters we're replacing
+        # or removing while we're shuffling things around.
+        for name in removed_names | rebuilt_names:
+            cluster = original_resources[name]
             with cluster.res_lock:
                 cluster.vm_slots = 0
                 cluster.memory = []
                 if cluster.__class__.__name__ == "NimbusCluster":
                     cluster.net_slots = {}
-            old_resources.append(cluster)
-            self.resources.remove(cluster)
+                cluster.capacity_version += 1
 
-        # Update resources
-        # Do this by replacing each updated cluster object with the
+        # Rebuild changed clusters
+        # Do this by replacing each changed cluster object with the
         # cluster object built by reading the config file, then copying
-        # over to the new object. Feel free to refactor me. I dare you.
-        for updated_name in updated_names:
-            for old_cluster in old_resources:
-                if old_cluster.name == updated_name:
-
-                    with old_cluster.res_lock:
-                        for new_cluster in new_resources:
-                            if new_cluster.name == updated_name:
-
-                                new_cluster.vms = sorted(old_cluster.vms, key=lambda vm: vm.id)
-                                new_cluster.vms = sorted(new_cluster.vms, key=lambda vm: vm.status)
-                                while 1:
-                                    if new_cluster.vms[0].status == "Error":
-                                        new_cluster.vms.append(new_cluster.vms.pop(0))
-                                    else:
-                                        break
-                                new_cluster.vms.reverse()
-                                
-                                for vm in reversed(new_cluster.vms):
-                                    try:
-                                        new_cluster.resource_checkout(vm)
-                                    except cluster_tools.NoResourcesError, e:
-                                        new_cluster.vm_destroy(vm, return_resources=False, reason="Not enough %s on %s." % (e.resource, new_cluster.name))
-                                    except:
-                                        new_cluster.vm_destroy(vm, return_resources=False, reason="Unexcepted error checking out resources.")
-                                self.resources.append(new_cluster)
-
-        # Add new resources
-        for new_cluster_name in added_names:
-            for new_cluster in new_resources:
-                if new_cluster.name == new_cluster_name:
-                    self.resources.append(new_cluster)
+        # over its VMs and checking their resources out again.
+        resources = []
+        for new_cluster in new_resources:
+            name = new_cluster.name
+            if name in unchanged_names or name in resized_names:
+                resources.append(original_resources[name])
+            elif name in added_names:
+                self.vm_registry.attach(new_cluster)
+                resources.append(new_cluster)
+            else:
+                old_cluster = original_resources[name]
+                with old_cluster.res_lock:
+                    # Check out Error VMs last, so they're the ones destroyed
+                    # if the cluster has shrunk
+                    vms = sorted(old_cluster.vms, key=lambda vm: (vm.status == "Error", vm.status, vm.id))
+                    self.vm_registry.detach(old_cluster)
+                    new_cluster.vms = list(reversed(vms))
+                    for vm in vms:
+                        try:
+                            new_cluster.resource_checkout(vm)
+                        except cluster_tools.NoResourcesError, e:
+                            new_cluster.vm_destroy(vm, return_resources=False, reason="Not enough %s on %s." % (e.resource, new_cluster.name))
+                        except:
+                            new_cluster.vm_destroy(vm, return_resources=False, reason="Unexcepted error checking out resources.")
+                # Index the VMs before the cluster is visible in resources
+                self.vm_registry.attach(new_cluster)
+                resources.append(new_cluster)
+        self.resources[:] = resources
 
         # Remove resources
         for removed_cluster_name in removed_names:
-            for cluster in reversed(old_resources):
-                if cluster.name == removed_cluster_name:
-                    log.info("Removing %s from available resources" % 
-                                                          removed_cluster_name)
-                    self.retired_resources.append(cluster)
-                    for vm in cluster.vms:
-                            cluster.vm_destroy(vm, return_resources=False, reason="%s has been removed from system." % cluster.name)
-                    old_resources.remove(cluster)
+            cluster = original_resources[removed_cluster_name]
+            log.info("Removing %s from available resources" % 
+                                                  removed_cluster_name)
+            self.retired_resources.append(cluster)
+            for vm in list(cluster.vms):
+                    cluster.vm_destroy(vm, return_resources=False, reason="%s has been removed from system." % cluster.name)
+            self.vm_registry.detach(cluster)
+
+        self.cluster_definitions = new_definitions
+
+        self.capabilities = {}
+        for cluster in self.resources:
+            self.capabilities[cluster.name] = ClusterCapabilities(cluster)
+        self.clear_fit_memo()
 
         self.setup_lock.release()
         if self.setup_queued:
@@ -265,6 +828,51 @@ class ResourcePool:
             self.setup()
 
 
+    # cloud_resources.conf options that only set a cluster's capacity, and
+    # can be changed on reconfig without rebuilding the cluster
+    CAPACITY_OPTIONS = ('vm_slots', 'memory', 'storage', 'total_cpu_cores')
+
+    @staticmethod
+    def _configured_capacity(cluster):
+        """Return the capacity of a cluster fresh from the config file."""
+        return {'vm_slots': cluster.vm_slots,
+                'memory': list(cluster.memory),
+                'storage': cluster.storageGB,
+                'net_slots': dict(getattr(cluster, 'net_slots', {})),
+                'total_cpu_cores': getattr(cluster, 'total_cpu_cores', -1)}
+
+    def _without_capacity(self, options):
+        return dict((option, value) for option, value in options.iteritems()
+                    if option not in self.CAPACITY_OPTIONS)
+
+    def _resize_cluster(self, cluster, old_capacity, new_capacity):
+        """Apply the change from old_capacity to new_capacity, both from
+        _configured_capacity, to the free capacity of cluster in place. A
+        cluster that is now over its capacity is left to drain as its VMs
+        finish. Returns False, changing nothing, if the capacities don't
+        line up (a different number of memory entries or networks, or a
+        core limit added or dropped)."""
+        if len(old_capacity['memory']) != len(new_capacity['memory']) or \
+                sorted(old_capacity['net_slots']) != sorted(new_capacity['net_slots']) or \
+                (old_capacity['total_cpu_cores'] == -1) != (new_capacity['total_cpu_cores'] == -1):
+            return False
+        with cluster.res_lock:
+            if len(cluster.memory) != len(new_capacity['memory']):
+                return False
+            cluster.vm_slots += new_capacity['vm_slots'] - old_capacity['vm_slots']
+            cluster.max_slots += new_capacity['vm_slots'] - old_capacity['vm_slots']
+            cluster.storageGB += new_capacity['storage'] - old_capacity['storage']
+            cluster.max_storageGB = new_capacity['storage']
+            cluster.memory = [free + new - old for free, new, old in
+                              zip(cluster.memory, new_capacity['memory'], old_capacity['memory'])]
+            cluster.max_mem = tuple(new_capacity['memory'])
+            for network, slots in new_capacity['net_slots'].iteritems():
+                cluster.net_slots[network] += slots - old_capacity['net_slots'][network]
+            if new_capacity['total_cpu_cores'] != -1:
+                cluster.total_cpu_cores += new_capacity['total_cpu_cores'] - old_capacity['total_cpu_cores']
+            cluster.capacity_version += 1
+        return True
+
     @staticmethod
     def _cluster_from_config(config, cluster):
         """Create a new cluster object from a config file's specification."""
@@ -399,6 +1007,7 @@ class ResourcePool:
     def add_resource(self, cluster):
         """Add a cluster resource to the pool's resource list."""
         self.resources.append(cluster)
+        self.capabilities[cluster.name] = ClusterCapabilities(cluster)
 
     def log_list(self, clusters):
         """Log a list of clusters.
@@ -512,6 +1121,17 @@ class ResourcePool:
             log.debug("Pool is empty... Cannot return list of fitting resources")
             return []
 
+        # Identical queries within a scheduling cycle are answered from the
+        # memo until some cluster's capacity or the bans change
+        query = (network, cpuarch, memory, cpucores, storage, _hashable(ami), imageloc,
+                 _hashable(targets), _hashable(hypervisor), _hashable(blocked))
+        version = self._fit_memo_version()
+        if version != self.fit_memo_version:
+            self.fit_memo = {}
+            self.fit_memo_version = version
+        elif query in self.fit_memo:
+            return list(self.fit_memo[query])
+
         fitting_clusters = []
         if len(targets) > 0:
             clusters = self.filter_resources_by_names(targets)
@@ -524,14 +1144,17 @@ class ResourcePool:
             if cluster.name in blocked:
                 log.verbose("get_fitting_resources - %s is blocked." % cluster.name)
                 continue
-            if cluster.__class__.__name__ == "NimbusCluster":
+            capabilities = self.capabilities.get(cluster.name)
+            if capabilities == None:
+                capabilities = self.capabilities[cluster.name] = ClusterCapabilities(cluster)
+            if capabilities.kind == "NimbusCluster":
                 # If not valid image file to download
                 if imageloc == "":
                     continue
                 # If required network is NOT in cluster's network associations
                 # if network is undefined then it means pick whatever, so we
                 # just always okay it.
-                if network and (network not in cluster.network_pools):
+                if network and (network not in capabilities.network_pools):
                     log.verbose("get_fitting_resources - No matching networks in %s" % cluster.name)
                     continue
                 if network and network in cluster.net_slots.keys() and cluster.net_slots[network] <= 0:
@@ -545,36 +1168,33 @@ class ResourcePool:
                     if full:
                         log.verbose("get_fitting_resources - No Slots left on %s" % cluster.name)
                         continue
-                if imageloc in self.banned_job_resource.keys():
-                    if cluster.name in self.banned_job_resource[imageloc]:
-                        log.verbose("get_fitting_resources - %s cloud is banned for image location" % cluster.name)
-                        continue
-                if cluster.max_vm_storage != -1 and storage > cluster.max_vm_storage:
+                if self._is_banned(imageloc, cluster.name):
+                    log.verbose("get_fitting_resources - %s cloud is banned for image location" % cluster.name)
+                    continue
+                if capabilities.max_vm_storage != -1 and storage > capabilities.max_vm_storage:
                     log.verbose("get_fitting_resources - Storage request exceeds max_vm_storage for %s" % cluster.name)
                     continue
                 if cluster.total_cpu_cores != -1 and cpucores > cluster.total_cpu_cores:
                     log.verbose("get_fitting_resources - cpu request greater than total available cores on %s" % cluster.name)
                     continue
-                if cluster.hypervisor not in hypervisor:
+                if capabilities.hypervisor not in hypervisor:
                     log.verbose("get_fitting_resources - Wrong hypervisor on %s" % cluster.name)
                     continue
-            elif cluster.__class__.__name__ == "EC2Cluster":
+            elif capabilities.kind == "EC2Cluster":
                 # If no valid ami to boot from
                 if ami == "":
                     continue
                 # If ami banned from cluster
-                if ami in self.banned_job_resource.keys():
-                    if cluster.name in self.banned_job_resource[ami]:
-                        log.verbose("get_fitting_resources - %s ami banned on %s" % (ami, cluster.name))
-                        continue
+                if self._is_banned(ami, cluster.name):
+                    log.verbose("get_fitting_resources - %s ami banned on %s" % (ami, cluster.name))
+                    continue
             
-            elif cluster.__class__.__name__ == "StratusLabCluster" and stratuslab_support:
+            elif capabilities.kind == "StratusLabCluster" and stratuslab_support:
                 # If not valid image file
                 if imageloc == "":
                     continue
-                if imageloc in self.banned_job_resource.keys():
-                    if cluster.name in self.banned_job_resource[imageloc]:
-                        continue
+                if self._is_banned(imageloc, cluster.name):
+                    continue
                 if (not Image.isDiskId(imageloc)) and (not Image.isImageId(imageloc)):
                     continue
             
@@ -583,11 +1203,11 @@ class ResourcePool:
                 log.verbose("get_fitting_resources - No free slots in %s" % cluster.name)
                 continue
             # If the cluster does not have the required CPU architecture
-            if (cpuarch not in cluster.cpu_archs):
+            if (cpuarch not in capabilities.cpu_archs):
                 log.verbose("get_fitting_resources - No matching CPU archs in %s" % cluster.name)
                 continue
             # If request exceeds the max vm memory on cluster
-            if memory > cluster.max_vm_mem and cluster.max_vm_mem != -1:
+            if memory > capabilities.max_vm_mem and capabilities.max_vm_mem != -1:
                 continue
             # If the cluster has no sufficient memory entries for the VM
             if (cluster.find_mementry(memory) < 0):
@@ -608,8 +1228,27 @@ class ResourcePool:
         if fitting_clusters:
             log.verbose("List of fitting clusters: ")
             self.log_list(fitting_clusters)
+        self.fit_memo[query] = tuple(fitting_clusters)
         return fitting_clusters
 
+    def _fit_memo_version(self):
+        """Changes whenever a cluster's capacity (resource_checkout and
+        resource_return) or enabled state, or the fit generation, changes."""
+        return (self.fit_generation,
+                tuple((cluster.capacity_version, cluster.enabled) for cluster in self.resources))
+
+    def clear_fit_memo(self):
+        """Forget memoised get_fitting_resources results. Called at the start
+        of each scheduling cycle and whenever bans or the clusters change."""
+        self.fit_generation += 1
+
+    def _is_banned(self, image, cluster_name):
+        """True if image (an image location or ami) is banned on the cluster."""
+        try:
+            return cluster_name in self.banned_job_resource.get(image, ())
+        except TypeError: # unhashable image, such as a job's ami dictionary
+            return False
+
 
     def get_resourceBF(self, network, cpuarch, memory, cpucores, storage, ami, imageloc, targets=[], hypervisor=['xen'], blocked=[]):
         """
@@ -766,11 +1405,7 @@ class ResourcePool:
 
     def get_cluster_with_vm(self, vm):
         """Find cluster that contains vm."""
-        cluster = None
-        for c in self.resources:
-            if vm in c.vms:
-                cluster = c
-        return cluster
+        return self.vm_registry.cluster_of(vm)
 
     def convert_classad_dict(self, ad):
         """Convert the Condor class ad struct into a python dict.
@@ -800,21 +1435,8 @@ class ResourcePool:
         registered with condor.
         """
         log.verbose("Querying Condor Collector with %s" % config.condor_status_command)
-
-        machine_list = []
-        try:
-            condor_status = shlex.split(config.condor_status_command)
-            sp = subprocess.Popen(condor_status, shell=False,
-                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            (condor_out, condor_err) = sp.communicate(input=None)
-        except:
-            log.exception("Problem running %s, unexpected error" % string.join(condor_status, " "))
-            return []
-
-
-        machine_list = self._condor_status_to_machine_list(condor_out)
-
-        return machine_list
+        return list(self._condor_status_popen(config.condor_status_command,
+                                              VMMachine.CONDOR_ATTRIBUTES.values()))
 
 
     def resource_query_SOAP(self):
@@ -851,19 +1473,124 @@ class ResourcePool:
         registered with condor.
         """
         log.verbose("Querying Condor Collector with %s" % config.condor_status_master_command)
+        return list(self._condor_status_popen(config.condor_status_master_command,
+                                              VMMachine.MASTER_ATTRIBUTES))
 
-        master_list = []
+    def vm_machine_query_local(self):
+        """
+        vm_machine_query_local -- queries the condor collector for the master
+        and then the startd ads, building VMMachines as the startd ads are
+        read from condor_status
+
+        Returns a list of VMMachines, [] if the query failed
+        """
+        master_ips = {}
+        for master in self._condor_status_popen(config.condor_status_master_command,
+                                                VMMachine.MASTER_ATTRIBUTES):
+            try:
+                master_ips[master['Machine']] = master['MasterIpAddr']
+            except KeyError:
+                log.warning('could not read master ip addr')
+        log.verbose("Querying Condor Collector with %s" % config.condor_status_command)
+        classads = self._condor_status_popen(config.condor_status_command,
+                                             VMMachine.CONDOR_ATTRIBUTES.values())
+        return list(self._classads_to_vmmachines(classads, master_ips))
+
+    def vm_machine_query_SOAP(self):
+        """
+        vm_machine_query_SOAP -- queries the condor collector for startd ads
+        with the SOAP API and for master ads locally
+
+        Returns a list of VMMachines, [] if the query failed
+        """
+        return self.machinelist_to_vmmachinelist(self.resource_query_SOAP(),
+                                                 self.master_resource_query_local())
+
+    @staticmethod
+    def _condor_status_popen(command, attributes):
+        """
+        _condor_status_popen - Generator running condor_status and yielding
+               each ClassAd, as a dictionary of the given attributes only,
+               as soon as it is read from the pipe
+        """
+        condor_status = ResourcePool._condor_status_command(command, attributes)
         try:
-            condor_status = shlex.split(config.condor_status_master_command)
+            # stderr goes to a file so a chatty condor_status can't fill the
+            # pipe and block while we are still reading stdout
+            condor_err = tempfile.TemporaryFile()
             sp = subprocess.Popen(condor_status, shell=False,
-                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            (condor_out, condor_err) = sp.communicate(input=None)
+                       stdout=subprocess.PIPE, stderr=condor_err)
         except:
             log.exception("Problem running %s, unexpected error" % string.join(condor_status, " "))
-            return []
+            return
+        try:
+            for classad in ResourcePool._condor_status_stream(iter(sp.stdout.readline, ''),
+                                                               frozenset(attributes)):
+                yield classad
+        finally:
+            sp.stdout.close()
+            returncode = sp.wait()
+            condor_err.close()
+        if returncode != 0:
+            log.error("Got non-zero return code '%s' from '%s'" %
+                      (returncode, string.join(condor_status, " ")))
 
-        master_list = self._condor_status_to_machine_list(condor_out)
-        return master_list
+    @staticmethod
+    def _condor_status_stream(condor_status_lines, attributes=None):
+        """
+        _condor_status_stream - Generator converting the output of
+               condor_status -l, given as an iterable of lines, to one
+               dictionary per ClassAd, holding only the given attributes
+               (or all of them if attributes is None)
+        """
+        classad = {}
+        for classad_line in condor_status_lines:
+            classad_line = classad_line.strip()
+            # Each classad is seperated by a blank line
+            if not classad_line:
+                if classad:
+                    yield classad
+                    classad = {}
+                continue
+            try:
+                (classad_key, classad_value) = classad_line.split(" = ", 1)
+            except ValueError:
+                log.debug("Skipping unexpected condor_status line: %s" % classad_line)
+                continue
+            if attributes == None or classad_key in attributes:
+                classad[classad_key] = classad_value.strip('"')
+        if classad:
+            yield classad
+
+    @staticmethod
+    def _classads_to_vmmachines(classads, master_ips):
+        """
+        _classads_to_vmmachines - Generator building a VMMachine from each
+               startd ClassAd dictionary, with its master's address
+               looked up in master_ips by Machine name
+        """
+        for classad in classads:
+            if not classad.has_key('Machine'):
+                log.warning("Failed to create VMMachine Obj")
+                continue
+            attributes = {'current_time': -1, 'entered_state_time': -1}
+            for attribute, condor_attribute in VMMachine.CONDOR_ATTRIBUTES.iteritems():
+                if classad.has_key(condor_attribute):
+                    attributes[attribute] = classad[condor_attribute]
+            if master_ips.has_key(classad['Machine']):
+                attributes['address_master'] = master_ips[classad['Machine']]
+            yield VMMachine(**attributes)
+
+    @staticmethod
+    def _condor_status_command(command, attributes):
+        """
+        _condor_status_command - Builds a condor_status command line, asking
+               only for the given attributes if condor_query_projection is set
+        """
+        condor_status = shlex.split(command)
+        if config.condor_query_projection:
+            condor_status.extend(['-attributes', ','.join(attributes)])
+        return condor_status
 
     @staticmethod
     def _condor_status_to_machine_list(condor_status_output):
@@ -875,25 +1602,7 @@ class ResourcePool:
                returns [] is there are no machines
         """
 
-        machines = []
-
-        # Each classad is seperated by '\n\n'
-        raw_machine_classads = condor_status_output.split("\n\n")
-        # Empty condor pools give us an empty string or stray \n in our list
-        raw_machine_classads = filter(lambda x: x != "" and x != "\n", raw_machine_classads)
-
-        for raw_classad in raw_machine_classads:
-            classad = {}
-            classad_lines = raw_classad.splitlines()
-            for classad_line in classad_lines:
-                classad_line = classad_line.strip()
-                (classad_key, classad_value) = classad_line.split(" = ", 1)
-                classad_value = classad_value.strip('"')
-                classad[classad_key] = classad_value
-
-            machines.append(classad)
-
-        return machines
+        return list(ResourcePool._condor_status_stream(StringIO(condor_status_output)))
 
 
     @staticmethod
@@ -981,11 +1690,7 @@ class ResourcePool:
 
     def find_in_where(self, machineList, criteria):
         """Find all the matching entries for given criteria."""
-        matches = []
-        for machine in machineList:
-            if self.match_criteria(machine.__dict__, criteria):
-                matches.append(machine)
-        return matches
+        return self.get_machine_index(machineList).find(criteria)
 
     #Creating a usertype version of this function was skipped
     #def get_vmtypes_count_internal(self):
@@ -1002,31 +1707,15 @@ class ResourcePool:
 
     def get_vmtypes_count_internal(self):
         """Get a dictionary of uservmtypes of VMs the scheduler is currently tracking."""
-        types = defaultdict(int)
-        for cluster in self.resources:
-            for vm in cluster.vms:
-                types[vm.uservmtype] += 1
-        return types
+        return self.vm_registry.counts('uservmtype')
 
     def get_vmtypes_count_cpu_slots(self):
         """Get a dictionary of uservmtypes of VMs the scheduler is currently tracking."""
-        types = defaultdict(int)
-        for cluster in self.resources:
-            for vm in cluster.vms:
-                if vm.job_per_core:
-                    types[vm.uservmtype] += vm.cpucores
-                else:
-                    types[vm.uservmtype] += 1
-        return types
+        return self.vm_registry.get_slot_counts()
 
     def get_vm_count_user(self, user):
         """Get a count of the number of VMs for specified user."""
-        count = 0
-        for cluster in self.resources:
-            for vm in cluster.vms:
-                if vm.user == user:
-                    count += 1
-        return count
+        return self.vm_registry.count('user', user)
 
     def vm_count(self):
         """Count of VMs in the system."""
@@ -1035,84 +1724,74 @@ class ResourcePool:
             count = count + len(cluster.vms)
         return count
 
+    def get_machine_index(self, machine_list):
+        """Return a MachineIndex of machine_list, reusing the last one
+        built if it was for the same list."""
+        index = self.machine_index
+        if index == None or index.machines is not machine_list:
+            index = MachineIndex(machine_list)
+            self.machine_index = index
+        return index
+
+    def refresh_fair_share(self, job_pool):
+        """Compute a new FairShareState from the current VMs and jobs."""
+        with self.fair_share_lock:
+            self.fair_share_generation += 1
+            self.fair_share = FairShareState(self, job_pool, self.fair_share_generation)
+            log.verbose("Fair share generation %d: %s" % (self.fair_share_generation, self.fair_share.diff_types))
+            return self.fair_share
+
+    def get_fair_share(self, job_pool, max_age=None):
+        """Return the latest FairShareState, only computing a new one if
+        there is none yet or it is older than max_age seconds (by default
+        two scheduler intervals, ie. the scheduler has stopped refreshing)."""
+        if max_age == None:
+            max_age = 2 * config.scheduler_interval
+        fair_share = self.fair_share
+        if fair_share == None or time.time() - fair_share.computed_at > max_age:
+            fair_share = self.refresh_fair_share(job_pool)
+        return fair_share
+
     def vmtype_slot_distribution(self, types=None):
         """VM Type Distribution."""
         if types is None:
             types = self.get_vmtypes_count_internal()
-        count = Decimal(self.vm_count())
+        count = self.vm_count()
         if count == 0:
             return {}
-        count = 1 / count
-        for vmtype in types.keys():
-            types[vmtype] *= count
-        return types
+        scale = 1.0 / count
+        return dict((vmtype, num * scale) for vmtype, num in types.iteritems())
 
     def vmtype_mem_distribution(self, vmcount=None):
         """VM Type Memory Distribution."""
-        if vmcount:
-            usage = self.vmtype_resource_usage_sim(vmcount)
-        else:
-            usage = self.vmtype_resource_usage()
-        types = {}
-        mem_total = 0
-        for vmtype in usage:
-            types[vmtype] = usage[vmtype][0]
-            mem_total += usage[vmtype][0]
-        del usage
-        if mem_total == 0:
-            return {}
-        mem_total = 1 / Decimal(mem_total)
-        for vmtype in types.keys():
-            types[vmtype] *= mem_total
-        return types
+        usage = self._distribution_usage(vmcount)
+        return utilities.normalise_shares(dict((vmtype, mem)
+                for vmtype, (mem, cpu, storage) in usage.iteritems()))
 
     def vmtype_mem_cpu_distribution(self, vmcount=None):
         """VM Type Memory & CPU Distribution."""
-        if vmcount:
-            usage = self.vmtype_resource_usage_sim(vmcount)
-        else:
-            usage = self.vmtype_resource_usage()
-        types = {}
-        mem_cpu_total = 0
-        for vmtype in usage:
-            mem_cpu_area = usage[vmtype][0] * usage[vmtype][1]
-            types[vmtype] = mem_cpu_area
-            mem_cpu_total += mem_cpu_area
-        del usage
-        if mem_cpu_total == 0:
-            return {}
-        mem_cpu_total = 1 / Decimal(mem_cpu_total)
-        for vmtype in types.keys():
-            types[vmtype] *= mem_cpu_total
-        return types
+        usage = self._distribution_usage(vmcount)
+        return utilities.normalise_shares(dict((vmtype, mem * cpu)
+                for vmtype, (mem, cpu, storage) in usage.iteritems()))
 
     def vmtype_mem_cpu_storage_distribution(self, vmcount=None):
         """VM Type Memory & CPU & Storage Distribution."""
-        if vmcount:
-            usage = self.vmtype_resource_usage_sim(vmcount)
-        else:
-            usage = self.vmtype_resource_usage()
-        types = {}
-        vol_total = 0
+        usage = self._distribution_usage(vmcount)
         weight_all = config.cpu_distribution_weight * config.memory_distribution_weight * config.storage_distribution_weight
         weight_cm = config.cpu_distribution_weight * config.memory_distribution_weight
-        for vmtype in usage:
-            vol = 0
-            if usage[vmtype][2] != 0:
-                vol = usage[vmtype][0] * usage[vmtype][1] * usage[vmtype][2] * weight_all
-                types[vmtype] = Decimal(str(vol))
+        types = {}
+        for vmtype, (mem, cpu, storage) in usage.iteritems():
+            if storage != 0:
+                types[vmtype] = mem * cpu * storage * weight_all
             else:
-                vol = usage[vmtype][0] * usage[vmtype][1] * weight_cm
-                types[vmtype] = Decimal(str(vol))
-            vol_total += vol
-        del usage
-        if vol_total == 0:
-            return {}
-        if vol_total != 0:
-            mem_cpu_storage_total = 1 / Decimal(str(vol_total))
-        for vmtype in types.keys():
-            types[vmtype] *= mem_cpu_storage_total
-        return types
+                types[vmtype] = mem * cpu * weight_cm
+        return utilities.normalise_shares(types)
+
+    def _distribution_usage(self, vmcount=None):
+        """Resource usage per uservmtype, simulated from vmcount if given."""
+        if vmcount:
+            return self.vmtype_resource_usage_sim(vmcount)
+        return self.vmtype_resource_usage()
 
     # Skipped creating an alternate usertypes version of this function
     # VM Type resource usage
@@ -1137,14 +1816,7 @@ class ResourcePool:
         Counts up how much/many of each resource (RAM, Cores, Storage)
         are being used by each type of VM
         """
-        types = defaultdict(list)
-        for cluster in self.resources:
-            for vm in cluster.vms:
-                types[vm.uservmtype].append([vm.memory, vm.cpucores, vm.storage])
-        results = {}
-        for vmtype in types.keys():
-            results[vmtype] = [sum(values) for values in zip(*types[vmtype])]
-        return results
+        return self.vm_registry.get_usage()
 
     def vmtype_resource_usage_sim(self, vmcount):
         """Count the resources used by each type of VM through a count of VMs instead of iterating over all VMs.
@@ -1152,16 +1824,10 @@ class ResourcePool:
         # Locate a VM for each type in vmcount
         types = {}
         for vmusertype in vmcount.keys():
-            foundIt = False
-            for cluster in self.resources:
-                for vm in cluster.vms:
-                    if vm.uservmtype == vmusertype:
-                        foundIt = True
-                        types[vmusertype] = vm
-                        break
-                if foundIt:
-                    break
-            if not foundIt:
+            vm = self.vm_registry.find_one('uservmtype', vmusertype)
+            if vm != None:
+                types[vmusertype] = vm
+            else:
                 log.warning("Unable to find VM with type %s" % vmusertype)
         results = {}
         # Compute the resource usage based on given counts instead of checking every VM.
@@ -1222,133 +1888,134 @@ class ResourcePool:
             changed[n] = changed[n].split('.')[0]
         return changed
 
-    def save_persistence(self):
+    def save_persistence(self, compact=False):
         """
-        save_persistence - pickle the resources list to the persistence file
+        save_persistence - write the VM changes since the last save to the
+                           persistence journal, compacting it into a new
+                           snapshot of the resources list once it grows large
+                           or if compact is set. Otherwise nothing is written
+                           if no VM has changed.
         """
-        with self.setup_lock:
-            try:
-                persistence_file = open(config.persistence_file, "wb")
-                pickle.dump(self.resources, persistence_file)
-                persistence_file.close()
-            except IOError, e:
-    
-                log.error("Couldn't write persistence file to %s! \"%s\"" % 
-                          (config.persistence_file, e.strerror))
-            except:
-                log.exception("Unknown problem saving persistence file!")
+        self.vm_journal.save(self.resources, len(self.vm_registry.cluster_of_vm),
+                             self.setup_lock, compact)
 
     def load_persistence(self):
         """
-        load_persistence - if a pickled persistence file exists, load it and 
-                           check to see if the resources described in it are
-                           valid. If so, add them to the list of resources.
+        load_persistence - if a persistence snapshot exists, load it, replay
+                           the journal written since, and check to see if the
+                           resources described in them are valid. If so, add
+                           them to the list of resources.
         """
 
         try:
             log.info("Loading persistence file from last run.")
-            persistence_file = open(config.persistence_file, "rb")
+            persisted = self.vm_journal.replay()
+            if persisted == ([], []) and self.state_store != None:
+                # a new state store; take over the persistence file, if any
+                persisted = VMJournal(config.persistence_file).replay()
         except IOError, e:
             log.debug("No persistence file to load. Exited normally last time.")
             return
         except:
             log.exception("Unknown problem opening persistence file!")
             return
-
-        try:
-            old_resources = pickle.load(persistence_file)
-        except:
-            log.exception("Unknown problem opening persistence file!")
-            return
-        persistence_file.close()
-
+        old_resources, persisted_vms = persisted
+        old_clusters = dict((old_cluster.name, old_cluster) for old_cluster in old_resources)
         for old_cluster in old_resources:
             old_cluster.setup_logging()
 
-            for vm in old_cluster.vms:
-                log.debug("Found VM %s on %s" % (vm.id, old_cluster.name))
-                new_cluster = self.get_cluster(old_cluster.name)
-
-                if new_cluster:
-                    try:
-                        new_cluster.resource_checkout(vm)
-                        new_cluster.vms.append(vm)
-                        log.info("Persisted VM %s on %s." % (vm.id, new_cluster.name))
-                    except cluster_tools.NoResourcesError, e:
-                        new_cluster.vm_destroy(vm, return_resources=False, reason="Not enough %s left on %s" %(e.resource, new_cluster.name))
-                    except:
-                        new_cluster.vm_destroy(vm, return_resources=False, reason="Unexpected error checking out resources.")
-                else:
-                    log.info("%s doesn't seem to exist, so destroying vm %s." %
-                             (old_cluster.name, vm.id))
-                    old_cluster.vm_destroy(vm, reason="cloud %s no longer exists." % old_cluster.name)
+        for cluster_name, vm in persisted_vms:
+            log.debug("Found VM %s on %s" % (vm.id, cluster_name))
+            new_cluster = self.get_cluster(cluster_name)
+
+            if new_cluster:
+                try:
+                    new_cluster.resource_checkout(vm)
+                    new_cluster.vms.append(vm)
+                    log.info("Persisted VM %s on %s." % (vm.id, new_cluster.name))
+                except cluster_tools.NoResourcesError, e:
+                    new_cluster.vm_destroy(vm, return_resources=False, reason="Not enough %s left on %s" %(e.resource, new_cluster.name))
+                except:
+                    new_cluster.vm_destroy(vm, return_resources=False, reason="Unexpected error checking out resources.")
+            elif old_clusters.has_key(cluster_name):
+                log.info("%s doesn't seem to exist, so destroying vm %s." %
+                         (cluster_name, vm.id))
+                old_clusters[cluster_name].vm_destroy(vm, reason="cloud %s no longer exists." % cluster_name)
+            else:
+                log.error("%s doesn't exist any more and isn't in the persistence snapshot, "
+                          "so vm %s can't be destroyed." % (cluster_name, vm.id))
+
+        # Start the journal afresh from what survived
+        self.save_persistence(compact=True)
 
     def track_failures(self, job, resources,  value):
         """Error Tracking to be used to ban / filter resources."""
         for cluster in resources:
             if cluster.__class__.__name__ == 'NimbusCluster':
-                if job.req_imageloc in self.failures.keys():
-                    foundIt = False
-                    for resource in self.failures[job.req_imageloc]:
-                        if resource.name == cluster.name:
-                            resource.append(value)
-                            foundIt = True
-                        if foundIt:
-                            break
-                        else:
-                            queue = ErrTrackQueue(cluster.name)
-                            queue.append(value)
-                            self.failures[job.req_imageloc].append(queue)
-                else:
-                    self.failures[job.req_imageloc] = []
-                    queue = ErrTrackQueue(cluster.name)
-                    queue.append(value)
-                    self.failures[job.req_imageloc].append(queue)
+                image = job.req_imageloc
 
             elif cluster.__class__.__name__ == 'StratusLabCluster' and stratuslab_support:
                 # If not valid image file to download
-                if imageloc == "":
+                image = job.req_imageloc
+                if image == "":
                     continue
-                if (not Image.isDiskId(imageloc)) and (not Image.isImageId(imageloc)):
+                if (not Image.isDiskId(image)) and (not Image.isImageId(image)):
                     continue
-                resource.append(value)
 
             elif cluster.__class__.__name__ == 'EC2Cluster':
-                if job.req_ami in self.failures.keys():
-                    foundIt = False
-                    for resource in self.failures[job.req_ami]:
-                        if resource.name == cluster.name:
-                            resource.append(value)
-                            foundIt = True
-                        if foundIt:
-                            break
-                        else:
-                            queue = ErrTrackQueue(cluster.name)
-                            queue.append(value)
-                            self.failures[job.req_ami].append(queue)
-                else:
-                    self.failures[job.req_ami] = []
-                    queue = ErrTrackQueue(cluster.name)
-                    queue.append(value)
-                    self.failures[job.req_ami].append(queue)
+                image = job.req_ami
+            else:
+                continue
+
+            if self.state_store != None:
+                self.state_store.record_failure(image, cluster.name, value)
+            with self.ban_lock:
+                self._failure_queue(image, cluster.name).append(value)
+                self.failures_changed.add((image, cluster.name))
+
+    def _failure_queue(self, image, cluster_name):
+        """Return the ErrTrackQueue of image on the named cluster, adding an
+        empty one if there is none yet."""
+        queues = self.failures.setdefault(image, {})
+        queue = queues.get(cluster_name)
+        if queue == None:
+            queue = queues[cluster_name] = ErrTrackQueue(cluster_name)
+        return queue
+
+    def load_failure_history(self):
+        """Refill the failure tracking queues from the state store's boot
+        history, so a restart doesn't forget recent failures."""
+        if self.state_store == None:
+            return
+        try:
+            history = self.state_store.load_failures(config.ban_min_track)
+        except:
+            log.exception("Problem loading failure history from the state store!")
+            return
+        with self.ban_lock:
+            for image, clusters in history.iteritems():
+                for cluster_name, attempts in clusters.iteritems():
+                    queue = self._failure_queue(image, cluster_name)
+                    for success in attempts:
+                        queue.append(success)
+                    self.failures_changed.add((image, cluster_name))
 
     def check_failures(self):
-        """Check if failures have crossed the threshold and ban job from resources."""
+        """Check if failures tracked since the last check have crossed the
+        threshold and ban job from resources."""
         with self.ban_lock:
             banned_changed = False
-            for img in self.failures.keys():
-                for cq in self.failures[img]:
-                    if cq.min_use() and cq.dist_false() == config.ban_failrate_threshold:
-                        # add this img / cluster entry to banned jobs
-                        if img in self.banned_job_resource.keys():
-                            if cq.name not in self.banned_job_resource[img]:
-                                self.banned_job_resource[img].append(cq.name)
-                                banned_changed = True
-                        else:
-                            self.banned_job_resource[img] = []
-                            self.banned_job_resource[img].append(cq.name)
-                            banned_changed = True
+            changed, self.failures_changed = self.failures_changed, set()
+            for img, cluster_name in changed:
+                cq = self.failures[img][cluster_name]
+                if cq.min_use() and cq.dist_false() == config.ban_failrate_threshold:
+                    # add this img / cluster entry to banned jobs
+                    banned = self.banned_job_resource.setdefault(img, [])
+                    if cluster_name not in banned:
+                        banned.append(cluster_name)
+                        banned_changed = True
             if banned_changed:
+                self.clear_fit_memo()
                 self.save_banned_job_resource()
                 log.verbose("Updating Banned job file")
 
@@ -1365,6 +2032,8 @@ class ResourcePool:
                       (config.ban_file, e.strerror))
         except:
             log.exception("Unknown problem saving ban file!")
+        if self.state_store != None:
+            self.state_store.save_bans(self.banned_job_resource)
 
     def load_banned_job_resource(self):
         """
@@ -1396,26 +2065,21 @@ class ResourcePool:
             if len(updated_ban) == 0:
                 for img in self.banned_job_resource.keys():
                     for res in self.banned_job_resource[img]:
-                        foundit = False
-                        for cl in self.failures[img]:
-                            if cl.name == res:
-                                foundit = True
-                                cl.clear()
-                            if foundit:
-                                break
+                        cl = self.failures.get(img, {}).get(res)
+                        if cl != None:
+                            cl.clear()
             else:
                 for img in updated_ban.keys():
                     if img in self.banned_job_resource.keys():
                         diff = set(self.banned_job_resource[img]) - set(updated_ban[img])
                         for res in diff:
-                            foundit = False
-                            for cl in self.failures[img]:
-                                if cl.name == res:
-                                    foundit = True
-                                    cl.clear()
-                                if foundit:
-                                    break
+                            cl = self.failures.get(img, {}).get(res)
+                            if cl != None:
+                                cl.clear()
             self.banned_job_resource = updated_ban
+            self.clear_fit_memo()
+            if self.state_store != None:
+                self.state_store.save_bans(self.banned_job_resource)
 
     def load_user_limits(self, path=None):
             limit_file = None
@@ -1547,111 +2211,53 @@ class ResourcePool:
 
     def find_vm_with_name(self, condor_name):
         """Find a VM in cloudscheduler with the given condor machine name(hostname)."""
-        foundIt = False
-        vm_match = None
         if len(condor_name.split('@')) > 1:
             condor_name = condor_name.split('@')[1]
-        for cluster in self.resources:
-            for vm in cluster.vms:
-                if vm.condorname == condor_name:
-                    foundIt = True
-                    vm_match = vm
-                    break
-            if foundIt:
-                break
-        if not foundIt:
+        vm_match = self.vm_registry.find_one('condorname', condor_name)
+        if vm_match == None:
             log.verbose("Could not find a VM with name: %s" % condor_name)
         return vm_match
 
     def find_cluster_with_vm(self, condor_name):
         """Find which cluster holds a VM with the given condor machine name(hostname)."""
-        foundIt = False
         cluster_match = None
-        vm_match = None
-        for cluster in self.resources:
-            for vm in cluster.vms:
-                if vm.condorname == condor_name:
-                    foundIt = True
-                    cluster_match = cluster
-                    vm_match = vm
-                    break
-            if foundIt:
-                break
+        vm_match = self.vm_registry.find_one('condorname', condor_name)
+        if vm_match != None:
+            cluster_match = self.vm_registry.cluster_of(vm_match)
         return (cluster_match, vm_match)
 
     def find_vm_with_addr(self, condor_addr):
         """Find a VM with the given condor address."""
-        foundIt = False
-        vm_match = None
-        for cluster in self.resources:
-            for vm in cluster.vms:
-                if vm.condoraddr == condor_addr:
-                    foundIt = True
-                    vm_match = vm
-                    break
-            if foundIt:
-                break
-        return vm_match
+        return self.vm_registry.find_one('condoraddr', condor_addr)
 
     def retiring_vms_of_type(self, vmtype):
         """Get a list of the VMs in the Retiring state of the given type."""
-        retiring = []
-        for cluster in self.resources:
-            for vm in cluster.vms:
-                if vm.vmtype == vmtype:
-                    if vm.override_status == 'Retiring':
-                        retiring.append(vm)
-        return retiring
+        return self.vm_registry.find('vmtype_override', vmtype, 'Retiring')
 
     def retiring_vms_of_usertype(self, vmtype):
         """Get a list of the VMs in the Retiring state of the given usertype."""
-        retiring = []
-        for cluster in self.resources:
-            for vm in cluster.vms:
-                if vm.uservmtype == vmtype:
-                    if vm.override_status == 'Retiring':
-                        retiring.append(vm)
-        return retiring
+        return self.vm_registry.find('uservmtype_override', vmtype, 'Retiring')
 
     def get_starting_of_type(self, vmtype):
         """Get a list of the VMs in the Starting state of the given type."""
-        starting = []
-        for cluster in self.resources:
-            for vm in cluster.vms:
-                if vm.vmtype == vmtype:
-                    if vm.status == "Starting" or vm.status == "Unpropagated":
-                        starting.append(vm)
-        return starting
+        return self.vm_registry.find('vmtype_status', vmtype, "Starting") + \
+               self.vm_registry.find('vmtype_status', vmtype, "Unpropagated")
     
     def get_num_starting_vms(self):
         """Count the number of starting state VMs."""
-        num_starting = 0
-        for cluster in self.resources:
-            for vm in cluster.vms:
-                if vm.status == "Starting" or vm.status == "Unpropagated":
-                    num_starting += 1
+        num_starting = self.vm_registry.count('status', "Starting") + \
+                       self.vm_registry.count('status', "Unpropagated")
         log.verbose("There are %i Starting VMs, the max_starting_vm is %i." % (num_starting, config.max_starting_vm))
         return num_starting
 
     def get_starting_of_usertype(self, vmtype):
         """Get a list of the VMs in the Starting state of the given usertype."""
-        starting = []
-        for cluster in self.resources:
-            for vm in cluster.vms:
-                if vm.uservmtype == vmtype:
-                    if vm.status == "Starting" or vm.status == "Unpropagated":
-                        starting.append(vm)
-        return starting
+        return self.vm_registry.find('uservmtype_status', vmtype, "Starting") + \
+               self.vm_registry.find('uservmtype_status', vmtype, "Unpropagated")
 
     def get_error_of_usertype(self, vmtype):
         """Get a list of the VMs in the Error state of the given usertype."""
-        error = []
-        for cluster in self.resources:
-            for vm in cluster.vms:
-                if vm.uservmtype == vmtype:
-                    if vm.status == "Error":
-                        error.append(vm)
-        return error
+        return self.vm_registry.find('uservmtype_status', vmtype, "Error")
     def get_all_vms(self):
         """Returns a list of all the VMs in the system."""
         all_vms = []
@@ -1662,12 +2268,7 @@ class ResourcePool:
 
     def get_user_vms(self, user):
         """Returns a list of all VMs of a user."""
-        user_vms = []
-        for cluster in self.resources:
-            for vm in cluster.vms:
-                if vm.user == user:
-                    user_vms.append(vm)
-        return user_vms
+        return self.vm_registry.find('user', user)
 
     def get_cloud_config_output(self):
         """Build up a string of the cloudscheduler configuration values."""
@@ -1848,59 +2449,20 @@ class ResourcePool:
     def uservmtype_at_limit(self, uservmtype, limit):
         """Check if a vmusertype has met it's limit."""
         atLimit = False
-        counts = self.get_vmtypes_count_internal()
-        if limit != -1 and uservmtype in counts.keys() and not (counts[uservmtype] < limit):
+        count = self.vm_registry.count('uservmtype', uservmtype)
+        if limit != -1 and count > 0 and not (count < limit):
             atLimit = True
         return atLimit
 
-    def machinelist_to_vmmachinelist(self, machinelist, master_machinelist):
-        vm_machine_list = []
+    @staticmethod
+    def machinelist_to_vmmachinelist(machinelist, master_machinelist):
         master_machine_ips = {}
         for master in master_machinelist:
             try:
                 master_machine_ips[master['Machine']] = master['MasterIpAddr']
             except:
                 log.warning('could not read master ip addr')
-        for machine in machinelist:
-            try:
-                name = machine_name = job_id = global_job_id = address_startd = \
-                     address_master = state = activity = vmtype = start_req = \
-                     remote_owner = ""
-                current_time = entered_state_time = -1
-                if machine.has_key('Name'):
-                    name = machine['Name']
-                if machine.has_key('Machine'):
-                    machine_name = machine['Machine']
-                if machine.has_key('JobId'):
-                    job_id = machine['JobId']
-                if machine.has_key('GlobalJobId'):
-                    global_job_id = machine['GlobalJobId']
-                if machine.has_key('MyAddress'):
-                    address_startd = machine['MyAddress']
-                if machine.has_key('State'):
-                    state = machine['State']
-                if machine.has_key('Activity'):
-                    activity = machine['Activity']
-                if machine.has_key('VMType'):
-                    vmtype = machine['VMType']
-                if machine.has_key('MyCurrentTime'):
-                    current_time = machine['MyCurrentTime']
-                if machine.has_key('EnteredCurrentState'):
-                    entered_state_time = machine['EnteredCurrentState']
-                if machine.has_key('Start'):
-                    start_req = machine['Start']
-                if machine.has_key('RemoteOwner'):
-                    remote_owner = machine['RemoteOwner']
-                if master_machine_ips.has_key(machine['Machine']):
-                    address_master = master_machine_ips[machine['Machine']]
-                vmmachine = VMMachine(name=name, machine_name=machine_name, job_id=job_id, global_job_id=global_job_id,
-                 address_startd=address_startd, address_master=address_master, state=state, activity=activity,
-                 vmtype=vmtype, current_time=current_time, entered_state_time=entered_state_time,
-                 start_req=start_req, remote_owner=remote_owner)
-                vm_machine_list.append(vmmachine)
-            except:
-                log.warning("Failed to create VMMachine Obj")
-        return vm_machine_list
+        return list(ResourcePool._classads_to_vmmachines(machinelist, master_machine_ips))
 
 class VMDestroyCmd(threading.Thread):
     """
@@ -1922,7 +2484,7 @@ class VMDestroyCmd(threading.Thread):
     def get_vm(self):
         return self.vm
 
-class VMMachine():
+class VMMachine(object):
     """
     VMMachine - abstraction class to hold information about machines registered with the batch queue
     
@@ -1941,6 +2503,22 @@ class VMMachine():
     remote_owner - the user running jobs on the machine
     """
 
+    # The condor_status startd attribute each VMMachine attribute is read from
+    CONDOR_ATTRIBUTES = {'name': 'Name', 'machine_name': 'Machine',
+                         'job_id': 'JobId', 'global_job_id': 'GlobalJobId',
+                         'address_startd': 'MyAddress', 'state': 'State',
+                         'activity': 'Activity', 'vmtype': 'VMType',
+                         'current_time': 'MyCurrentTime',
+                         'entered_state_time': 'EnteredCurrentState',
+                         'start_req': 'Start', 'remote_owner': 'RemoteOwner'}
+    # The condor_status -master attributes used to find a machine's master
+    MASTER_ATTRIBUTES = ('Machine', 'MasterIpAddr')
+
+    __slots__ = ('name', 'machine_name', 'job_id', 'global_job_id',
+                 'address_startd', 'address_master', 'state', 'activity',
+                 'vmtype', 'current_time', 'entered_state_time', 'start_req',
+                 'remote_owner')
+
     def __init__(self, name="", machine_name="", job_id="", global_job_id="",
                  address_startd="", address_master="", state="", activity="",
                  vmtype="", current_time=0, entered_state_time=0, start_req="",
@@ -1951,13 +2529,100 @@ class VMMachine():
         self.global_job_id = global_job_id
         self.address_startd = address_startd
         self.address_master = address_master
-        self.state = state
-        self.activity = activity
-        self.vmtype = vmtype
+        self.state = intern_str(state)
+        self.activity = intern_str(activity)
+        self.vmtype = intern_str(vmtype)
         self.current_time = current_time
         self.entered_state_time = entered_state_time
-        self.start_req = start_req
-        self.remote_owner = remote_owner
+        self.start_req = intern_str(start_req)
+        self.remote_owner = intern_str(remote_owner)
     
     def get_uservmtype(self):
         return ''.join([self.remote_owner, self.vmtype])
+
+
+def _is_ip_address(host):
+    try:
+        socket.inet_aton(host)
+        return True
+    except:
+        return False
+
+class MachineIndex:
+    """
+    MachineIndex - the machines of a condor machine list indexed by
+    normalised host name and by the attributes in INDEXED_ATTRIBUTES, so
+    a VM's hostname can be matched to its machine, and machines found by
+    attribute values, without scanning every slot.
+
+    find() returns the machines whose attributes equal all the given
+    criteria, in list order, looking only at the smallest matching bucket.
+
+    match() applies the rules of utilities.match_host_with_condor_host and
+    match_host_with_condor_host_master: the full host names (less any slotx@)
+    are equal, or the condor name is not an IP address and the first parts
+    of the names are equal. As with a scan of the list, the earliest machine
+    matching either rule is returned.
+    """
+
+    INDEXED_ATTRIBUTES = ('vmtype', 'state', 'activity', 'machine_name')
+
+    def __init__(self, machines):
+        self.machines = machines
+        # attribute -> value -> machines, in list order
+        self.by_attribute = dict((attribute, {}) for attribute in self.INDEXED_ATTRIBUTES)
+        # host without slot -> position of first machine
+        self.by_host = {}
+        # first part of host -> position, when the condor name (with any
+        # slot) is not an IP address, as match_host_with_condor_host checks
+        self.by_short_host = {}
+        # first part of host -> position, when the host (without slot) is
+        # not an IP address, as match_host_with_condor_host_master checks
+        self.by_short_host_master = {}
+        for position, machine in enumerate(machines):
+            for attribute, index in self.by_attribute.iteritems():
+                index.setdefault(getattr(machine, attribute), []).append(machine)
+            name = machine.machine_name
+            host = self._strip_slot(name)
+            short_host = host.split(".")[0]
+            self.by_host.setdefault(host, position)
+            if not _is_ip_address(name):
+                self.by_short_host.setdefault(short_host, position)
+            if not _is_ip_address(host):
+                self.by_short_host_master.setdefault(short_host, position)
+
+    def find(self, criteria):
+        """Return the machines whose attributes equal every key, value pair
+        in the criteria dictionary."""
+        candidates = self.machines
+        for attribute, value in criteria.iteritems():
+            if attribute not in VMMachine.__slots__:
+                return []
+            if attribute in self.by_attribute:
+                bucket = self.by_attribute[attribute].get(value, [])
+                if len(bucket) < len(candidates):
+                    candidates = bucket
+        return [machine for machine in candidates
+                if all(getattr(machine, attribute) == value
+                       for attribute, value in criteria.iteritems())]
+
+    @staticmethod
+    def _strip_slot(name):
+        parts = name.split("@")
+        if len(parts) > 1:
+            return parts[1]
+        return name
+
+    def match(self, hostname, master_only=False):
+        """Return the first machine matching hostname, or None. With
+        master_only only the match_host_with_condor_host_master rules apply."""
+        host = self._strip_slot(hostname)
+        positions = [self.by_host.get(host),
+                     self.by_short_host_master.get(host.split(".")[0])]
+        if not master_only:
+            positions.append(self.by_host.get(hostname))
+            positions.append(self.by_short_host.get(hostname.split(".")[0]))
+        positions = [position for position in positions if position != None]
+        if not positions:
+            return None
+        return self.machines[min(positions)]
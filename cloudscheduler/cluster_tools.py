@@ -35,6 +35,75 @@ from cloudscheduler.utilities import get_cert_expiry_time
 log = utilities.get_cloudscheduler_logger()
 
 
+class VMList(list):
+    """
+    The 'vms' list of a cluster. Behaves as a plain list, and additionally
+    tells the VMRegistry it is attached to (see cloud_management) about VMs
+    added to or removed from it, so the registry's lookup indexes stay
+    current. Pickles as a plain list.
+    """
+
+    def __init__(self, cluster=None, vms=()):
+        list.__init__(self, vms)
+        self.cluster = cluster
+        self.registry = None
+
+    def __reduce__(self):
+        return (list, (list(self),))
+
+    def append(self, vm):
+        list.append(self, vm)
+        if self.registry != None:
+            self.registry.add(vm, self.cluster)
+
+    def insert(self, index, vm):
+        list.insert(self, index, vm)
+        if self.registry != None:
+            self.registry.add(vm, self.cluster)
+
+    def extend(self, vms):
+        vms = list(vms)
+        list.extend(self, vms)
+        if self.registry != None:
+            for vm in vms:
+                self.registry.add(vm, self.cluster)
+
+    def remove(self, vm):
+        list.remove(self, vm)
+        if self.registry != None:
+            self.registry.discard(vm, self.cluster)
+
+    def pop(self, index=-1):
+        vm = list.pop(self, index)
+        if self.registry != None:
+            self.registry.discard(vm, self.cluster)
+        return vm
+
+    def __iadd__(self, vms):
+        self.extend(vms)
+        return self
+
+    def __setitem__(self, index, value):
+        list.__setitem__(self, index, value)
+        self._resync()
+
+    def __delitem__(self, index):
+        list.__delitem__(self, index)
+        self._resync()
+
+    def __setslice__(self, i, j, values):
+        list.__setslice__(self, i, j, values)
+        self._resync()
+
+    def __delslice__(self, i, j):
+        list.__delslice__(self, i, j)
+        self._resync()
+
+    def _resync(self):
+        if self.registry != None:
+            self.registry.attach(self.cluster)
+
+
 class VM:
     """
     A class for storing created VM information. Used to populate Cluster classes
@@ -51,6 +120,10 @@ class VM:
     maps specific cloud software state to these global states.
     """
 
+    # The VMRegistry (cloud_management) indexing this VM, if any. Changes
+    # to the attributes it indexes are routed through it by __setattr__.
+    _registry = None
+
     def __init__(self, name="", id="", vmtype="", user="",
             hostname="", ipaddress="", clusteraddr="", clusterport="",
             cloudtype="", network="public", cpuarch="x86",
@@ -136,6 +209,27 @@ class VM:
         log.verbose("New VM Object - Name: %s, id: %s, host: %s, image: %s, memory: %d" \
           % (name, id, clusteraddr, image, memory))
 
+    def __setattr__(self, name, value):
+        registry = self._registry
+        if registry != None and (registry.journal != None or
+                                 name in registry.watched_attributes):
+            registry.vm_changed(self, name, value)
+        else:
+            self.__dict__[name] = value
+
+    def mark_changed(self):
+        """Tell the registry the VM changed inside one of its attributes,
+        eg. an item was appended to a list, which __setattr__ can't see."""
+        registry = self._registry
+        if registry != None:
+            registry.vm_touched(self)
+
+    def __getstate__(self):
+        """Override to work with pickle module."""
+        state = self.__dict__.copy()
+        state.pop('_registry', None)
+        return state
+
     def log(self):
         """Log the VM to the info level."""
         log.info("VM Name: %s, ID: %s, Type: %s, User: %s, Status: %s on %s" % (self.name, self.id, self.vmtype,  self.user, self.status, self.clusteraddr))
@@ -289,6 +383,9 @@ class ICluster:
     and vm_destroy
     """
 
+    # Default for clusters unpickled from before capacity_version existed
+    capacity_version = 0
+
     def __init__(self, name="Dummy Cluster", host="localhost",
                  cloud_type="Dummy", memory=[], max_vm_mem= -1, cpu_archs=[], networks=[],
                  vm_slots=0, cpu_cores=0, storage=0, hypervisor='xen', boot_timeout=None):
@@ -305,10 +402,13 @@ class ICluster:
         self.cpu_cores = cpu_cores
         self.storageGB = storage
         self.max_storageGB = storage
-        self.vms = [] # List of running VMs
+        self.vms = VMList(self) # List of running VMs
         self.vms_lock = threading.RLock()
         self.res_lock = threading.RLock()
         self.enabled = True
+        # Bumped whenever available capacity changes, so memoised fit
+        # queries (ResourcePool.get_fitting_resources) know to recheck
+        self.capacity_version = 0
         self.hypervisor = hypervisor
         self.boot_timeout = int(boot_timeout) if boot_timeout != None else config.vm_start_running_timeout
         self.connection_fail_disable_time = config.connection_fail_disable_time
@@ -498,6 +598,7 @@ class ICluster:
             self.vm_slots = remaining_vm_slots
             self.storageGB = remaining_storage
             self.memory[vm.mementry] = remaining_memory
+            self.capacity_version += 1
 
     def resource_return(self, vm):
         """Returns the resources taken by the passed in VM to the Cluster's internal
@@ -507,6 +608,7 @@ class ICluster:
         """
         log.debug("Returning resources used by VM %s to Cluster %s" % (vm.id, self.name))
         with self.res_lock:
+            self.capacity_version += 1
             self.vm_slots += 1
             self.storageGB += vm.storage
             # ISSUE: No way to know what mementry a VM is running on
@@ -21,6 +21,10 @@ condor_webservice_url = "http://localhost:8080"
 condor_collector_url = "http://localhost:9618"
 condor_retrieval_method = "soap"
 condor_q_command = "condor_q -l"
+condor_q_incremental = False
+condor_query_projection = False
+condor_schedds = []
+condor_q_timeout = 600
 condor_status_command = "condor_status -l"
 condor_status_master_command = "condor_status -master -l"
 condor_off_command = "/usr/sbin/condor_off"
@@ -45,6 +49,7 @@ info_server_port = 8111
 admin_server_port = 8112
 workspace_path = "workspace"
 persistence_file = "/var/lib/cloudscheduler.persistence"
+state_store_file = None
 user_limit_file = None
 job_ban_timeout = 60*60 # 1 hour default
 ban_tracking = False
@@ -57,6 +62,7 @@ graceful_shutdown = False
 graceful_shutdown_method = "off"
 retire_before_lifetime = False
 retire_before_lifetime_factor = 1.5
+retire_before_lifetime_percentile = 0
 retire_missing_vms = False
 clean_shutdown_idle = False
 getclouds = False
@@ -123,6 +129,10 @@ def setup(path=None):
     global condor_collector_url
     global condor_retrieval_method
     global condor_q_command
+    global condor_q_incremental
+    global condor_query_projection
+    global condor_schedds
+    global condor_q_timeout
     global condor_status_command
     global condor_status_master_command
     global condor_off_command
@@ -147,6 +157,7 @@ def setup(path=None):
     global admin_server_port
     global workspace_path
     global persistence_file
+    global state_store_file
     global user_limit_file
     global job_ban_timeout
     global ban_tracking
@@ -159,6 +170,7 @@ def setup(path=None):
     global graceful_shutdown_method
     global retire_before_lifetime
     global retire_before_lifetime_factor
+    global retire_before_lifetime_percentile
     global retire_missing_vms
     global clean_shutdown_idle
     global getclouds
@@ -253,6 +265,33 @@ def setup(path=None):
         condor_q_command = config_file.get("global",
                                                 "condor_q_command")
 
+    if config_file.has_option("global", "condor_q_incremental"):
+        try:
+            condor_q_incremental = config_file.getboolean("global", "condor_q_incremental")
+        except ValueError:
+            print "Configuration file problem: condor_q_incremental must be a" \
+                  " Boolean value."
+            sys.exit(1)
+
+    if config_file.has_option("global", "condor_query_projection"):
+        try:
+            condor_query_projection = config_file.getboolean("global", "condor_query_projection")
+        except ValueError:
+            print "Configuration file problem: condor_query_projection must be a" \
+                  " Boolean value."
+            sys.exit(1)
+
+    if config_file.has_option("global", "condor_schedds"):
+        condor_schedds = utilities.splitnstrip(',', config_file.get("global", "condor_schedds"))
+
+    if config_file.has_option("global", "condor_q_timeout"):
+        try:
+            condor_q_timeout = config_file.getint("global", "condor_q_timeout")
+        except ValueError:
+            print "Configuration file problem: condor_q_timeout must be an " \
+                  "integer value."
+            sys.exit(1)
+
     if config_file.has_option("global", "condor_off_command"):
         condor_off_command = config_file.get("global",
                                                 "condor_off_command")
@@ -354,6 +393,9 @@ def setup(path=None):
     if config_file.has_option("global", "persistence_file"):
         persistence_file = config_file.get("global", "persistence_file")
 
+    if config_file.has_option("global", "state_store_file"):
+        state_store_file = config_file.get("global", "state_store_file")
+
     if config_file.has_option("global", "user_limit_file"):
         user_limit_file = config_file.get("global", "user_limit_file")
 
@@ -441,6 +483,17 @@ def setup(path=None):
                   "float value."
             sys.exit(1)
 
+    if config_file.has_option("global", "retire_before_lifetime_percentile"):
+        try:
+            retire_before_lifetime_percentile = config_file.getint("global", "retire_before_lifetime_percentile")
+            if retire_before_lifetime_percentile < 0 or retire_before_lifetime_percentile > 100:
+                print "Please use an integer value [0, 100] for the retire_before_lifetime_percentile"
+                sys.exit(1)
+        except ValueError:
+            print "Configuration file problem: retire_before_lifetime_percentile must be an " \
+                  "integer value."
+            sys.exit(1)
+
     if config_file.has_option("global", "retire_missing_vms"):
         try:
             retire_missing_vms = config_file.getboolean("global", "retire_missing_vms")
@@ -239,50 +239,12 @@ class InfoServer(threading.Thread,):
                 return ''.join(output)
             def get_diff_types(self):
                 output = []
-                current_types = cloud_resources.vmtype_distribution()
-                desired_types = job_pool.job_type_distribution()
-                # Negative difference means will need to create that type
-                diff_types = {}
-                for vmtype in current_types.keys():
-                    if vmtype in desired_types.keys():
-                        diff_types[vmtype] = current_types[vmtype] - desired_types[vmtype]
-                    else:
-                        diff_types[vmtype] = 1 # changed from 0 to handle users with multiple job types, back to 0 from 1.
-                for vmtype in desired_types.keys():
-                    if vmtype not in current_types.keys():
-                        diff_types[vmtype] = -desired_types[vmtype]
-        
-                # With user limiting will need to reset any users that are at their limits
-                # so they will not interfere with scheduling
-                # will need to redistribute negatives to the non-limited users
-                limited_users = []
-                userjoblimits = job_pool.get_usertype_limits()
-                for vmusertype in diff_types.keys():
-                    user = vmusertype.split(':')[0]
-                    if cloud_resources.user_at_limit(user):
-                        if vmusertype not in limited_users:
-                            limited_users.append(vmusertype)
-                    if vmusertype in userjoblimits.keys():
-                        if cloud_resources.uservmtype_at_limit(vmusertype, userjoblimits[vmusertype]):
-                            if vmusertype not in limited_users:
-                                limited_users.append(vmusertype)
-                neg_total = 0
-                for usertype in limited_users:
-                    if diff_types[usertype] < 0:
-                        neg_total += diff_types[usertype]
-                splitby = len(diff_types) - len(limited_users)
-                adjustby = 0
-                if splitby > 0:
-                    adjustby = neg_total / splitby
-                elif splitby == 0:
-                    log.verbose("All users are limited.")
-                else:
-                    log.error("More user vmtypes limited than what's in diff types, something weird here.")
-        
-                for usertype in diff_types.keys():
-                    if usertype not in limited_users:
-                        diff_types[usertype] += adjustby # the 'extra' will be negative so add it
-                        
+                # The scheduler's latest snapshot, rather than recomputing here
+                fair_share = cloud_resources.get_fair_share(job_pool)
+                current_types = fair_share.current_types
+                desired_types = fair_share.desired_types
+                diff_types = fair_share.diff_types
+
                 #for type in current_types.keys():
                     #if type in desired_types.keys():
                         #diff_types[type] = current_types[type] - desired_types[type]
@@ -291,6 +253,7 @@ class InfoServer(threading.Thread,):
                 #for type in desired_types.keys():
                     #if type not in current_types.keys():
                         #diff_types[type] = -desired_types[type]
+                output.append("Fair share generation %d\n" % fair_share.generation)
                 output.append("Diff Types dictionary\n")
                 for key, value in diff_types.iteritems():
                     output.append("type: %s, dist: %f\n" % (key, value))
@@ -321,6 +284,15 @@ class InfoServer(threading.Thread,):
                 else:
                     output.append("Cluster named %s not found." % cluster_name)
                 return ''.join(output)
+            def get_job_container_lock_stats(self):
+                output = []
+                output.append("Job Container Lock Stats (seconds)\n")
+                stats = job_pool.job_container.get_lock_stats()
+                for side in ('read', 'write'):
+                    output.append("%s: acquisitions %d, wait %f, hold %f, max hold %f\n" %
+                                  (side, stats[side]['acquisitions'], stats[side]['wait_time'],
+                                   stats[side]['hold_time'], stats[side]['max_hold_time']))
+                return ''.join(output)
             def check_shared_objs(self):
                 output = []
                 output.append("Scheduler Thread:\n" + scheduler.check_shared_objs())
@@ -334,6 +306,15 @@ class InfoServer(threading.Thread,):
                 output.append("MachinePoller Thread:\n" + machine_poller.check_shared_objs())
                 output.append("\n")
                 return ''.join(output)
+            def get_failure_history(self, image=""):
+                if cloud_resources.state_store == None:
+                    return "No state store configured, set state_store_file to keep a boot failure history."
+                output = []
+                output.append("%-50s %-20s %8s %8s %s\n" % ("Image", "Cloud", "Attempts", "Failures", "Last Attempt"))
+                for row_image, cluster_name, attempts, failures, last in cloud_resources.state_store.failure_history(image):
+                    output.append("%-50s %-20s %8d %8d %s\n" % (row_image, cluster_name, attempts, failures,
+                                                               time.ctime(last)))
+                return ''.join(output)
             def get_vm_stats(self, cluster_name=""):
                 vms = []
                 if cluster_name:
@@ -400,7 +381,7 @@ class VMJSONEncoder(json.JSONEncoder):
                 'myproxy_renew_time': vm.myproxy_renew_time, 'override_status': vm.override_status,
                 'job_per_core': vm.job_per_core, 'force_retire': vm.force_retire,
                 'failed_retire': vm.failed_retire, 'x509userproxy_expiry_time': vm.x509userproxy_expiry_time,
-                'job_run_times': vm.job_run_times.data}
+                'job_run_times': vm.job_run_times.get()}
 
 class ClusterJSONEncoder(json.JSONEncoder):
     def default(self, cluster):
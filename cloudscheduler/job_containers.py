@@ -1,9 +1,10 @@
 from abc import ABCMeta, abstractmethod
 from collections import defaultdict
+import bisect
 import time
-import threading
 import logging
 import cloudscheduler.config as config
+from cloudscheduler.utilities import ReadWriteLock
 
 # Use this global variable for logging.
 log = None
@@ -17,12 +18,19 @@ log = None
 class JobContainer():
     __metclass__ = ABCMeta
 
-    # Use this lock if you require to threadsafe an operation.
+    # Use this lock if you require to threadsafe an operation. It is the
+    # write side of rwlock; methods that only read take read_lock instead,
+    # so readers don't block each other. Never take lock while holding
+    # read_lock.
     lock = None
+    read_lock = None
+    rwlock = None
     ## Condor Job Status mapping
     job_status_list = ['NEW', 'IDLE', 'RUNNING', 'REMOVED', 'COMPLETE', 'HELD', 'ERROR']
     def __init__(self):
-        self.lock = threading.RLock()
+        self.rwlock = ReadWriteLock()
+        self.lock = self.rwlock.write
+        self.read_lock = self.rwlock.read
         global log
         log = logging.getLogger("cloudscheduler")
         pass
@@ -82,11 +90,51 @@ class JobContainer():
     def remove_all_not_in(self, jobs_to_keep):
         pass
 
+    # Remove all jobs in the container whose id does not appear in a given
+    # set of job ids.
+    # Returns a list of the removed jobs.
+    @abstractmethod
+    def remove_all_not_in_ids(self, jobids_to_keep):
+        pass
+
+    # Apply the result of a job query in one locked batch: remove the jobs
+    # with the given ids, add the given new jobs, then update the status of
+    # known jobs from a dictionary of
+    # jobid -> (status, remote, servertime, starttime, priority).
+    # Returns a list of the removed jobs.
+    @abstractmethod
+    def apply_job_updates(self, new_jobs, status_updates, removed_jobids):
+        pass
+
+    # Bans a job from being scheduled until config.job_ban_timeout passes;
+    # reason is shown as the job's override_status.
+    # Returns True if the job was found in the container, False otherwise.
+    @abstractmethod
+    def ban_job(self, jobid, reason):
+        pass
+
+    # Returns a dictionary of req_vmtype -> number of jobs needing it, counting
+    # jobs that are not banned and are running or waiting to run.
+    @abstractmethod
+    def get_required_vmtypes_dict(self):
+        pass
+
+    # Same as get_required_vmtypes_dict, keyed by uservmtype.
+    @abstractmethod
+    def get_required_uservmtypes_dict(self):
+        pass
+
+    # Returns a dictionary of uservmtype -> VMTypeLimit, for the usertypes
+    # with jobs that set a limit.
+    @abstractmethod
+    def get_usertype_limits(self):
+        pass
+
     # Updates the status and remote host of a job (job.job_status attribute) 
-    # in the container.
+    # in the container, and its priority if one is given.
     # Returns True if the job was found in the container, False otherwise.
     @abstractmethod
-    def update_job_status(self, jobid, status, remote):
+    def update_job_status(self, jobid, status, remote, servertime, starttime, priority=None):
         pass
 
     # Mark a job as being scheduled.
@@ -116,6 +164,11 @@ class JobContainer():
     def get_all_jobs(self):
         pass
 
+    # Returns a set of the ids of all jobs in the container.
+    @abstractmethod
+    def get_job_ids(self):
+        pass
+
     # Get a job by job id.
     # Return the job with the given job id, or None if the job does not exist in the container.
     @abstractmethod
@@ -171,10 +224,20 @@ class JobContainer():
     # (user, [list of unscheduled jobs])
     # If a user does not have any unscheduled jobs, then there will be no entry for that user.
     # If prioritized is True, then the returned lists of jobs will be sorted by job.priority, high to low.
+    # A container may return the lists sorted even if prioritized is False.
     @abstractmethod
     def get_unscheduled_jobs_by_users(self, prioritized=False):
         pass
 
+    # Get a list of all unscheduled jobs per user and VM type.
+    # Returns dictionary where the items are:
+    # ("user:vmtype", [list of unscheduled jobs])
+    # If prioritized is True, then the returned lists of jobs will be sorted by job.priority, high to low.
+    # A container may return the lists sorted even if prioritized is False.
+    @abstractmethod
+    def get_unscheduled_jobs_by_usertype(self, prioritized=False):
+        pass
+
     # Get a list of all unscheduled jobs per type.
     # Returns dictionary where the items are:
     # {type, [list of unscheduled jobs]}
@@ -198,12 +261,18 @@ class JobContainer():
     def get_high_priority_jobs_by_users(self, prioritized=False):
         pass
 
-    # Finds up to N jobs matching the requirements of the given job.
+    # Finds up to N jobs matching the requirements of the given job
+    # (see Job.has_same_reqs), in priority order, high to low.
     # If N == 0, then all matching jobs are returned.
     @abstractmethod
     def find_unscheduled_jobs_with_matching_reqs(self, user, job, N=0):
         pass
 
+    # Returns how long the container's read and write locks have been waited
+    # for and held; see utilities.ReadWriteLock.get_stats.
+    def get_lock_stats(self):
+        return self.rwlock.get_stats()
+
     # Returns True if the container has no jobs, returns False otherwise.
     @abstractmethod
     def is_empty(self):
@@ -223,6 +292,73 @@ class JobContainer():
 
 
 
+#
+# A set of jobs kept in priority order, high to low and first added first
+# within a priority, so prioritized lists can be read without sorting.
+# Jobs are filed under (-priority, sequence, job) keys in a bisect-maintained
+# list; the key a job was filed under is remembered, so it can still be
+# found after its priority changes. Removed keys are left in the list as
+# stale entries (deleting from the middle of a large list is O(n)) and are
+# dropped in one pass once they make up half of it.
+#
+class PriorityOrderedJobs():
+    keys = None
+    keys_by_id = None
+    stale_keys = 0
+
+    def __init__(self):
+        self.keys = []
+        self.keys_by_id = {}
+        self.stale_keys = 0
+
+    def __len__(self):
+        return len(self.keys_by_id)
+
+    def __contains__(self, jobid):
+        return jobid in self.keys_by_id
+
+    def add(self, job, sequence):
+        key = (-job.get_priority(), sequence, job)
+        bisect.insort(self.keys, key)
+        self.keys_by_id[job.id] = key
+
+    # Returns the sequence number the job was added with, or None.
+    def remove(self, job):
+        key = self.keys_by_id.pop(job.id, None)
+        if key == None:
+            return None
+        self.stale_keys += 1
+        if self.stale_keys * 2 > len(self.keys):
+            self.keys = [k for k in self.keys if self._is_current(k)]
+            self.stale_keys = 0
+        return key[1]
+
+    def _is_current(self, key):
+        return self.keys_by_id.get(key[2].id) is key
+
+    # Re-file a job under its current priority, keeping its place among
+    # jobs of equal priority.
+    def reposition(self, job):
+        sequence = self.remove(job)
+        if sequence != None:
+            self.add(job, sequence)
+
+    def head(self):
+        for key in self.keys:
+            if self._is_current(key):
+                return key[2]
+        return None
+
+    def values(self):
+        if self.stale_keys == 0:
+            return [key[2] for key in self.keys]
+        return [key[2] for key in self.keys if self._is_current(key)]
+
+    def itervalues(self):
+        for key in self.keys:
+            if self._is_current(key):
+                yield key[2]
+
 #
 # This class implements a job container based on hash tables.
 #
@@ -233,6 +369,35 @@ class HashTableJobContainer(JobContainer):
     sched_jobs = None
     jobs_by_user = None
 
+    # Secondary indexes, kept up to date as jobs are added, removed,
+    # (un)scheduled and change condor status, so the getters below never
+    # have to scan all jobs. Each maps a key to a {job.id: job} dict, except
+    # new_jobs_by_user and new_jobs_by_usertype, which map to a
+    # PriorityOrderedJobs so the scheduler's prioritized reads need no sort.
+    # new_jobs_by_reqs is keyed by job.reqs_signature and ordered the same
+    # way, for find_unscheduled_jobs_with_matching_reqs.
+    new_jobs_by_user = None
+    new_jobs_by_type = None
+    new_jobs_by_usertype = None
+    new_jobs_by_reqs = None
+    sched_jobs_by_user = None
+    sched_jobs_by_type = None
+    sched_jobs_by_usertype = None
+    jobs_by_status = None
+    high_jobs = None
+    new_high_jobs = None
+    # Order of arrival, to break priority ties, and jobs whose priority
+    # changed since the ordered indexes were last read.
+    job_sequence = None
+    next_sequence = 0
+    reprioritized_jobs = None
+    # Counts of jobs needing each req_vmtype and uservmtype (see
+    # _is_required), and per uservmtype counts of jobs by VMTypeLimit,
+    # so the JobPool's required type and limit queries need no job scan.
+    required_vmtypes = None
+    required_uservmtypes = None
+    usertype_limit_counts = None
+
     # constructor
     def __init__(self):
         JobContainer.__init__(self)
@@ -240,32 +405,161 @@ class HashTableJobContainer(JobContainer):
         self.new_jobs = {}
         self.sched_jobs = {}
         self.jobs_by_user = defaultdict(dict)
+        self.new_jobs_by_user = defaultdict(PriorityOrderedJobs)
+        self.new_jobs_by_type = defaultdict(dict)
+        self.new_jobs_by_usertype = defaultdict(PriorityOrderedJobs)
+        self.new_jobs_by_reqs = defaultdict(PriorityOrderedJobs)
+        self.sched_jobs_by_user = defaultdict(dict)
+        self.sched_jobs_by_type = defaultdict(dict)
+        self.sched_jobs_by_usertype = defaultdict(dict)
+        self.jobs_by_status = defaultdict(dict)
+        self.high_jobs = {}
+        self.new_high_jobs = {}
+        self.job_sequence = {}
+        self.reprioritized_jobs = {}
+        self.required_vmtypes = defaultdict(int)
+        self.required_uservmtypes = defaultdict(int)
+        self.usertype_limit_counts = defaultdict(lambda: defaultdict(int))
         log.verbose('HashTableJobContainer instance created.')
 
     # methods
     def __str__(self):
         return 'HashTableJobContainer [# of jobs: %d (unshed: %d sched: %d)]' % (len(self.all_jobs), len(self.new_jobs), len(self.sched_jobs))
 
+    # Index helpers. Callers must hold self.lock.
+    @staticmethod
+    def _index_add(index, key, job):
+        index[key][job.id] = job
+
+    @staticmethod
+    def _index_remove(index, key, job):
+        bucket = index.get(key)
+        if bucket != None and job.id in bucket:
+            del bucket[job.id]
+            if len(bucket) == 0:
+                del index[key]
+
+    @staticmethod
+    def _count_add(counts, key, delta):
+        counts[key] += delta
+        if counts[key] <= 0:
+            del counts[key]
+
+    @staticmethod
+    def _is_required(job):
+        RUNNING = 2
+        return job.job_status <= RUNNING and not job.banned
+
+    def _count_required(self, job, delta):
+        self._count_add(self.required_vmtypes, job.req_vmtype, delta)
+        self._count_add(self.required_uservmtypes, job.uservmtype, delta)
+
+    def _count_job(self, job, delta):
+        if self._is_required(job):
+            self._count_required(job, delta)
+        if job.usertype_limit > -1:
+            limits = self.usertype_limit_counts[job.uservmtype]
+            self._count_add(limits, job.usertype_limit, delta)
+            if len(limits) == 0:
+                del self.usertype_limit_counts[job.uservmtype]
+
+    def _ordered_index_add(self, index, key, job):
+        index[key].add(job, self.job_sequence[job.id])
+
+    @staticmethod
+    def _ordered_index_remove(index, key, job):
+        bucket = index.get(key)
+        if bucket != None and bucket.remove(job) != None and len(bucket) == 0:
+            del index[key]
+
+    def _reposition_reprioritized_jobs(self):
+        # Catch the ordered indexes up with priority changes seen by
+        # _update_job_status. Writers call this once at the end of a batch
+        # of updates, so readers always see the ordered indexes current.
+        for job in self.reprioritized_jobs.itervalues():
+            if job.id in self.new_jobs:
+                self.new_jobs_by_user[job.user].reposition(job)
+                self.new_jobs_by_usertype[job.uservmtype].reposition(job)
+                self.new_jobs_by_reqs[job.reqs_signature].reposition(job)
+        self.reprioritized_jobs.clear()
+
+    def _ordered_index_lists(self, index):
+        # Copy an ordered index into a dictionary of job lists, already
+        # sorted by job.priority (high to low).
+        return_value = defaultdict(list)
+        for key, bucket in index.iteritems():
+            return_value[key] = bucket.values()
+        return return_value
+
+    @staticmethod
+    def _index_lists(index, prioritized=False):
+        # Copy an index into a dictionary of job lists, sorted by job.priority
+        # (high to low) if prioritized is True.
+        return_value = defaultdict(list)
+        for key, bucket in index.iteritems():
+            return_value[key] = bucket.values()
+        if prioritized:
+            for job_list in return_value.values():
+                job_list.sort(key=lambda job: job.get_priority(), reverse=True)
+        return return_value
+
+    def _index_unscheduled(self, job):
+        self.new_jobs[job.id] = job
+        self._ordered_index_add(self.new_jobs_by_user, job.user, job)
+        self._index_add(self.new_jobs_by_type, job.req_vmtype, job)
+        self._ordered_index_add(self.new_jobs_by_usertype, job.uservmtype, job)
+        self._ordered_index_add(self.new_jobs_by_reqs, job.reqs_signature, job)
+        if job.high_priority:
+            self.new_high_jobs[job.id] = job
+
+    def _unindex_unscheduled(self, job):
+        self.new_jobs.pop(job.id, None)
+        self._ordered_index_remove(self.new_jobs_by_user, job.user, job)
+        self._index_remove(self.new_jobs_by_type, job.req_vmtype, job)
+        self._ordered_index_remove(self.new_jobs_by_usertype, job.uservmtype, job)
+        self._ordered_index_remove(self.new_jobs_by_reqs, job.reqs_signature, job)
+        self.new_high_jobs.pop(job.id, None)
+
+    def _index_scheduled(self, job):
+        self.sched_jobs[job.id] = job
+        self._index_add(self.sched_jobs_by_user, job.user, job)
+        self._index_add(self.sched_jobs_by_type, job.req_vmtype, job)
+        self._index_add(self.sched_jobs_by_usertype, job.uservmtype, job)
+
+    def _unindex_scheduled(self, job):
+        self.sched_jobs.pop(job.id, None)
+        self._index_remove(self.sched_jobs_by_user, job.user, job)
+        self._index_remove(self.sched_jobs_by_type, job.req_vmtype, job)
+        self._index_remove(self.sched_jobs_by_usertype, job.uservmtype, job)
+
     def has_job(self, jobid):
         return self.get_job_by_id(jobid) != None
 
     def add_job(self, job):
         with self.lock:
+            if job.id in self.all_jobs:
+                self.remove_job(self.all_jobs[job.id])
             self.all_jobs[job.id] = job
+            self.job_sequence[job.id] = self.next_sequence
+            self.next_sequence += 1
             self.jobs_by_user[job.user][job.id] = job
+            self._index_add(self.jobs_by_status, job.job_status, job)
+            self._count_job(job, 1)
+            if job.high_priority:
+                self.high_jobs[job.id] = job
 
             # Update scheduled/unscheduled maps too:
             if(job.status == "Unscheduled"):
-                self.new_jobs[job.id] = job
+                self._index_unscheduled(job)
             else:
-                self.sched_jobs[job.id] = job
+                self._index_scheduled(job)
 
             #log.debug('job %s added to job container' % (job.id))
 
-    def add_jobs(self, jobs, add_type):
+    def add_jobs(self, jobs):
         with self.lock:
             for job in jobs:
-                self.add_job(job, add_type)
+                self.add_job(job)
 
     def clear(self):
         with self.lock:
@@ -273,20 +567,38 @@ class HashTableJobContainer(JobContainer):
             self.jobs_by_user.clear()
             self.new_jobs.clear()
             self.sched_jobs.clear()
+            self.new_jobs_by_user.clear()
+            self.new_jobs_by_type.clear()
+            self.new_jobs_by_usertype.clear()
+            self.new_jobs_by_reqs.clear()
+            self.sched_jobs_by_user.clear()
+            self.sched_jobs_by_type.clear()
+            self.sched_jobs_by_usertype.clear()
+            self.jobs_by_status.clear()
+            self.high_jobs.clear()
+            self.new_high_jobs.clear()
+            self.job_sequence.clear()
+            self.reprioritized_jobs.clear()
+            self.required_vmtypes.clear()
+            self.required_uservmtypes.clear()
+            self.usertype_limit_counts.clear()
             log.verbose('job container cleared')
 
     def remove_job(self, job):
         with self.lock:
             if job.id in self.all_jobs:
                 del self.all_jobs[job.id]
+                self._count_job(job, -1)
             if job.user in self.jobs_by_user and (job.id in self.jobs_by_user[job.user]):
                 del self.jobs_by_user[job.user][job.id]
                 if len(self.jobs_by_user[job.user]) == 0:
                     del self.jobs_by_user[job.user]
-            if job.id in self.new_jobs:
-                del self.new_jobs[job.id]
-            if job.id in self.sched_jobs:
-                del self.sched_jobs[job.id]
+            self._index_remove(self.jobs_by_status, job.job_status, job)
+            self.high_jobs.pop(job.id, None)
+            self._unindex_unscheduled(job)
+            self._unindex_scheduled(job)
+            self.job_sequence.pop(job.id, None)
+            self.reprioritized_jobs.pop(job.id, None)
             #log.debug('job %s removed from container' % job.id)
 
     def remove_jobs(self, jobs):
@@ -318,12 +630,40 @@ class HashTableJobContainer(JobContainer):
                     removed_jobs.append(job)
         return removed_jobs
 
+    def remove_all_not_in_ids(self, jobids_to_keep):
+        with self.lock:
+            removed_jobs = []
+            for job in self.all_jobs.values():
+                if job.id not in jobids_to_keep:
+                    self.remove_job(job)
+                    removed_jobs.append(job)
+        return removed_jobs
+
+    def apply_job_updates(self, new_jobs, status_updates, removed_jobids):
+        with self.lock:
+            removed_jobs = []
+            for jobid in removed_jobids:
+                job = self.get_job_by_id(jobid)
+                if job != None:
+                    self.remove_job(job)
+                    removed_jobs.append(job)
+            for job in new_jobs:
+                self.add_job(job)
+            for jobid, (status, remote, servertime, starttime, priority) in status_updates.iteritems():
+                self._update_job_status(jobid, status, remote, servertime, starttime, priority)
+            self._reposition_reprioritized_jobs()
+        return removed_jobs
+
     def get_users(self):
         return self.jobs_by_user.keys()
 
     def get_all_jobs(self):
         return self.all_jobs.values()
 
+    def get_job_ids(self):
+        with self.read_lock:
+            return set(self.all_jobs)
+
     def get_job_by_id(self, jobid):
         try:
             return self.all_jobs[jobid]
@@ -332,38 +672,26 @@ class HashTableJobContainer(JobContainer):
 
     def get_held_jobs(self):
         HELD = 5
-        held_jobs = []
-        for job in self.all_jobs.values():
-            if job.job_status == HELD:
-                held_jobs.append(job)
-        return held_jobs
+        with self.read_lock:
+            return self.jobs_by_status.get(HELD, {}).values()
     
     def get_idle_jobs(self):
         IDLE = 1
-        idle_jobs = []
-        for job in self.all_jobs.values():
-            if job.job_status == IDLE:
-                idle_jobs.append(job)
-        return idle_jobs
+        with self.read_lock:
+            return self.jobs_by_status.get(IDLE, {}).values()
 
     def get_running_jobs(self):
         RUNNING = 2
-        run_jobs = []
-        for job in self.all_jobs.values():
-            if job.job_status == RUNNING:
-                run_jobs.append(job)
-        return run_jobs
+        with self.read_lock:
+            return self.jobs_by_status.get(RUNNING, {}).values()
 
     def get_complete_jobs(self):
         COMPLETE = 4
-        comp_jobs = []
-        for job in self.all_jobs.values():
-            if job.job_status == COMPLETE:
-                comp_jobs.append(job)
-        return comp_jobs
+        with self.read_lock:
+            return self.jobs_by_status.get(COMPLETE, {}).values()
 
     def get_jobs_for_user(self, user, prioritized=False):
-        with self.lock:
+        with self.read_lock:
             if user not in self.jobs_by_user:
                 return []
 
@@ -385,37 +713,16 @@ class HashTableJobContainer(JobContainer):
         return return_value
 
     def get_scheduled_jobs_by_users(self, prioritized=False):
-        with self.lock:
-            return_value = defaultdict(list)
-            for job in self.sched_jobs.values():
-                return_value[job.user].append(job)
-            # Now lets sort if needed.
-            if prioritized:
-                for job_list in return_value.values():
-                    job_list.sort(key=lambda job: job.get_priority(), reverse=True)
-            return return_value
+        with self.read_lock:
+            return self._index_lists(self.sched_jobs_by_user, prioritized)
 
     def get_scheduled_jobs_by_type(self, prioritized=False):
-        with self.lock:
-            return_value = defaultdict(list)
-            for job in self.sched_jobs.values():
-                return_value[job.req_vmtype].append(job)
-            # Now sort if needed.
-            if prioritized:
-                for job_list in return_value.values():
-                    job_list.sort(key=lambda job: job.get_priority(), reverse=True)
-            return return_value
+        with self.read_lock:
+            return self._index_lists(self.sched_jobs_by_type, prioritized)
 
     def get_scheduled_jobs_by_usertype(self, prioritized=False):
-        with self.lock:
-            return_value = defaultdict(list)
-            for job in self.sched_jobs.values():
-                return_value[job.uservmtype].append(job)
-            # Now sort if needed.
-            if prioritized:
-                for job_list in return_value.values():
-                    job_list.sort(key=lambda job: job.get_priority(), reverse=True)
-            return return_value
+        with self.read_lock:
+            return self._index_lists(self.sched_jobs_by_usertype, prioritized)
 
     def get_unscheduled_jobs(self):
         return self.new_jobs.values()
@@ -427,49 +734,27 @@ class HashTableJobContainer(JobContainer):
         return return_value
         
     def get_unscheduled_jobs_by_users(self, prioritized=False):
-        with self.lock:
-            return_value = defaultdict(list)
-            for job in self.new_jobs.values():
-                return_value[job.user].append(job)
-            # Now lets sort if needed.
-            if prioritized:
-                for job_list in return_value.values():
-                    job_list.sort(key=lambda job: job.get_priority(), reverse=True)
-            return return_value
+        # The lists are always in priority order; prioritized is ignored.
+        with self.read_lock:
+            return self._ordered_index_lists(self.new_jobs_by_user)
 
     def get_unscheduled_jobs_by_type(self, prioritized=False):
-        with self.lock:
-            return_value = defaultdict(list)
-            for job in self.new_jobs.values():
-                return_value[job.req_vmtype].append(job)
-            # Now sort if needed.
-            if prioritized:
-                for job_list in return_value.values():
-                    job_list.sort(key=lambda job: job.get_priority(), reverse=True)
-            return return_value
+        with self.read_lock:
+            return self._index_lists(self.new_jobs_by_type, prioritized)
 
     def get_unscheduled_jobs_by_usertype(self, prioritized=False):
-        with self.lock:
-            return_value = defaultdict(list)
-            for job in self.new_jobs.values():
-                return_value[job.uservmtype].append(job)
-            # Now sort if needed.
-            if prioritized:
-                for job_list in return_value.values():
-                    job_list.sort(key=lambda job: job.get_priority(), reverse=True)
-            return return_value
+        # The lists are always in priority order; prioritized is ignored.
+        with self.read_lock:
+            return self._ordered_index_lists(self.new_jobs_by_usertype)
 
     def get_high_priority_jobs(self):
-        jobs = []
-        for job in self.all_jobs.values():
-            if job.high_priority:
-                jobs.append(job)
-        return jobs
+        with self.read_lock:
+            return self.high_jobs.values()
 
     def get_high_priority_jobs_by_users(self, prioritized=False):
-        with self.lock:
+        with self.read_lock:
             return_value = defaultdict(list)
-            for job in self.get_high_priority_jobs():
+            for job in self.high_jobs.itervalues():
                 return_value[job.user].append(job)
             # Now lets sort if needed.
             if prioritized:
@@ -481,16 +766,13 @@ class HashTableJobContainer(JobContainer):
             return return_value
 
     def get_unscheduled_high_priority_jobs(self):
-        jobs = []
-        for job in self.all_jobs.values():
-            if job.high_priority and job.status == 'Unscheduled':
-                jobs.append(job)
-        return jobs
+        with self.read_lock:
+            return self.new_high_jobs.values()
 
     def get_unscheduled_high_priority_jobs_by_users(self, prioritized=False):
-        with self.lock:
+        with self.read_lock:
             return_value = defaultdict(list)
-            for job in self.get_unscheduled_high_priority_jobs():
+            for job in self.new_high_jobs.itervalues():
                 return_value[job.user].append(job)
             # Now lets sort if needed.
             if prioritized:
@@ -504,38 +786,81 @@ class HashTableJobContainer(JobContainer):
     def is_empty(self):
         return len(self.all_jobs) == 0
 
-    def update_job_status(self, jobid, status, remote, servertime, starttime):
+    def update_job_status(self, jobid, status, remote, servertime, starttime, priority=None):
         with self.lock:
-            job = self.get_job_by_id(jobid)
-        if job != None:
-            if job.job_status != status and job.override_status != None:
+            found = self._update_job_status(jobid, status, remote, servertime, starttime, priority)
+            self._reposition_reprioritized_jobs()
+            return found
+
+    def _update_job_status(self, jobid, status, remote, servertime, starttime, priority=None):
+        # Callers must hold self.lock and reposition reprioritized jobs after.
+        job = self.get_job_by_id(jobid)
+        if job == None:
+            return False
+        was_required = self._is_required(job)
+        if job.job_status != status and job.override_status != None:
+            job.override_status = None
+        if job.job_status != status:
+            log.debug("Job %s status change: %s -> %s" % (job.id, self.job_status_list[job.job_status], self.job_status_list[status]))
+            self._index_remove(self.jobs_by_status, job.job_status, job)
+            self._index_add(self.jobs_by_status, status, job)
+        job.job_status = status
+        job.remote_host = remote
+        job.servertime = int(servertime)
+        job.jobstarttime = int(starttime)
+        if priority != None and int(priority) != job.priority:
+            # Ordered indexes are caught up once the batch is done.
+            job.priority = int(priority)
+            self.reprioritized_jobs[job.id] = job
+        if job.banned and job.ban_time:
+            if (time.time() - job.ban_time) > config.job_ban_timeout:
+                job.banned = False
+                job.ban_time = None
                 job.override_status = None
-            if job.job_status != status:
-                log.debug("Job %s status change: %s -> %s" % (job.id, self.job_status_list[job.job_status], self.job_status_list[status]))
-            job.job_status = status
-            job.remote_host = remote
-            job.servertime = int(servertime)
-            job.jobstarttime = int(starttime)
-            if job.banned and job.ban_time:
-                if (time.time() - job.ban_time) > config.job_ban_timeout:
-                    job.banned = False
-                    job.ban_time = None
-                    job.override_status = None
-            if len(job.blocked_clouds) > 0:
-                if (time.time() - job.block_time) > config.job_ban_timeout:
-                    job.blocked_clouds = []
-                    job.block_time = None
+        if len(job.blocked_clouds) > 0:
+            if (time.time() - job.block_time) > config.job_ban_timeout:
+                job.blocked_clouds = []
+                job.block_time = None
+        if was_required != self._is_required(job):
+            self._count_required(job, -1 if was_required else 1)
+        return True
+
+    def ban_job(self, jobid, reason):
+        with self.lock:
+            job = self.get_job_by_id(jobid)
+            if job == None:
+                return False
+            if self._is_required(job):
+                self._count_required(job, -1)
+            job.banned = True
+            job.ban_time = time.time()
+            job.override_status = reason
             return True
-        else:
-            return False
+
+    def get_required_vmtypes_dict(self):
+        with self.read_lock:
+            return defaultdict(int, self.required_vmtypes)
+
+    def get_required_uservmtypes_dict(self):
+        with self.read_lock:
+            return defaultdict(int, self.required_uservmtypes)
+
+    def get_usertype_limits(self):
+        # Jobs of one usertype should all carry the same limit; if they
+        # don't, the lowest one is used.
+        with self.read_lock:
+            limits = {}
+            for uservmtype, limit_counts in self.usertype_limit_counts.iteritems():
+                limits[uservmtype] = min(limit_counts)
+            return limits
 
     def schedule_job(self, jobid):
         with self.lock:
             if jobid in self.new_jobs:
                 job = self.new_jobs[jobid]
+                self._unindex_unscheduled(job)
                 job.set_status("Scheduled")
-                self.sched_jobs[jobid] = job
-                del self.new_jobs[jobid]
+                self._index_scheduled(job)
                 #log.verbose('Job %s marked as scheduled in the job container' % (jobid))
                 return True
             else:
@@ -546,68 +871,60 @@ class HashTableJobContainer(JobContainer):
         with self.lock:
             if jobid in self.sched_jobs:
                 job = self.sched_jobs[jobid]
+                self._unindex_scheduled(job)
                 job.set_status("Unscheduled")
-                self.new_jobs[jobid] = job
-                del self.sched_jobs[jobid]
+                self._index_unscheduled(job)
                 #log.verbose('Job %s marked as unscheduled in the job container' % (jobid))
                 return True
             else:
                 return False
 
     def find_unscheduled_jobs_with_matching_reqs(self, user, job, N=0):
-        with self.lock:
-            counter = 0
-            unscheduled_jobs_for_user = []
-            try:
-                unscheduled_jobs_for_user = self.get_unscheduled_jobs_by_users()[user]
-            except KeyError:
-                # User has no unscheduled jobs.
+        # The signature includes the user, so a job of another user only
+        # matches itself.
+        with self.read_lock:
+            if user != job.user or job.reqs_signature not in self.new_jobs_by_reqs:
+                # User has no unscheduled jobs with these requirements.
                 # Simply return an empty list right away.
                 return []
 
             matching_jobs = []
-            for j in unscheduled_jobs_for_user:
-                if j.has_same_reqs(job):
-                    matching_jobs.append(j)
-                    counter += 1
-                    if counter > 0 and counter == N:
-                        break
+            for j in self.new_jobs_by_reqs[job.reqs_signature].itervalues():
+                matching_jobs.append(j)
+                if len(matching_jobs) == N:
+                    break
 
             return matching_jobs
 
     def get_unscheduled_user_jobs_by_type(self, user, prioritized=False):
-        with self.lock:
-            unsched = self.get_unscheduled_jobs_by_users()
+        # The user's jobs are walked in priority order, so each list is too.
+        with self.read_lock:
             return_value = defaultdict(list)
-            if user in unsched.keys():
-                for job in unsched[user]:
+            if user in self.new_jobs_by_user:
+                for job in self.new_jobs_by_user[user].itervalues():
                     return_value[job.req_vmtype].append(job)
-            # Sort if needed
-            if prioritized:
-                for job_list in return_value.values():
-                    job_list.sort(key=lambda job: job.get_priority(), reverse=True)
         return return_value
 
     def get_unscheduled_user_jobs_by_usertype(self, user, prioritized=False):
-        with self.lock:
-            unsched = self.get_unscheduled_jobs_by_users()
+        with self.read_lock:
             return_value = defaultdict(list)
-            if user in unsched.keys():
-                for job in unsched[user]:
+            if user in self.new_jobs_by_user:
+                for job in self.new_jobs_by_user[user].itervalues():
                     return_value[job.uservmtype].append(job)
-            # Sort if needed
-            if prioritized:
-                for job_list in return_value.values():
-                    job_list.sort(key=lambda job: job.get_priority(), reverse=True)
+        return return_value
+
+    def get_unscheduled_head_jobs_by_users(self):
+        with self.read_lock:
+            return_value = {}
+            for user, bucket in self.new_jobs_by_user.iteritems():
+                return_value[user] = bucket.head()
         return return_value
     
     def get_scheduled_user_jobs_by_type(self, user, prioritized=False):
-        with self.lock:
-            sched = self.get_scheduled_jobs_by_users()
+        with self.read_lock:
             return_value = defaultdict(list)
-            if user in sched.keys():
-                for job in sched[user]:
-                    return_value[job.req_vmtype].append(job)
+            for job in self.sched_jobs_by_user.get(user, {}).itervalues():
+                return_value[job.req_vmtype].append(job)
             # Sort if needed
             if prioritized:
                 for job_list in return_value.values():
@@ -615,14 +932,12 @@ class HashTableJobContainer(JobContainer):
         return return_value
     
     def get_scheduled_user_jobs_by_usertype(self, user, prioritized=False):
-        with self.lock:
-            sched = self.get_scheduled_jobs_by_users()
+        with self.read_lock:
             return_value = defaultdict(list)
-            if user in sched.keys():
-                for job in sched[user]:
-                    return_value[job.req_vmtype].append(job)
+            for job in self.sched_jobs_by_user.get(user, {}).itervalues():
+                return_value[job.req_vmtype].append(job)
             # Sort if needed
             if prioritized:
                 for job_list in return_value.values():
                     job_list.sort(key=lambda job: job.get_priority(), reverse=True)
-        return return_value
\ No newline at end of file
+        return return_value
@@ -28,10 +28,14 @@ from __future__ import with_statement
 import os
 import re
 import sys
+import time
 import shlex
 import string
+import inspect
 import logging
 import datetime
+import Queue
+import tempfile
 import threading
 import subprocess
 from urllib2 import URLError
@@ -52,8 +56,8 @@ import cloudscheduler.config as config
 from cloudscheduler.utilities import determine_path
 from cloudscheduler.utilities import get_cert_expiry_time
 from cloudscheduler.utilities import splitnstrip
+from cloudscheduler.utilities import intern_str
 import job_containers
-from decimal import *
 
 ##
 ## LOGGING
@@ -66,12 +70,79 @@ log = None
 ## CLASSES
 ##
 
-class Job:
+class JobQueryError(Exception):
+    """Exception raised when a job query fails part way through its output
+
+    Attributes:
+        msg -- explanation of the failure
+
+    """
+
+    def __init__(self, msg):
+        self.msg = msg
+
+    def __str__(self):
+        return self.msg
+
+class JobQueryDelta:
+    """The result of an incremental job query
+
+    Attributes:
+        jobs            -- iterable of the Jobs that are new or changed status
+        queued_ids      -- set of the ids of every job still in the queue
+        last_servertime -- schedd time of the previous poll, or None
+
+    """
+
+    def __init__(self, jobs, queued_ids, last_servertime):
+        self.jobs = jobs
+        self.queued_ids = queued_ids
+        self.last_servertime = last_servertime
+
+class JobStatusUpdate:
+    """The volatile attributes of a job the JobPool already tracks
+
+    A query only needs these few attributes of a known job, so its
+    ClassAd is read into one of these instead of a full Job.
+
+    """
+
+    def __init__(self, GlobalJobId, JobStatus=0, RemoteHost=None,
+                 ServerTime=0, JobStartDate=0, JobPrio=1):
+        self.id = GlobalJobId
+        self.priority = int(JobPrio)
+        self.job_status = int(JobStatus)
+        self.remote_host = RemoteHost
+        self.servertime = ServerTime
+        self.jobstarttime = JobStartDate
+
+class Job(object):
     """
     Job Class - Represents a job as read from the Job Scheduler
 
 
     """
+    # Jobs are kept in __slots__ rather than a per-instance __dict__, and
+    # their low-cardinality strings are interned, since a queue can hold
+    # hundreds of thousands of them.
+    __slots__ = ('id', 'user', 'uservmtype', 'priority', 'job_status',
+                 'cluster_id', 'proc_id', 'req_vmtype', 'req_network',
+                 'req_cpuarch', 'req_image', 'req_imageloc', 'req_ami',
+                 'req_memory', 'req_cpucores', 'req_storage', 'keep_alive',
+                 'high_priority', 'instance_type', 'maximum_price',
+                 'myproxy_server', 'myproxy_server_port', 'myproxy_creds_name',
+                 'x509userproxysubject', 'x509userproxy',
+                 'original_x509userproxy', 'spool_dir',
+                 'x509userproxy_expiry_time', 'proxy_renew_time',
+                 'job_per_core', 'remote_host', 'running_cloud', 'running_vm',
+                 'servertime', 'jobstarttime', 'banned', 'ban_time',
+                 'machine_reserved', 'req_hypervisor', 'proxy_non_boot',
+                 'vmimage_proxy_file', 'usertype_limit', 'req_image_id',
+                 'req_instance_type_ibm', 'location', 'key_name',
+                 'req_security_group', 'reqs_signature', 'status',
+                 'override_status', 'block_time', 'blocked_clouds',
+                 'target_clouds')
+
     # A list of possible statuses for internal job representation
     SCHEDULED = "Scheduled"
     UNSCHEDULED = "Unscheduled"
@@ -127,29 +198,29 @@ class Job:
         if VMType == "":
             VMType = config.default_VMType
         self.id           = GlobalJobId
-        self.user         = Owner
-        self.uservmtype   = ':'.join([Owner, VMType])
+        self.user         = intern_str(Owner)
+        self.uservmtype   = intern_str(':'.join([Owner, VMType]))
         self.priority     = int(JobPrio)
         self.job_status   = int(JobStatus)
         self.cluster_id   = int(ClusterId)
         self.proc_id      = int(ProcId)
-        self.req_vmtype   = VMType
-        self.req_network  = VMNetwork
-        self.req_cpuarch  = VMCPUArch
-        self.req_image    = VMName
-        self.req_imageloc = VMLoc
+        self.req_vmtype   = intern_str(VMType)
+        self.req_network  = intern_str(VMNetwork)
+        self.req_cpuarch  = intern_str(VMCPUArch)
+        self.req_image    = intern_str(VMName)
+        self.req_imageloc = intern_str(VMLoc)
         self.req_ami      = VMAMI
         self.req_memory   = int(VMMem)
         self.req_cpucores = int(VMCPUCores)
         self.req_storage  = int(VMStorage)
         self.keep_alive   = int(VMKeepAlive) * 60 # Convert to seconds
         self.high_priority = int(VMHighPriority)
-        self.instance_type = VMInstanceType
+        self.instance_type = intern_str(VMInstanceType)
         self.maximum_price = int(VMMaximumPrice)
-        self.myproxy_server = CSMyProxyServer
-        self.myproxy_server_port = CSMyProxyServerPort
-        self.myproxy_creds_name = CSMyProxyCredsName
-        self.x509userproxysubject = x509userproxysubject
+        self.myproxy_server = intern_str(CSMyProxyServer)
+        self.myproxy_server_port = intern_str(CSMyProxyServerPort)
+        self.myproxy_creds_name = intern_str(CSMyProxyCredsName)
+        self.x509userproxysubject = intern_str(x509userproxysubject)
         self.x509userproxy = x509userproxy
         self.original_x509userproxy = SUBMIT_x509userproxy
         self.spool_dir = Iwd
@@ -164,15 +235,19 @@ class Job:
         self.banned = False
         self.ban_time = None
         self.machine_reserved = ""     #Used for FIFO scheduling to determine which, if any, machine is reserved (stores the "Name" dict key)
-        self.req_hypervisor = [x.lower() for x in splitnstrip(',', VMHypervisor)]
+        self.req_hypervisor = [intern_str(x.lower()) for x in splitnstrip(',', VMHypervisor)]
         self.proxy_non_boot = VMProxyNonBoot in ['true', "True", True]
-        self.vmimage_proxy_file = VMImageProxyFile
+        self.vmimage_proxy_file = intern_str(VMImageProxyFile)
         self.usertype_limit = int(VMTypeLimit)
-        self.req_image_id = VMImageID
-        self.req_instance_type_ibm = VMInstanceTypeIBM
-        self.location = VMLocation
-        self.key_name = VMKeyName
-        self.req_security_group = splitnstrip(',', VMSecurityGroup)
+        self.req_image_id = intern_str(VMImageID)
+        self.req_instance_type_ibm = intern_str(VMInstanceTypeIBM)
+        self.location = intern_str(VMLocation)
+        self.key_name = intern_str(VMKeyName)
+        self.req_security_group = [intern_str(x) for x in splitnstrip(',', VMSecurityGroup)]
+        # Jobs with equal signatures can share a VM (see has_same_reqs)
+        self.reqs_signature = (self.req_vmtype, self.req_cpucores, self.req_memory,
+                               self.req_storage, self.req_cpuarch, self.req_network,
+                               self.user)
 
         # Set the new job's status
         if self.job_status == 2:
@@ -190,7 +265,7 @@ class Job:
         try:
             if len(TargetClouds) != 0:
                 for cloud in TargetClouds.split(','):
-                    self.target_clouds.append(cloud.strip())
+                    self.target_clouds.append(intern_str(cloud.strip()))
         except:
             log.error("Failed to parse TargetClouds - use a comma separated list")
 
@@ -346,7 +421,7 @@ class Job:
 
     def has_same_reqs(self, job):
         """A method that will compare a job's requirements listed below with another job to see if they all match."""
-        return self.req_vmtype == job.req_vmtype and self.req_cpucores == job.req_cpucores and self.req_memory == job.req_memory and self.req_storage == job.req_storage and self.req_cpuarch == job.req_cpuarch and self.req_network == job.req_network and self.user == job.user
+        return self.reqs_signature == job.reqs_signature
 
     def get_vmimage_proxy_file_path(self):
         proxypath = []
@@ -379,6 +454,69 @@ class Job:
 
         return proxyfilepath
 
+class ScheddQuery(threading.Thread):
+    """
+    ScheddQuery - runs condor_q against one schedd in its own thread, so
+    several schedds can be queried at the same time. The jobs read are put
+    on a bounded queue shared by all the queries, as (schedd, job) pairs
+    ending with (schedd, None), for JobPool.update_jobs to consume while
+    condor_q is still running.
+    """
+
+    def __init__(self, job_pool, schedd, job_queue):
+        threading.Thread.__init__(self, name=self.__class__.__name__)
+        self.job_pool = job_pool
+        self.schedd = schedd
+        self.job_queue = job_queue
+        self.process = None
+        self.stopped = False
+        self.succeeded = False
+    def run(self):
+        try:
+            condor_q = self.job_pool._condor_q_command(schedd=self.schedd)
+            started = self.job_pool._condor_q_start(condor_q)
+            if started == None:
+                return
+            (self.process, condor_err) = started
+            if self.stopped:
+                # stop() was called before condor_q was running
+                self.stop()
+                self.process.wait()
+                return
+            for job in self.job_pool._condor_q_stream(self.process, condor_q, condor_err):
+                if not self._put(job):
+                    return
+            self.succeeded = not self.stopped
+        except JobQueryError, e:
+            log.error("Query of schedd %s failed: %s" % (self.schedd, e))
+        except:
+            log.exception("Problem querying schedd %s, unexpected error" % self.schedd)
+        finally:
+            self._put(None)
+    def _put(self, job):
+        """Put a job on the queue, waiting for room unless stopped."""
+        while not self.stopped:
+            try:
+                self.job_queue.put((self.schedd, job), True, 1)
+                return True
+            except Queue.Full:
+                pass
+        return False
+    def stop(self):
+        """Kill the condor_q of a query that has taken too long, or, if it
+        hasn't started yet, as soon as it does."""
+        self.stopped = True
+        process = self.process
+        if process != None and process.poll() == None:
+            try:
+                process.kill()
+            except OSError:
+                pass
+
+# The ClassAd attributes a Job is built from: the constructor's keyword
+# arguments, plus the Requirements expression VMType and friends come from.
+JOB_CLASSAD_ATTRIBUTES = inspect.getargspec(Job.__init__)[0][1:] + ["Requirements"]
+
 class JobPool:
     """ A pool of all jobs read from the job scheduler. Stores all jobs until they
  complete. Keeps scheduled and unscheduled jobs.
@@ -403,6 +541,19 @@ class JobPool:
     # can take a REALLY long time to return the XML list of jobs
     CONDOR_TIMEOUT = 1200 # seconds (20min)
 
+    # In incremental mode the whole queue is still fetched every this many
+    # polls, to pick up attribute changes that don't touch EnteredCurrentStatus
+    FULL_QUERY_INTERVAL = 10
+    # How far the incremental constraint reaches back past the previous poll,
+    # so status changes in the same second as that poll aren't missed
+    WATERMARK_OVERLAP = 60 # seconds
+
+    # How many jobs the schedd queries may read ahead of update_jobs
+    SCHEDD_QUEUE_SIZE = 1000
+
+    # The only ClassAd attributes read for jobs that are already known
+    VOLATILE_ATTRIBUTES = ("JobStatus", "RemoteHost", "ServerTime", "JobStartDate", "JobPrio")
+
     ## Instance Methods
 
     def __init__(self, name, condor_query_type=""):
@@ -422,6 +573,11 @@ class JobPool:
         self.name = name
         self.last_query = None
         self.write_lock = threading.RLock()
+        # schedd ServerTime of the last incremental poll
+        self.servertime_watermark = None
+        self.incremental_polls = 0
+        # ids of the jobs each of config.condor_schedds last reported
+        self.schedd_job_ids = {}
 
         _schedd_wsdl  = "file://" + determine_path() \
                         + "/wsdl/condorSchedd.wsdl"
@@ -435,8 +591,19 @@ class JobPool:
             condor_query_type = config.condor_retrieval_method
 
         if condor_query_type.lower() == "local":
-            self.job_query = self.job_query_local
+            if config.condor_schedds:
+                if config.condor_q_incremental:
+                    log.warning("condor_q_incremental can't be used with condor_schedds. Using full queries.")
+                self.job_query = self.job_query_local_schedds
+            elif config.condor_q_incremental:
+                self.job_query = self.job_query_local_incremental
+            else:
+                self.job_query = self.job_query_local
         elif condor_query_type.lower() == "soap":
+            if config.condor_q_incremental:
+                log.warning("condor_q_incremental is only supported by the local retrieval method. Using full queries.")
+            if config.condor_schedds:
+                log.warning("condor_schedds is only supported by the local retrieval method. Using %s." % config.condor_webservice_url)
             self.job_query = self.job_query_SOAP
         else:
             log.error("Can't use '%s' retrieval method. Using SOAP method." % condor_query_type)
@@ -465,26 +632,231 @@ class JobPool:
         return jobs
 
     def job_query_local(self):
-        """job_query_local -- query and parse condor_q for job information."""
+        """job_query_local -- query condor_q for job information.
+
+           Returns a generator that parses the condor_q output as it is read
+           from the pipe and yields Job objects, or None if condor_q could
+           not be started.
+        """
         log.verbose("Querying Condor scheduler daemon (schedd) with %s" % config.condor_q_command)
+        return self._condor_q_popen(self._condor_q_command())
+
+    def job_query_local_schedds(self):
+        """job_query_local_schedds -- query every schedd in condor_schedds at once.
+
+           Each schedd is queried in its own ScheddQuery thread, and one that
+           doesn't answer within condor_q_timeout seconds has its condor_q
+           killed. The jobs are handed over through a bounded queue as they
+           are read. The ids last reported by a schedd that failed are kept,
+           so its jobs aren't removed.
+
+           Returns a JobQueryDelta whose jobs raise JobQueryError if every
+           schedd failed.
+        """
+        log.verbose("Querying Condor scheduler daemons (schedds) %s" % ", ".join(config.condor_schedds))
+        job_queue = Queue.Queue(self.SCHEDD_QUEUE_SIZE)
+        queries = [ScheddQuery(self, schedd, job_queue) for schedd in config.condor_schedds]
+        kept_ids = set()
+        return JobQueryDelta(self._schedd_query_jobs(queries, job_queue, kept_ids), kept_ids, None)
+
+    def _schedd_query_jobs(self, queries, job_queue, kept_ids):
+        """Start the queries and yield the jobs they put on job_queue until
+        every one has finished or condor_q_timeout has passed.
+
+           Once the jobs are consumed, the ids last reported by each schedd
+           that failed or timed out are added to kept_ids. Raises
+           JobQueryError if every schedd failed.
+        """
+        for query in queries:
+            query.start()
+        deadline = time.time() + config.condor_q_timeout
+        schedd_ids = dict((query.schedd, set()) for query in queries)
+        running = len(queries)
         try:
-            condor_q = shlex.split(config.condor_q_command)
+            while running:
+                try:
+                    (schedd, job) = job_queue.get(True, max(0, deadline - time.time()))
+                except Queue.Empty:
+                    break
+                if job == None:
+                    running -= 1
+                    continue
+                schedd_ids[schedd].add(job.id)
+                yield job
+
+            for query in queries:
+                if query.isAlive():
+                    log.error("Query of schedd %s timed out after %ds" % (query.schedd, config.condor_q_timeout))
+                    query.stop()
+            # Jobs a query finished putting just before the deadline
+            while True:
+                try:
+                    (schedd, job) = job_queue.get_nowait()
+                except Queue.Empty:
+                    break
+                if job != None:
+                    schedd_ids[schedd].add(job.id)
+                    yield job
+        finally:
+            # The jobs may be abandoned part way through, so don't leave a
+            # query blocked on the full queue or its condor_q running
+            for query in queries:
+                if query.isAlive():
+                    query.stop()
+
+        failed = 0
+        for query in queries:
+            if query.succeeded:
+                self.schedd_job_ids[query.schedd] = schedd_ids[query.schedd]
+            else:
+                failed += 1
+                kept_ids.update(self.schedd_job_ids.get(query.schedd, ()))
+        if failed == len(queries):
+            raise JobQueryError("Every schedd query failed")
+
+    def job_query_local_incremental(self):
+        """job_query_local_incremental -- query condor_q only for changed jobs.
+
+           Lists the id and status of every queued job, then fetches full
+           ClassAds only for jobs that entered their current status since the
+           previous poll. The whole queue is fetched on the first poll, after
+           a failure, and every FULL_QUERY_INTERVAL polls.
+
+           Returns a JobQueryDelta, or None if condor_q could not be run.
+        """
+        log.verbose("Querying Condor scheduler daemon (schedd) incrementally with %s" % config.condor_q_command)
+        listing = self._condor_q_job_ids()
+        if listing == None:
+            self.servertime_watermark = None
+            return None
+        (queued_ids, servertime) = listing
+
+        last_servertime = self.servertime_watermark
+        if not queued_ids:
+            jobs = []
+        elif last_servertime != None and self.incremental_polls < self.FULL_QUERY_INTERVAL:
+            self.incremental_polls += 1
+            jobs = self._condor_q_popen(self._condor_q_command(
+                       'EnteredCurrentStatus >= %d' % (last_servertime - self.WATERMARK_OVERLAP)))
+        else:
+            self.incremental_polls = 0
+            jobs = self._condor_q_popen(self._condor_q_command())
+        if jobs == None:
+            self.servertime_watermark = None
+            return None
+
+        self.servertime_watermark = servertime
+        return JobQueryDelta(jobs, queued_ids, last_servertime)
+
+    def _condor_q_command(self, constraint=None, schedd=None):
+        """Build the condor_q command line used to fetch job ClassAds.
+
+           With condor_query_projection set, -l is swapped for -af:lrng and
+           only JOB_CLASSAD_ATTRIBUTES are asked for; the output keeps the
+           'Attribute = value' lines and blank line between ads of -l.
+        """
+        condor_q = shlex.split(config.condor_q_command)
+        if schedd:
+            condor_q.extend(['-name', schedd])
+        if constraint:
+            condor_q.extend(['-constraint', constraint])
+        if config.condor_query_projection:
+            condor_q = [arg for arg in condor_q if arg not in ('-l', '-long')]
+            # -af takes every argument after it as an attribute, so it goes last
+            condor_q.append('-af:lrng')
+            condor_q.extend(JOB_CLASSAD_ATTRIBUTES)
+        return condor_q
+
+    def _condor_q_job_ids(self):
+        """Run a cheap condor_q listing of job ids, statuses and the schedd time.
+
+           Returns a tuple of (set of ids of jobs below REMOVED status, schedd
+           ServerTime or None if the queue is empty), or None on failure.
+        """
+        condor_q = [arg for arg in shlex.split(config.condor_q_command)
+                    if arg not in ('-l', '-long')]
+        condor_q.extend(['-format', '%s ', 'GlobalJobId',
+                         '-format', '%d ', 'JobStatus',
+                         '-format', '%d\n', 'ServerTime'])
+        try:
+            condor_err = tempfile.TemporaryFile()
             sp = subprocess.Popen(condor_q, shell=False,
-                       stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            (condor_out, condor_err) = sp.communicate(input=None)
-            returncode = sp.returncode
+                       stdout=subprocess.PIPE, stderr=condor_err)
         except:
             log.exception("Problem running %s, unexpected error" % string.join(condor_q, " "))
             return None
 
+        queued_ids = set()
+        servertime = None
+        for line in iter(sp.stdout.readline, ''):
+            try:
+                (jobid, status, job_servertime) = line.split()
+                if int(status) < self.REMOVED:
+                    queued_ids.add(jobid)
+                servertime = max(servertime, int(job_servertime))
+            except ValueError:
+                log.debug("Skipping unexpected condor_q id listing line: %s" % line.strip())
+        sp.stdout.close()
+        returncode = sp.wait()
+
+        condor_err.seek(0)
+        stderr = condor_err.read()
+        condor_err.close()
         if returncode != 0:
             log.error("Got non-zero return code '%s' from '%s'. stderr was: %s" %
-                              (returncode, string.join(condor_q, " "), condor_err))
+                              (returncode, string.join(condor_q, " "), stderr))
+            return None
+        return (queued_ids, servertime)
+
+    def _condor_q_popen(self, condor_q):
+        """Start condor_q and return a generator of the Jobs it lists.
+
+           Returns None if condor_q could not be started.
+        """
+        started = self._condor_q_start(condor_q)
+        if started == None:
+            return None
+        (sp, condor_err) = started
+        return self._condor_q_stream(sp, condor_q, condor_err)
+
+    def _condor_q_start(self, condor_q):
+        """Start condor_q with its stdout on a pipe.
+
+           Returns a tuple of (Popen object, stderr file), or None if
+           condor_q could not be started.
+        """
+        try:
+            # stderr goes to a file so a chatty condor_q can't fill the pipe
+            # and block while we are still reading stdout
+            condor_err = tempfile.TemporaryFile()
+            sp = subprocess.Popen(condor_q, shell=False,
+                       stdout=subprocess.PIPE, stderr=condor_err)
+        except:
+            log.exception("Problem running %s, unexpected error" % string.join(condor_q, " "))
             return None
+        return (sp, condor_err)
 
-        job_ads = self._condor_q_to_job_list(condor_out)
+    def _condor_q_stream(self, sp, condor_q, condor_err):
+        """Yield Jobs from a running condor_q process, then check how it exited.
+
+           Raises JobQueryError if condor_q returns non-zero, so a truncated
+           listing is never mistaken for the whole queue.
+        """
+        try:
+            for job in self._condor_q_stream_to_jobs(iter(sp.stdout.readline, ''),
+                                                     self.job_container.get_job_ids()):
+                yield job
+        finally:
+            sp.stdout.close()
+            returncode = sp.wait()
+
+        condor_err.seek(0)
+        stderr = condor_err.read()
+        condor_err.close()
+        if returncode != 0:
+            raise JobQueryError("Got non-zero return code '%s' from '%s'. stderr was: %s" %
+                                (returncode, string.join(condor_q, " "), stderr))
         self.last_query = datetime.datetime.now()
-        return job_ads
 
 
     def job_query_SOAP(self):
@@ -507,7 +879,7 @@ class JobPool:
             return None
 
         # Create the condor_jobs list to store jobs
-        condor_jobs = self._condor_job_xml_to_job_list(job_ads)
+        condor_jobs = self._condor_job_xml_to_job_list(job_ads, self.job_container.get_job_ids())
         del job_ads
         # When querying finishes successfully, reset last query timestamp
         self.last_query = datetime.datetime.now()
@@ -523,6 +895,72 @@ class JobPool:
 
                 returns [] if there are no jobs
         """
+        return list(JobPool._condor_q_stream_to_jobs(StringIO(condor_q_output)))
+
+    @staticmethod
+    def _condor_q_stream_to_jobs(condor_q_lines, known_ids=()):
+        """
+        _condor_q_stream_to_jobs - Generator converting the output of condor_q,
+                given as an iterable of lines, to Job Objects
+
+                A Job is yielded as soon as the blank line that ends its
+                ClassAd is read, so only one ClassAd is held at a time.
+                Jobs whose GlobalJobId is in known_ids are yielded as
+                JobStatusUpdates instead.
+        """
+        classad_lines = []
+        for classad_line in condor_q_lines:
+            classad_line = classad_line.strip()
+            # Each classad is seperated by a blank line
+            if not classad_line:
+                if classad_lines:
+                    yield JobPool._classad_lines_to_job(classad_lines, known_ids)
+                    classad_lines = []
+                continue
+            # The header line looks like:
+            # -- Submitter: hostname : <ip> : hostname
+            # we can just skip it.
+            if classad_line.startswith("--"):
+                continue
+            classad_lines.append(classad_line)
+        if classad_lines:
+            yield JobPool._classad_lines_to_job(classad_lines, known_ids)
+
+    @staticmethod
+    def _classad_lines_to_job(classad_lines, known_ids=()):
+        """
+        _classad_lines_to_job - Builds a Job Object from the lines of one
+                condor_q ClassAd, or only a JobStatusUpdate if its
+                GlobalJobId is in known_ids
+        """
+        if known_ids:
+            for classad_line in classad_lines:
+                if classad_line.startswith("GlobalJobId = "):
+                    jobid = classad_line[len("GlobalJobId = "):].strip('"')
+                    if jobid in known_ids:
+                        status = {}
+                        for status_line in classad_lines:
+                            (classad_key, _, classad_value) = status_line.partition(" = ")
+                            # Projections print attributes a job lacks as undefined
+                            if classad_key in JobPool.VOLATILE_ATTRIBUTES and classad_value != "undefined":
+                                status[classad_key] = classad_value.strip('"')
+                        return JobStatusUpdate(jobid, **status)
+                    break
+
+        classad = {}
+        for classad_line in classad_lines:
+            (classad_key, classad_value) = classad_line.split(" = ", 1)
+            # Projections print attributes a job lacks as undefined
+            if classad_value != "undefined":
+                classad[classad_key] = classad_value.strip('"')
+        return JobPool._classad_to_job(classad)
+
+    @staticmethod
+    def _classad_to_job(classad):
+        """
+        _classad_to_job - Builds a Job Object from a dictionary of raw
+                condor_q ClassAd attributes
+        """
 
         def _attribute_from_requirements(requirements, attribute):
             regex = "%s\s=\?=\s\"(?P<value>[^\"].+?)\"" % attribute
@@ -551,63 +989,43 @@ class JobPool:
             except:
                 pass
 
-        jobs = []
-
-        # The first three lines look like:
-        # \n\n\t-- Submitter: hostname : <ip> : hostname
-        # we can just strip these.
-        condor_q_output = re.sub('\n\n.*?Submitter:.*?\n', "", condor_q_output, re.MULTILINE)
-
-        # Each classad is seperated by '\n\n'
-        raw_job_classads = condor_q_output.split("\n\n")
-        # Empty condor pools give us an empty string in our list
-        raw_job_classads = filter(lambda x: x != "", raw_job_classads)
+        try:
+            classad["VMType"] = _attribute_from_requirements(classad["Requirements"], "VMType")
+        except:
+            log.exception("Problem extracting VMType from Requirements")
 
-        for raw_classad in raw_job_classads:
-            classad = {}
-            classad_lines = raw_classad.splitlines()
-            for classad_line in classad_lines:
-                classad_line = classad_line.strip()
-                (classad_key, classad_value) = classad_line.split(" = ", 1)
-                classad_value = classad_value.strip('"')
-                classad[classad_key] = classad_value
+        if config.vm_reqs_from_condor_reqs:
+            if not classad.has_key("VMMem"):
+                try:
+                    classad["VMMem"] = int(_attribute_from_requirements_alt(classad["Requirements"], "Memory"))
+                except:
+                    log.exception("Problem extracting Memory from Requirements")
+            if not classad.has_key("VMStorage"):
+                try:
+                    classad["VMStorage"] = int(_attribute_from_requirements_alt(classad["Requirements"], "Disk")) / 1000000
+                    if classad["VMStorage"] < 1:
+                        classad["VMStorage"] = 1
+                except:
+                    log.exception("Problem extracting Disk from Requirements")
+            if not classad.has_key("VMCPUCores"):
+                try:
+                    classad["VMCPUCores"] = int(_attribute_from_requirements_alt(classad["Requirements"], "Cpus"))
+                except:
+                    log.exception("Problem extracting Cpus from Requirements")
+        # VMAMI requires special fiddling
+        _attribute_from_list(classad, "VMAMI")
+        _attribute_from_list(classad, "VMInstanceType")
 
-            try:
-                classad["VMType"] = _attribute_from_requirements(classad["Requirements"], "VMType")
-            except:
-                log.exception("Problem extracting VMType from Requirements")
-
-            if config.vm_reqs_from_condor_reqs:
-                if not classad.has_key("VMMem"):
-                    try:
-                        classad["VMMem"] = int(_attribute_from_requirements_alt(classad["Requirements"], "Memory"))
-                    except:
-                        log.exception("Problem extracting Memory from Requirements")
-                if not classad.has_key("VMStorage"):
-                    try:
-                        classad["VMStorage"] = int(_attribute_from_requirements_alt(classad["Requirements"], "Disk")) / 1000000
-                        if classad["VMStorage"] < 1:
-                            classad["VMStorage"] = 1
-                    except:
-                        log.exception("Problem extracting Disk from Requirements")
-                if not classad.has_key("VMCPUCores"):
-                    try:
-                        classad["VMCPUCores"] = int(_attribute_from_requirements_alt(classad["Requirements"], "Cpus"))
-                    except:
-                        log.exception("Problem extracting Cpus from Requirements")
-            # VMAMI requires special fiddling
-            _attribute_from_list(classad, "VMAMI")
-            _attribute_from_list(classad, "VMInstanceType")
-
-            jobs.append(Job(**classad))
-        return jobs
+        return Job(**classad)
 
     @staticmethod
-    def _condor_job_xml_to_job_list(condor_xml):
+    def _condor_job_xml_to_job_list(condor_xml, known_ids=()):
         """
         _condor_job_xml_to_job_list - Converts Condor SOAP XML from Condor
                 to a list of Job Objects
 
+                Jobs whose GlobalJobId is in known_ids are returned as
+                JobStatusUpdates instead.
                 returns [] if there are no jobs
         """
         def _job_attribute(xml, element):
@@ -647,6 +1065,12 @@ class JobPool:
                 job_dictionary = {}
                 # Mandatory parameters
                 job_dictionary['GlobalJobId'] = _job_attribute(xml_job, "GlobalJobId")
+                if job_dictionary['GlobalJobId'] in known_ids:
+                    for attribute in JobPool.VOLATILE_ATTRIBUTES:
+                        _add_if_exists(xml_job, job_dictionary, attribute)
+                    jobs.append(JobStatusUpdate(**job_dictionary))
+                    elem.clear()
+                    continue
                 job_dictionary['Owner'] = _job_attribute(xml_job, "Owner")
                 job_dictionary['JobPrio'] = _job_attribute(xml_job, "JobPrio")
                 job_dictionary['JobStatus'] = _job_attribute(xml_job, "JobStatus")
@@ -708,81 +1132,90 @@ class JobPool:
     def update_jobs(self, query_jobs):
         """Updates the system jobs:
             - Removes finished or deleted jobs from the system
-            - Ignores jobs already in the system and still in Condor
+            - Updates the status of jobs already in the system and still in Condor
             - Adds all new jobs to the system
+           The changes are worked out by _reconcile_jobs and then applied to
+           the job container in a single locked batch.
            Keywords:
-            - query_jobs - (list of Job objects) The jobs received from a condor query
+            - query_jobs - (iterable of Job objects, or a JobQueryDelta) The
+                           jobs received from a condor query. May be a
+                           generator; it is consumed once.
         """
+        try:
+            (new_jobs, status_updates, removed_ids) = self._reconcile_jobs(query_jobs)
+        except JobQueryError, e:
+            log.error("Job query failed, not removing any jobs this cycle: %s" % e)
+            self.servertime_watermark = None
+            return
+
         # If no jobs recvd, remove all jobs from the system (all have finished or have been removed)
-        if (query_jobs == []):
+        if new_jobs == None:
             log.debug("No jobs received from job query. Removing all jobs from the system.")
             self.job_container.clear()
             return
 
-        # Filter out any jobs in an error status (from the given job list)
-        jobs_removed_due_status = 0
-        for job in reversed(query_jobs):
-            if job.job_status >= self.REMOVED:
-                jobs_removed_due_status += 1
-                query_jobs.remove(job)
-        log.verbose("Jobs removed due to status held, removed, error, complete: %i" % jobs_removed_due_status)
-        # Update all system jobs:
-        #   - remove jobs already in the system from the jobs list
-        #   - remove finished jobs (job in system, not in jobs list)
-
-        # DBG: print both jobs dicts before updating system.
-        #log.verbose("System jobs prior to system update:")
-        #log.verbose("Unscheduled Jobs (new_jobs):")
-        #self.log_unsched_jobs()
-        #log.verbose("Scheduled Jobs (sched_jobs):")
-        #self.log_sched_jobs()
-        #log.verbose("High Priority Jobs (high_jobs):")
-        #self.log_high_jobs()
-
-        # Lets remove all jobs in the container that do not appear in the
-        # given condor job list.
-        # Keep a list of the removed jobs
-        removed = self.job_container.remove_all_not_in(query_jobs)
+        log.verbose("Adding %d new jobs, updating job status of %d jobs, removing %d jobs" %
+                    (len(new_jobs), len(status_updates), len(removed_ids)))
+        removed = self.job_container.apply_job_updates(new_jobs.values(), status_updates, removed_ids)
+        if isinstance(query_jobs, JobQueryDelta) and query_jobs.last_servertime != None:
+            # Unchanged jobs weren't refetched, so their ServerTime is stale;
+            # they were last seen at the previous poll.
+            for job in removed:
+                if int(job.servertime) < query_jobs.last_servertime:
+                    job.servertime = query_jobs.last_servertime
         self.track_run_time(removed)
 
-        # Now lets loop through the remaining jobs given by condor and
-        # check if each job is in the job container.
-        # If yes, then it means the job is not new (the container already
-        # knows about it) and we simply need to update it.
-        # In that case, we also remove it from the query_jobs, so that
-        # only new jobs will remain in query_jobs after this step.
-        jobs_to_update = []
-        new_jobs = []
-        for job in query_jobs:
-            if self.job_container.has_job(job.id):
-                jobs_to_update.append(job)
-            else:
-                new_jobs.append(job)
-        query_jobs = new_jobs
+    def _reconcile_jobs(self, query_jobs):
+        """Work out how the job container must change to match a job query.
 
-        # Add all jobs remaining in jobs list to the Unscheduled job set (new_jobs)
+           Makes one pass over the query, remembering the full Job only for
+           ids the container doesn't know yet and just the volatile status
+           attributes for the rest. Jobs to remove come from set differences.
+
+           Returns a tuple of (dict of jobid -> new Job,
+           dict of jobid -> (status, remote_host, servertime, jobstarttime),
+           set of jobids to remove), or (None, None, None) if the query
+           returned no jobs at all.
+        """
+        # An incremental query only carries the jobs that changed; the rest
+        # of the queue is described by its id listing.
+        delta = None
+        if isinstance(query_jobs, JobQueryDelta):
+            delta = query_jobs
+            query_jobs = delta.jobs
+
+        known_ids = self.job_container.get_job_ids()
+        new_jobs = {}
+        status_updates = {}
+        jobs_received = 0
+        jobs_removed_due_status = 0
         for job in query_jobs:
-            if job.high_priority == 0 or  not config.high_priority_job_support:
-                self.add_new_job(job)
+            jobs_received += 1
+            # Filter out any jobs in an error status
+            if job.job_status >= self.REMOVED:
+                jobs_removed_due_status += 1
+                continue
+            if job.id in known_ids:
+                status_updates[job.id] = (int(job.job_status), job.remote_host,
+                                          job.servertime, job.jobstarttime,
+                                          job.priority)
+            elif isinstance(job, JobStatusUpdate):
+                # Left the container since the query started; the next
+                # query will read it in full if it is still queued.
+                log.debug("Skipping status update for unknown job %s" % job.id)
             else:
-                self.add_high_job(job)
-        del query_jobs
-
+                new_jobs[job.id] = job
+        log.verbose("Jobs removed due to status held, removed, error, complete: %i" % jobs_removed_due_status)
 
-        # Update job status of all the non-new jobs
-        log.verbose("Updating job status of %d jobs" % (len(jobs_to_update)))
-        for job in jobs_to_update:
-            self.update_job_status(job)
-        del jobs_to_update
+        if jobs_received == 0 and delta == None:
+            return (None, None, None)
 
-        # DBG: print both jobs dicts before updating system.
-        #log.verbose("System jobs after system update:")
-        #log.verbose("Unscheduled Jobs (new_jobs):")
-        #self.log_unsched_jobs()
-        #log.verbose("Scheduled Jobs (sched_jobs):")
-        #self.log_sched_jobs()
-        #log.verbose("High Priority Jobs (high_jobs):")
-        #self.log_high_jobs()
+        # Jobs left out of an incremental query are unchanged, not gone, so
+        # there only jobs missing from the id listing are removed.
+        removed_ids = known_ids.difference(status_updates)
+        if delta != None:
+            removed_ids.difference_update(delta.queued_ids)
+        return (new_jobs, status_updates, removed_ids)
 
     def add_new_job(self, job):
         """Add New Job
@@ -823,7 +1256,7 @@ class JobPool:
             True - updated
             False - failed
         """
-        return self.job_container.update_job_status(target_job.id, int(target_job.job_status), target_job.remote_host, target_job.servertime, target_job.jobstarttime)
+        return self.job_container.update_job_status(target_job.id, int(target_job.job_status), target_job.remote_host, target_job.servertime, target_job.jobstarttime, target_job.priority)
 
     def schedule(self, job):
         """Makes all changes to a job to indicate that the job has been scheduled.
@@ -841,6 +1274,15 @@ class JobPool:
         """
         self.job_container.unschedule_job(job.id)
 
+    def ban(self, job, reason):
+        """Temporarily bans a job from being scheduled.
+
+            Keywords:
+                job - (Job object) The job to ban
+                reason - (string) Shown as the job's override status
+        """
+        self.job_container.ban_job(job.id, reason)
+
     def get_required_vmtypes(self):
         """Get a list of required VM types.
 
@@ -850,11 +1292,7 @@ class JobPool:
            required_vmtypes - (list of strings) A list of required VM types
 
         """
-        required_vmtypes = []
-        for job in self.job_container.get_all_jobs():
-            if job.req_vmtype not in required_vmtypes and job.job_status <= self.RUNNING \
-            and not job.banned:
-                required_vmtypes.append(job.req_vmtype)
+        required_vmtypes = self.job_container.get_required_vmtypes_dict().keys()
 
         log.verbose("get_required_vmtypes - Required VM types: " + ", ".join(required_vmtypes))
         return required_vmtypes
@@ -869,11 +1307,7 @@ class JobPool:
             required_vmtypes - (list of strings) A list of required VM types
 
         """
-        required_vmtypes = []
-        for job in self.job_container.get_all_jobs():
-            if job.uservmtype not in required_vmtypes and job.job_status <= self.RUNNING \
-               and not job.banned:
-                required_vmtypes.append(job.uservmtype)
+        required_vmtypes = self.job_container.get_required_uservmtypes_dict().keys()
 
         log.verbose("get_required_uservmtypes - Required VM types: " + ", ".join(required_vmtypes))
         return required_vmtypes
@@ -888,10 +1322,7 @@ class JobPool:
             required_vmtypes - (dictionary, string key, int value)
 
         """
-        required_vmtypes = defaultdict(int)
-        for job in self.job_container.get_all_jobs():
-            if job.job_status <= self.RUNNING and not job.banned:
-                required_vmtypes[job.req_vmtype] += 1
+        required_vmtypes = self.job_container.get_required_vmtypes_dict()
         log.verbose("get_required_vm_types_dict - Required VM Type : Count " + str(required_vmtypes))
         return required_vmtypes
 
@@ -902,10 +1333,7 @@ class JobPool:
         Returns:
             required_vmtypes - (dictionary, string key, int value) A dict of required VM types
         """
-        required_vmtypes = defaultdict(int)
-        for job in self.job_container.get_all_jobs():
-            if job.job_status <= self.RUNNING and not job.banned:
-                required_vmtypes[job.uservmtype] += 1
+        required_vmtypes = self.job_container.get_required_uservmtypes_dict()
         log.verbose("get_required_vm_usertypes_dict - Required VM Type : Count " + str(required_vmtypes))
         return required_vmtypes
 
@@ -929,7 +1357,7 @@ class JobPool:
             if vmtype == None:
                 held_user_adjust -= 1 #This user is completely held
                 break
-            type_desired[vmtype] += 1 * (1 / Decimal(config.high_priority_job_weight) if high_priority_jobs_by_users else 1)
+            type_desired[vmtype] += 1 * (1.0 / config.high_priority_job_weight if high_priority_jobs_by_users else 1)
         for user in high_priority_jobs_by_users.keys():
             vmtype = None
             for job in high_priority_jobs_by_users[user]:
@@ -940,7 +1368,7 @@ class JobPool:
                 held_user_adjust -= 1 # this user is completely held
                 break
             type_desired[vmtype] += 1 * config.high_priority_job_weight
-        num_users = Decimal(held_user_adjust + len(new_jobs_by_users.keys()) + len(high_priority_jobs_by_users.keys()))
+        num_users = float(held_user_adjust + len(new_jobs_by_users.keys()) + len(high_priority_jobs_by_users.keys()))
         if num_users == 0:
             log.verbose("All users held, completed, or banned")
             return {}
@@ -967,7 +1395,7 @@ class JobPool:
             if vmtype == None:
                 held_user_adjust -= 1 #This user is completely held
                 continue
-            type_desired[vmtype] += 1 * (1 / Decimal(config.high_priority_job_weight) if high_priority_jobs_by_users else 1)
+            type_desired[vmtype] += 1 * (1.0 / config.high_priority_job_weight if high_priority_jobs_by_users else 1)
         for user in high_priority_jobs_by_users.keys():
             vmtype = None
             for job in high_priority_jobs_by_users[user]:
@@ -978,7 +1406,7 @@ class JobPool:
                 held_user_adjust -= 1 # this user is completely held
                 continue
             type_desired[vmtype] += 1 * config.high_priority_job_weight
-        num_users = Decimal(held_user_adjust + len(new_jobs_by_users.keys()) + len(high_priority_jobs_by_users.keys()))
+        num_users = float(held_user_adjust + len(new_jobs_by_users.keys()) + len(high_priority_jobs_by_users.keys()))
         if num_users == 0:
             log.verbose("All users held, completed, or banned")
             return {}
@@ -1004,7 +1432,9 @@ class JobPool:
             vmtypes = set()
             highest_priority = new_jobs_by_users[user][0].priority
             for job in new_jobs_by_users[user]:
-                if job.job_status <= self.RUNNING and job.priority == highest_priority and not job.banned:
+                if job.priority != highest_priority:
+                    break # lists are in priority order
+                if job.job_status <= self.RUNNING and not job.banned:
                     vmtypes.add(job.req_vmtype)
             if len(vmtypes) == 0: # user is held / complete
                 held_user_adjust -= 1
@@ -1014,7 +1444,9 @@ class JobPool:
             vmtypes = set()
             highest_priority = high_priority_jobs_by_users[user][0].priority
             for job in high_priority_jobs_by_users[user]:
-                if job.job_status <= self.RUNNING and job.priority == highest_priority and not job.banned:
+                if job.priority != highest_priority:
+                    break # lists are in priority order
+                if job.job_status <= self.RUNNING and not job.banned:
                     vmtypes.add(job.req_vmtype)
             if len(vmtypes) == 0: # user is held / complete
                 held_user_adjust -= 1
@@ -1024,18 +1456,18 @@ class JobPool:
         for user in user_types.keys():
             for vmtype in user_types[user]:
                 if vmtype in type_desired.keys():
-                    type_desired[vmtype] += Decimal('1.0') / len(user_types[user]) * (1 / Decimal(config.high_priority_job_weight) if high_priority_jobs_by_users else 1)
+                    type_desired[vmtype] += 1.0 / len(user_types[user]) * (1.0 / config.high_priority_job_weight if high_priority_jobs_by_users else 1)
                 else:
-                    type_desired[vmtype] = Decimal('1.0') / len(user_types[user]) * (1 / Decimal(config.high_priority_job_weight) if high_priority_jobs_by_users else 1)
+                    type_desired[vmtype] = 1.0 / len(user_types[user]) * (1.0 / config.high_priority_job_weight if high_priority_jobs_by_users else 1)
         for user in high_user_types.keys():
             for vmtype in high_user_types[user]:
                 if vmtype in type_desired.keys():
-                    type_desired[vmtype] += Decimal('1.0') / len(high_user_types[user]) * config.high_priority_job_weight
+                    type_desired[vmtype] += 1.0 / len(high_user_types[user]) * config.high_priority_job_weight
                 else:
-                    type_desired[vmtype] = Decimal('1.0') / len(high_user_types[user]) * config.high_priority_job_weight
+                    type_desired[vmtype] = 1.0 / len(high_user_types[user]) * config.high_priority_job_weight
         num_users = held_user_adjust + len(set(user_types.keys() + high_user_types.keys()))
         if num_users != 0:
-            num_users = Decimal('1.0') / num_users
+            num_users = 1.0 / num_users
         else:
             log.verbose("All users' jobs held, complete, or banned")
             return {}
@@ -1062,7 +1494,9 @@ class JobPool:
             vmtypes = set()
             highest_priority = new_jobs_by_users[user][0].priority
             for job in new_jobs_by_users[user]:
-                if job.job_status <= self.RUNNING and job.priority == highest_priority and not job.banned:
+                if job.priority != highest_priority:
+                    break # lists are in priority order
+                if job.job_status <= self.RUNNING and not job.banned:
                     vmtypes.add(job.uservmtype)
             if len(vmtypes) == 0: # user is held / complete
                 held_user_adjust -= 1
@@ -1072,7 +1506,9 @@ class JobPool:
             vmtypes = set()
             highest_priority = high_priority_jobs_by_users[user][0].priority
             for job in high_priority_jobs_by_users[user]:
-                if job.job_status <= self.RUNNING and job.priority == highest_priority and not job.banned:
+                if job.priority != highest_priority:
+                    break # lists are in priority order
+                if job.job_status <= self.RUNNING and not job.banned:
                     vmtypes.add(job.uservmtype)
             if len(vmtypes) == 0: # user is held / complete
                 held_user_adjust -= 1
@@ -1082,18 +1518,18 @@ class JobPool:
         for user in user_types.keys():
             for vmtype in user_types[user]:
                 if vmtype in type_desired.keys():
-                    type_desired[vmtype] += Decimal('1.0') / len(user_types[user]) * (1 / Decimal(config.high_priority_job_weight) if high_priority_jobs_by_users else 1)
+                    type_desired[vmtype] += 1.0 / len(user_types[user]) * (1.0 / config.high_priority_job_weight if high_priority_jobs_by_users else 1)
                 else:
-                    type_desired[vmtype] = Decimal('1.0') / len(user_types[user]) * (1 / Decimal(config.high_priority_job_weight) if high_priority_jobs_by_users else 1)
+                    type_desired[vmtype] = 1.0 / len(user_types[user]) * (1.0 / config.high_priority_job_weight if high_priority_jobs_by_users else 1)
         for user in high_user_types.keys():
             for vmtype in high_user_types[user]:
                 if vmtype in type_desired.keys():
-                    type_desired[vmtype] += Decimal('1.0') / len(high_user_types[user]) * config.high_priority_job_weight
+                    type_desired[vmtype] += 1.0 / len(high_user_types[user]) * config.high_priority_job_weight
                 else:
-                    type_desired[vmtype] = Decimal('1.0') / len(high_user_types[user]) * config.high_priority_job_weight
+                    type_desired[vmtype] = 1.0 / len(high_user_types[user]) * config.high_priority_job_weight
         num_users = held_user_adjust + len(set(user_types.keys() + high_user_types.keys()))
         if num_users != 0:
-            num_users = Decimal('1.0') / num_users
+            num_users = 1.0 / num_users
         else:
             log.verbose("All users' jobs held, complete, or banned")
             return {}
@@ -1117,12 +1553,7 @@ class JobPool:
 
         returns a dict of uservmtypes with their limits
         """
-        jobs = self.job_container.get_all_jobs()
-        limits = {}
-        for job in jobs:
-            if job.usertype_limit > -1:
-                limits[job.uservmtype] = job.usertype_limit
-        return limits
+        return self.job_container.get_usertype_limits()
 
 
     # Attempts to place a list of jobs into a Hold Status to prevent running
@@ -1243,6 +1674,7 @@ class JobPool:
                 if int(job.jobstarttime) > 0:
                     if job.running_vm != None:
                         job.running_vm.job_run_times.append(int(job.servertime) - int(job.jobstarttime))
+                        job.running_vm.mark_changed()
 
     ##
     ## JobPool Private methods (Support methods)
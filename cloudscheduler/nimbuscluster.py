@@ -221,11 +221,13 @@ class NimbusCluster(cluster_tools.ICluster):
                     if vm_networkassoc in self.net_slots.keys():
                         self.vm_slots -= self.net_slots[vm_networkassoc]
                         self.net_slots[vm_networkassoc] = 0 # no slots remaining
+                        self.capacity_version += 1
                 create_return = -2
             elif err_type =='NotEnoughMemory' and config.adjust_insufficient_resources:
                 with self.res_lock:
                     index = self.find_mementry(vm_mem)
                     self.memory[index] = vm_mem - 1 # may still be memory, but just not enough for this vm
+                    self.capacity_version += 1
                 create_return = -2
             elif err_type == 'ExceedMaximumWorkspaces' or err_type == 'NotAuthorized':
                 create_return = -3
@@ -690,6 +692,7 @@ class NimbusCluster(cluster_tools.ICluster):
             self.net_slots[vm.network] = remaining_net_slots
             if self.total_cpu_cores != -1:
                 self.total_cpu_cores = remaining_cores
+            self.capacity_version += 1
 
     def resource_return(self, vm):
         """Returns the resources taken by the passed in VM to the Cluster's internal
@@ -702,6 +705,7 @@ class NimbusCluster(cluster_tools.ICluster):
             if self.total_cpu_cores != -1:
                 self.total_cpu_cores += vm.cpucores
             cluster_tools.ICluster.resource_return(self, vm)
+            self.capacity_version += 1
 
     def slot_fill_ratio(self):
         """Return a ratio of how 'full' the cluster is based on used slots / total slots."""
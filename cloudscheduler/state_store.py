@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+# vim: set expandtab ts=4 sw=4:
+
+# Copyright (C) 2009 University of Victoria
+# You may distribute under the terms of either the GNU General Public
+# License or the Apache v2 License, as specified in the README file.
+
+## STATE STORE
+##
+
+##
+## IMPORTS
+##
+from __future__ import with_statement
+import copy
+import time
+import sqlite3
+import itertools
+import threading
+
+try:
+    import cPickle as pickle
+except:
+    import pickle
+
+import cloudscheduler.utilities as utilities
+
+log = utilities.get_cloudscheduler_logger()
+
+##
+## CLASSES
+##
+
+class StateStore:
+    """SQLite store of the resource pool's VMs, cluster capacity, image bans
+    and VM boot failure history, used in place of the persistence file when
+    state_store_file is set.
+
+    The store stands in for the pool's VMJournal: the VMRegistry records VM
+    changes in it, and save() writes each changed VM once per call, together
+    with the cluster capacities and any boot failures tracked since, in one
+    transaction. The database runs in WAL mode, so the info server can read
+    it while the scheduler writes."""
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS vms (
+            journal_id TEXT PRIMARY KEY,
+            cluster TEXT NOT NULL,
+            id TEXT,
+            name TEXT,
+            user TEXT,
+            vmtype TEXT,
+            status TEXT,
+            override_status TEXT,
+            hostname TEXT,
+            updated REAL,
+            state BLOB);
+        CREATE INDEX IF NOT EXISTS vms_cluster ON vms (cluster);
+        CREATE INDEX IF NOT EXISTS vms_user ON vms (user);
+        CREATE INDEX IF NOT EXISTS vms_status ON vms (status);
+        CREATE TABLE IF NOT EXISTS clusters (
+            name TEXT PRIMARY KEY,
+            cloud_type TEXT,
+            vm_slots INTEGER,
+            cpu_cores INTEGER,
+            storage INTEGER,
+            memory TEXT,
+            updated REAL,
+            state BLOB);
+        CREATE TABLE IF NOT EXISTS bans (
+            image TEXT NOT NULL,
+            cluster TEXT NOT NULL,
+            banned_at REAL,
+            PRIMARY KEY (image, cluster));
+        CREATE TABLE IF NOT EXISTS failures (
+            image TEXT NOT NULL,
+            cluster TEXT NOT NULL,
+            time REAL,
+            success INTEGER);
+        CREATE INDEX IF NOT EXISTS failures_image_cluster ON failures (image, cluster, time);
+        """
+
+    # VM attributes updated on every poll, left for the next change
+    UNJOURNALED_ATTRIBUTES = frozenset(('lastpoll', 'journal_id'))
+    # failure history older than this is dropped, checked every PRUNE_SECONDS
+    HISTORY_SECONDS = 30 * 24 * 60 * 60
+    PRUNE_SECONDS = 60 * 60
+
+    def __init__(self, path):
+        self.path = path
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.text_factory = str
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript(self.SCHEMA)
+        self.db_lock = threading.RLock()
+        self.lock = threading.Lock()
+        # journal id -> (cluster name, vm) of VMs changed since the last save
+        self.changed = {}
+        # journal id -> cluster name of VMs removed since the last save
+        self.removed = {}
+        self.new_failures = []
+        self.last_prune = 0
+        self.id_prefix = "%x" % int(time.time() * 1000)
+        self.id_counter = itertools.count()
+
+    def record(self, op, cluster_name, vm, payload=None):
+        """Note that vm was added ('add'), removed ('remove') or had an
+        attribute set ('set') on the named cluster."""
+        key = vm.__dict__.get('journal_id')
+        if key == None:
+            key = vm.__dict__['journal_id'] = "%s.%d" % (self.id_prefix, self.id_counter.next())
+        with self.lock:
+            if op == 'remove':
+                self.changed.pop(key, None)
+                self.removed[key] = cluster_name
+            else:
+                self.removed.pop(key, None)
+                self.changed[key] = (cluster_name, vm)
+
+    def record_failure(self, image, cluster_name, success):
+        """Add a VM boot attempt of image on the named cluster to the
+        failure history."""
+        with self.lock:
+            self.new_failures.append((image, cluster_name, time.time(), int(bool(success))))
+
+    def mark_dirty(self, cluster_name, vm):
+        """Note that vm changed inside one of its attributes, so it is
+        written again on the next save."""
+        self.record('set', cluster_name, vm)
+
+    def save(self, resources, vm_count, resources_lock, compact=False):
+        """Write the VMs changed since the last save, or all VMs of resources
+        if compact is set, and the cluster capacities. Does nothing if no VM
+        has changed and no boot has been tracked. The VMs are pickled holding
+        resources_lock."""
+        with self.lock:
+            changed, self.changed = self.changed, {}
+            removed, self.removed = self.removed, {}
+            new_failures, self.new_failures = self.new_failures, []
+        if not changed and not removed and not new_failures and not compact:
+            return
+        now = time.time()
+        prune = compact or now - self.last_prune > self.PRUNE_SECONDS
+        try:
+            with resources_lock:
+                if compact:
+                    changed = {}
+                    for cluster in resources:
+                        for vm in cluster.vms:
+                            vm_key = vm.__dict__.get('journal_id')
+                            if vm_key == None:
+                                vm_key = vm.__dict__['journal_id'] = "%s.%d" % \
+                                        (self.id_prefix, self.id_counter.next())
+                            changed[vm_key] = (cluster.name, vm)
+                vm_rows = [(journal_id, cluster_name, vm.id, vm.name, vm.user, vm.vmtype,
+                            vm.status, vm.override_status, vm.hostname, now,
+                            sqlite3.Binary(pickle.dumps(vm, pickle.HIGHEST_PROTOCOL)))
+                           for journal_id, (cluster_name, vm) in changed.iteritems()]
+                cluster_rows = [(cluster.name, cluster.cloud_type, cluster.vm_slots,
+                                 cluster.cpu_cores, cluster.storageGB, repr(cluster.memory), now,
+                                 sqlite3.Binary(pickle.dumps(self._without_vms(cluster),
+                                                             pickle.HIGHEST_PROTOCOL)))
+                                for cluster in resources]
+            with self.db_lock:
+                with self.db:
+                    if prune:
+                        self.db.execute("DELETE FROM failures WHERE time < ?",
+                                        (now - self.HISTORY_SECONDS,))
+                    if compact:
+                        self.db.execute("DELETE FROM vms")
+                        self.db.execute("DELETE FROM clusters")
+                    else:
+                        self.db.executemany("DELETE FROM vms WHERE journal_id = ?",
+                                            [(key,) for key in removed])
+                    self.db.executemany("INSERT OR REPLACE INTO vms VALUES (?,?,?,?,?,?,?,?,?,?,?)",
+                                        vm_rows)
+                    self.db.executemany("INSERT OR REPLACE INTO clusters VALUES (?,?,?,?,?,?,?,?)",
+                                        cluster_rows)
+                    self.db.executemany("INSERT INTO failures VALUES (?,?,?,?)", new_failures)
+            if prune:
+                self.last_prune = now
+        except:
+            log.exception("Problem saving state to %s!" % self.path)
+            with self.lock:
+                for key, cluster_name in removed.iteritems():
+                    if key not in self.changed:
+                        self.removed.setdefault(key, cluster_name)
+                for key, entry in changed.iteritems():
+                    if key not in self.removed:
+                        self.changed.setdefault(key, entry)
+                self.new_failures[:0] = new_failures
+
+    def _without_vms(self, cluster):
+        cluster = copy.copy(cluster)
+        cluster.vms = []
+        return cluster
+
+    def replay(self):
+        """Return the clusters saved last run, and the VMs of the last run
+        as a list of (cluster name, vm) pairs."""
+        with self.db_lock:
+            cluster_rows = self.db.execute("SELECT state FROM clusters").fetchall()
+            vm_rows = self.db.execute("SELECT cluster, state FROM vms ORDER BY rowid").fetchall()
+        old_resources = [pickle.loads(str(state)) for (state,) in cluster_rows]
+        persisted = [(cluster_name, pickle.loads(str(state))) for cluster_name, state in vm_rows]
+        return old_resources, persisted
+
+    def save_bans(self, banned_job_resource):
+        """Bring the bans table in line with banned_job_resource, a dict of
+        image -> list of banned cluster names."""
+        bans = set((image, cluster_name) for image, cluster_names in banned_job_resource.iteritems()
+                   for cluster_name in cluster_names)
+        try:
+            with self.db_lock:
+                with self.db:
+                    saved = set(self.db.execute("SELECT image, cluster FROM bans"))
+                    self.db.executemany("DELETE FROM bans WHERE image = ? AND cluster = ?",
+                                        saved - bans)
+                    now = time.time()
+                    self.db.executemany("INSERT INTO bans VALUES (?,?,?)",
+                                        [(image, cluster_name, now)
+                                         for image, cluster_name in bans - saved])
+        except:
+            log.exception("Problem saving bans to %s!" % self.path)
+
+    def load_failures(self, length):
+        """Return the last length boot attempts of each image on each cluster,
+        oldest first, as a dict of image -> cluster name -> [success, ...]."""
+        history = {}
+        with self.db_lock:
+            rows = self.db.execute("SELECT image, cluster, success FROM failures "
+                                   "ORDER BY image, cluster, time DESC, rowid DESC")
+            for image, cluster_name, success in rows:
+                attempts = history.setdefault(image, {}).setdefault(cluster_name, [])
+                if len(attempts) < length:
+                    attempts.append(bool(success))
+        for attempts_by_cluster in history.itervalues():
+            for attempts in attempts_by_cluster.itervalues():
+                attempts.reverse()
+        return history
+
+    def failure_history(self, image=None):
+        """Return (image, cluster, attempts, failures, last attempt time)
+        rows summarising the boot history, optionally for one image."""
+        query = ("SELECT image, cluster, COUNT(*), COUNT(*) - SUM(success), MAX(time) "
+                 "FROM failures %s GROUP BY image, cluster ORDER BY image, cluster")
+        with self.db_lock:
+            if image:
+                return self.db.execute(query % "WHERE image = ?", (image,)).fetchall()
+            return self.db.execute(query % "").fetchall()
+
+    def close(self):
+        with self.db_lock:
+            self.db.close()
@@ -8,7 +8,10 @@ import logging
 import ConfigParser
 import subprocess
 import time
+import array
 import errno
+import math
+import threading
 from urlparse import urlparse
 from datetime import datetime
 import config
@@ -67,6 +70,40 @@ def splitnstrip(sep, str):
     return [x.strip() for x in str.split(sep)];
 
 
+def intern_str(value):
+    """Return the interned copy of a str, so an attribute value repeated
+    across many parsed jobs or machines is only stored once. Values that
+    are not a plain str (None, unicode, ints) are returned unchanged."""
+    if type(value) is str:
+        return intern(value)
+    return value
+
+
+def normalise_shares(weights):
+    """Scale a dictionary of weights to float fractions of their total.
+    Returns an empty dictionary when the weights sum to zero."""
+    total = float(sum(weights.itervalues()))
+    if total == 0:
+        return {}
+    scale = 1 / total
+    return dict((key, weight * scale) for key, weight in weights.iteritems())
+
+
+def diff_distributions(current, desired, undesired=1):
+    """Subtract the desired share of each type from its current share.
+    Negative values mean more of that type is wanted; types that are
+    running but not desired at all get the value of undesired."""
+    diff = {}
+    for vmtype, share in current.iteritems():
+        if vmtype in desired:
+            diff[vmtype] = share - desired[vmtype]
+        else:
+            diff[vmtype] = undesired
+    for vmtype, share in desired.iteritems():
+        if vmtype not in current:
+            diff[vmtype] = -share
+    return diff
+
 def get_globus_path(executable="grid-proxy-init"):
     """
     Finds the path for Globus executables on the machine. 
@@ -261,7 +298,15 @@ def match_host_with_condor_host_master(hostname, condor_hostname):
     return False
 
 class CircleQueue():
-    """Represents a Circular queue of specified length."""
+    """Represents a Circular queue of specified length.
+
+    The items live in a fixed list used as a ring buffer; head is the index
+    of the oldest item, which the next append overwrites."""
+
+    # Defaults for queues unpickled from before the ring buffer
+    head = 0
+    count = None
+
     def __init__(self, length=10):
         """Initializes the new circular queue.
         
@@ -270,34 +315,42 @@ class CircleQueue():
         
         """
         self.data = [None for x in range(0, length)]
+        self.head = 0
+        self.count = 0
 
     def append(self, x):
-        """Append item to the end of the queue while removing the head."""
-        self.data.pop(0)
-        self.data.append(x)
+        """Append item to the end of the queue while removing the head.
+        Returns the removed head."""
+        if not self.data:
+            return x
+        old = self.data[self.head]
+        self.data[self.head] = x
+        self.head = (self.head + 1) % len(self.data)
+        if self.count == None:
+            self.count = self.length()
+        else:
+            self.count += (x != None) - (old != None)
+        return old
 
     def get(self):
         """Returns the queue as a list."""
-        return self.data
+        return self.data[self.head:] + self.data[:self.head]
 
     def clear(self):
         """Resets the queue to empty state filled with None values."""
         self.data = [None for x in range(0, len(self.data))]
+        self.head = 0
+        self.count = 0
 
     def min_use(self):
         """Checks the head of the queue for a None value to determine if is queue full."""
-        min_use = True
-        if self.data[0] == None:
-            min_use = False
-        return min_use
+        return bool(self.data) and self.data[self.head] != None
 
     def length(self):
         """Returns the number of non-None values to get the actual length of queue."""
-        length = 0
-        for x in self.data:
-            if x != None:
-                length += 1
-        return length
+        if self.count == None:
+            self.count = len([x for x in self.data if x != None])
+        return self.count
 
 class ErrTrackQueue(CircleQueue):
     """Error Tracking Queue - Keeps a True/False record of each VM Boot."""
@@ -305,37 +358,210 @@ class ErrTrackQueue(CircleQueue):
         """Initializes new queue with the configured length."""
         CircleQueue.__init__(self, config.ban_min_track)
         self.name = name
+        # running count of the True entries
+        self.true_count = 0
+
+    def append(self, x):
+        """Record a boot result, keeping the count of successes."""
+        old = CircleQueue.append(self, x)
+        self.true_count += bool(x) - bool(old)
+        return old
+
+    def clear(self):
+        CircleQueue.clear(self)
+        self.true_count = 0
 
     def dist_true(self):
         """Calculate the distribution of True(succuessful) starts."""
-        tc = 0
-        for x in self.data:
-            if x:
-                tc += 1
-        return (float(tc) / float(len(self.data))) if len(self.data) > 0 else 0
+        return (float(self.true_count) / float(len(self.data))) if len(self.data) > 0 else 0
 
     def dist_false(self):
         """Calculate the distribution of False(failed) starts."""
         return 1.0 - self.dist_true()
     
 class JobRunTrackQueue(CircleQueue):
-    """Job Run-[time] Tracking Queue. Keeps a list of job runtimes for  stats purposes."""
-    def __init__(self, name):
+    """Job Run-[time] Tracking Queue. Keeps a list of job runtimes for  stats purposes.
+
+    The run times are kept in an array of doubles used as a ring buffer,
+    with count of the slots filled and a running total, so appending and
+    averaging don't walk the queue."""
+    def __init__(self, name, length=10):
         """Initizlizes new queue, of length 10."""
-        CircleQueue.__init__(self, 10)
+        self.data = array.array('d', [0.0]) * length
+        self.head = 0
+        self.count = 0
+        self.total = 0.0
         self.name = name
         self.avg = 0
-        
+
+    def __setstate__(self, state):
+        """Override to convert queues pickled as a list of run times."""
+        self.__dict__.update(state)
+        if isinstance(self.data, list):
+            run_times = [x for x in self.data if x != None]
+            JobRunTrackQueue.__init__(self, self.name, len(self.data))
+            for x in run_times:
+                self.append(x)
+
+    def append(self, x):
+        """Record a run time, dropping the oldest once the queue is full.
+        Returns the dropped run time."""
+        size = len(self.data)
+        if size == 0:
+            return x
+        old = None
+        if self.count == size:
+            old = self.data[self.head]
+            self.total -= old
+        else:
+            self.count += 1
+        self.data[self.head] = x
+        self.total += x
+        self.head = (self.head + 1) % size
+        return old
+
+    def values(self):
+        """Returns the recorded run times, oldest first."""
+        ordered = self.data[self.head:] + self.data[:self.head]
+        return ordered[len(ordered) - self.count:].tolist()
+
+    def get(self):
+        """Returns the queue as a list, with None for unfilled places."""
+        return [None] * (len(self.data) - self.count) + self.values()
+
+    def clear(self):
+        self.data = array.array('d', [0.0]) * len(self.data)
+        self.head = 0
+        self.count = 0
+        self.total = 0.0
+
+    def min_use(self):
+        return len(self.data) > 0 and self.count == len(self.data)
+
+    def length(self):
+        return self.count
+
     def average(self):
         """"Returns the average run-time of jobs in the queue."""
-        total = 0
-        for x in self.data:
-            if x:
-                total += x
-        if self.length() > 0:
-            self.avg = total / self.length()
+        if self.count > 0:
+            self.avg = self.total / self.count
         return self.avg
 
+    def percentile(self, percent):
+        """Returns the nearest-rank percentile of the run-times in the
+        queue, eg. percentile(90) for the p90 run time, or 0 if empty."""
+        run_times = sorted(self.values())
+        if not run_times:
+            return 0
+        rank = int(math.ceil(percent / 100.0 * len(run_times)))
+        return run_times[min(max(rank, 1), len(run_times)) - 1]
+
+class ReadWriteLock():
+    """A lock that admits many readers at once, or a single writer.
+
+    Both sides are reentrant, and the writer may also take the read side,
+    but a reader must never ask for the write side. New readers wait while
+    a writer is waiting, so a steady stream of reads can't starve writes.
+    How long each side is waited for and held is recorded; see get_stats.
+
+    """
+    def __init__(self):
+        self.cond = threading.Condition(threading.Lock())
+        self.readers = {}       # thread ident -> [depth, acquire time]
+        self.writer = None
+        self.write_depth = 0
+        self.write_start = 0
+        self.writers_waiting = 0
+        self.stats = {'read': [0, 0.0, 0.0, 0.0], 'write': [0, 0.0, 0.0, 0.0]}
+        self.read = _LockSide(self.acquire_read, self.release_read)
+        self.write = _LockSide(self.acquire_write, self.release_write)
+
+    def _record(self, side, wait, hold):
+        # Callers must hold self.cond.
+        stats = self.stats[side]
+        stats[0] += 1
+        stats[1] += wait
+        stats[2] += hold
+        stats[3] = max(stats[3], hold)
+
+    def acquire_read(self):
+        me = threading.current_thread().ident
+        with self.cond:
+            if self.writer == me or me in self.readers:
+                if me in self.readers:
+                    self.readers[me][0] += 1
+                else:
+                    self.readers[me] = [1, None] # nested in our own write
+                return
+            start = time.time()
+            while self.writer != None or self.writers_waiting > 0:
+                self.cond.wait()
+            now = time.time()
+            self.readers[me] = [1, now]
+            self.stats['read'][1] += now - start
+
+    def release_read(self):
+        me = threading.current_thread().ident
+        with self.cond:
+            entry = self.readers[me]
+            entry[0] -= 1
+            if entry[0] == 0:
+                del self.readers[me]
+                if entry[1] != None:
+                    self._record('read', 0, time.time() - entry[1])
+                if len(self.readers) == 0:
+                    self.cond.notify_all()
+
+    def acquire_write(self):
+        me = threading.current_thread().ident
+        with self.cond:
+            if self.writer == me:
+                self.write_depth += 1
+                return
+            if me in self.readers:
+                raise RuntimeError("cannot take the write lock while holding the read lock")
+            start = time.time()
+            self.writers_waiting += 1
+            while self.writer != None or len(self.readers) > 0:
+                self.cond.wait()
+            self.writers_waiting -= 1
+            self.writer = me
+            self.write_depth = 1
+            self.write_start = time.time()
+            self.stats['write'][1] += self.write_start - start
+
+    def release_write(self):
+        with self.cond:
+            self.write_depth -= 1
+            if self.write_depth == 0:
+                self.writer = None
+                self._record('write', 0, time.time() - self.write_start)
+                self.cond.notify_all()
+
+    def get_stats(self):
+        """Returns {'read'|'write': {'acquisitions', 'wait_time', 'hold_time',
+        'max_hold_time'}}, times in seconds, counting outermost holds only."""
+        with self.cond:
+            stats = {}
+            for side, (count, wait, hold, max_hold) in self.stats.iteritems():
+                stats[side] = {'acquisitions': count, 'wait_time': wait,
+                               'hold_time': hold, 'max_hold_time': max_hold}
+            return stats
+
+class _LockSide():
+    """One side of a ReadWriteLock, usable in a with statement."""
+    def __init__(self, acquire, release):
+        self.acquire = acquire
+        self.release = release
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.release()
+        return False
+
 def check_popen_timeout(process, timeout=180):
     """ Timeout feature for subprocess.Popen - polls the process for timeout seconds waiting for it to complete
         If the process has exited return False (process did not timeout)
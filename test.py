@@ -15,6 +15,16 @@ import cloudscheduler.job_management
 import cloudscheduler.nimbus_xml
 import cloudscheduler.utilities as utilities
 
+# The timing and memory benchmarks only run when this is set, eg.
+# CLOUDSCHEDULER_BENCHMARKS=1 python test.py JobReconcileBenchmark
+RUN_BENCHMARKS = os.environ.get("CLOUDSCHEDULER_BENCHMARKS")
+
+def load_cloud_scheduler():
+    """Load the cloud_scheduler script's classes without running it."""
+    script = {'__name__': 'cloud_scheduler'}
+    execfile(os.path.join(os.path.dirname(os.path.abspath(__file__)), "cloud_scheduler"), script)
+    return script
+
 log = utilities.get_cloudscheduler_logger()
 
 held, sys.stderr = sys.stderr, StringIO() # Hide stderr
@@ -230,6 +240,92 @@ class Utilities(unittest.TestCase):
         match = match_host_with_condor_host("condor.host", "slot1@condor")
         self.assertTrue(match)
 
+    def test_err_track_queue(self):
+        from cloudscheduler.utilities import ErrTrackQueue
+
+        queue = ErrTrackQueue("cloud")
+        self.assertEqual(len(queue.get()), cloudscheduler.config.ban_min_track)
+        self.assertFalse(queue.min_use())
+        for x in range(cloudscheduler.config.ban_min_track):
+            queue.append(False)
+        self.assertTrue(queue.min_use())
+        self.assertEqual(queue.dist_false(), 1.0)
+        self.assertEqual(queue.append(True), False)
+        self.assertEqual(queue.get()[-1], True)
+        self.assertEqual(queue.true_count, 1)
+        self.assertEqual(queue.length(), cloudscheduler.config.ban_min_track)
+        queue.clear()
+        self.assertEqual(queue.dist_true(), 0)
+        self.assertEqual(queue.length(), 0)
+
+    def test_job_run_track_queue(self):
+        import pickle
+        from cloudscheduler.utilities import JobRunTrackQueue
+
+        queue = JobRunTrackQueue("Run_Times", 4)
+        self.assertEqual(queue.average(), 0)
+        self.assertEqual(queue.percentile(90), 0)
+        for run_time in [10, 20, 30]:
+            queue.append(run_time)
+        self.assertEqual(queue.get(), [None, 10, 20, 30])
+        self.assertFalse(queue.min_use())
+        self.assertEqual(queue.average(), 20)
+        for run_time in [40, 100]:
+            queue.append(run_time)
+        self.assertEqual(queue.get(), [20, 30, 40, 100])
+        self.assertEqual(queue.length(), 4)
+        self.assertEqual(queue.average(), 47.5)
+        self.assertEqual(queue.percentile(50), 30)
+        self.assertEqual(queue.percentile(90), 100)
+
+        restored = pickle.loads(pickle.dumps(queue))
+        self.assertEqual(restored.get(), [20, 30, 40, 100])
+        # Queues pickled as a list of run times still load
+        old = JobRunTrackQueue("Run_Times")
+        old.__dict__ = {'name': "Run_Times", 'avg': 0, 'data': [None] * 8 + [5, 15]}
+        restored = pickle.loads(pickle.dumps(old))
+        self.assertEqual(restored.get(), [None] * 8 + [5, 15])
+        self.assertEqual(restored.average(), 10)
+
+    def test_read_write_lock(self):
+        import threading
+        from cloudscheduler.utilities import ReadWriteLock
+
+        lock = ReadWriteLock()
+        events = []
+        def read():
+            with lock.read:
+                events.append("read")
+        def write():
+            with lock.write:
+                events.append("write")
+
+        # Readers share the lock, and the writer may re-enter and read
+        with lock.read:
+            reader = threading.Thread(target=read)
+            reader.start()
+            reader.join(5)
+            self.assertEqual(events, ["read"])
+            self.assertRaises(RuntimeError, lock.acquire_write)
+        with lock.write:
+            with lock.write:
+                with lock.read:
+                    pass
+            reader = threading.Thread(target=read)
+            writer = threading.Thread(target=write)
+            reader.start()
+            writer.start()
+            reader.join(0.2)
+            self.assertEqual(events, ["read"])
+        reader.join(5)
+        writer.join(5)
+        self.assertEqual(sorted(events), ["read", "read", "write"])
+
+        stats = lock.get_stats()
+        self.assertEqual(stats['read']['acquisitions'], 3)
+        self.assertEqual(stats['write']['acquisitions'], 2)
+        self.assertTrue(stats['write']['max_hold_time'] >= 0.2)
+
 class ResourcePoolSetup(unittest.TestCase):
 
     def setUp(self):
@@ -305,8 +401,458 @@ class ResourcePoolSetup(unittest.TestCase):
                 found_cluster1 = True
         self.assertTrue(found_cluster1)
 
+    def test_fitting_resources_memo(self):
+        from cloudscheduler.cluster_tools import VM
+
+        def fit(memory):
+            clusters = self.test_pool.get_fitting_resources("private", "x86", memory, 1, 10, "",
+                                                            "http://repo/image.img.gz", [], ['xen'], [])
+            return sorted(cluster.name for cluster in clusters)
+
+        self.assertEqual(fit(1024), [self.cloud_name0, self.cloud_name1])
+        self.assertEqual(fit(4096), [])
+        self.assertEqual(len(self.test_pool.fit_memo), 2)
+        self.assertEqual(fit(1024), [self.cloud_name0, self.cloud_name1])
+        self.assertEqual(len(self.test_pool.fit_memo), 2)
+
+        # Checking out all of example0's memory invalidates the memo
+        cluster0 = self.test_pool.get_cluster(self.cloud_name0)
+        vm = VM(name="vm0", network="private", memory=2048, mementry=0, storage=10)
+        cluster0.resource_checkout(vm)
+        self.assertEqual(fit(1024), [self.cloud_name1])
+        self.assertEqual(len(self.test_pool.fit_memo), 1)
+        cluster0.resource_return(vm)
+        self.assertEqual(fit(1024), [self.cloud_name0, self.cloud_name1])
+
+        # So do disabling a cluster and changing bans
+        cluster0.enabled = False
+        self.assertEqual(fit(1024), [self.cloud_name1])
+        self.test_pool.banned_job_resource = {"http://repo/image.img.gz": [self.cloud_name1]}
+        self.test_pool.clear_fit_memo()
+        self.assertEqual(fit(1024), [])
+
+    def test_vm_registry(self):
+        import pickle
+        from cloudscheduler.cluster_tools import VM
+
+        cluster0 = self.test_pool.get_cluster(self.cloud_name0)
+        cluster1 = self.test_pool.get_cluster(self.cloud_name1)
+        vm0 = VM(name="vm0", vmtype="t", user="alice")
+        vm1 = VM(name="vm1", vmtype="t", user="bob")
+        cluster0.vms.append(vm0)
+        cluster1.vms.append(vm1)
+
+        self.assertEqual(self.test_pool.get_num_starting_vms(), 2)
+        self.assertEqual(self.test_pool.get_starting_of_usertype("alice:t"), [vm0])
+        self.assertEqual(self.test_pool.get_user_vms("bob"), [vm1])
+        self.assertEqual(self.test_pool.get_cluster_with_vm(vm1), cluster1)
+
+        vm0.status = "Running"
+        vm0.condorname = "vm0.example.com"
+        vm0.condoraddr = "<10.0.0.1:9618>"
+        vm1.status = "Error"
+        self.assertEqual(self.test_pool.get_num_starting_vms(), 0)
+        self.assertEqual(self.test_pool.get_error_of_usertype("bob:t"), [vm1])
+        self.assertEqual(self.test_pool.find_vm_with_name("slot1@vm0.example.com"), vm0)
+        self.assertEqual(self.test_pool.find_cluster_with_vm("vm0.example.com"), (cluster0, vm0))
+        self.assertEqual(self.test_pool.find_vm_with_addr("<10.0.0.1:9618>"), vm0)
+
+        vm0.override_status = "Retiring"
+        self.assertEqual(self.test_pool.retiring_vms_of_usertype("alice:t"), [vm0])
+        self.assertEqual(self.test_pool.retiring_vms_of_type("t"), [vm0])
+
+        # A VM listed twice stays indexed until its last entry is removed
+        cluster0.vms.append(vm0)
+        cluster0.vms.remove(vm0)
+        self.assertEqual(self.test_pool.find_vm_with_addr("<10.0.0.1:9618>"), vm0)
+        self.assertEqual(self.test_pool.get_cluster_with_vm(vm0), cluster0)
+
+        cluster0.vms.remove(vm0)
+        self.assertEqual(self.test_pool.find_vm_with_name("vm0.example.com"), None)
+        self.assertEqual(self.test_pool.retiring_vms_of_usertype("alice:t"), [])
+        vm0.status = "Starting"
+        self.assertEqual(self.test_pool.get_num_starting_vms(), 0)
+
+        # VMs and clusters pickle without the registry
+        restored = pickle.loads(pickle.dumps(cluster1))
+        self.assertEqual(type(restored.vms), list)
+        self.assertFalse('_registry' in restored.vms[0].__dict__)
+
+        # Reconfiguring replaces the vms lists, and rebuilds the indexes
+        cluster0.vms = [vm0]
+        self.test_pool.vm_registry.rebuild(self.test_pool.resources)
+        self.assertEqual(self.test_pool.get_error_of_usertype("bob:t"), [vm1])
+        self.assertEqual(self.test_pool.get_num_starting_vms(), 1)
+        cluster0.vms.remove(vm0)
+        self.assertEqual(self.test_pool.get_num_starting_vms(), 0)
+
+    def test_vm_journal(self):
+        import shutil
+        from cloudscheduler.cluster_tools import VM
+        from cloudscheduler.cloud_management import VMJournal
+
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "persistence")
+        journal = VMJournal(path)
+        self.test_pool.vm_journal = journal
+        self.test_pool.vm_registry.journal = journal
+        try:
+            cluster0 = self.test_pool.get_cluster(self.cloud_name0)
+            cluster1 = self.test_pool.get_cluster(self.cloud_name1)
+            vm0 = VM(name="vm0", id="0", vmtype="t", user="alice")
+            vm1 = VM(name="vm1", id="1", vmtype="t", user="bob")
+            cluster0.vms.append(vm0)
+            cluster1.vms.append(vm1)
+
+            # The first save writes a snapshot and an empty journal
+            self.test_pool.save_persistence()
+            self.assertTrue(os.path.exists(path))
+            self.assertEqual(journal.journal_records, 0)
+            snapshot_size = os.path.getsize(path)
+
+            vm0.status = "Running"
+            vm0.hostname = "vm0.example.com"
+            vm0.lastpoll = 1
+            cluster1.vms.remove(vm1)
+            vm2 = VM(name="vm2", id="2", vmtype="t", user="bob")
+            cluster1.vms.append(vm2)
+            self.test_pool.save_persistence()
+            self.assertEqual(journal.journal_records, 4)
+            self.assertEqual(os.path.getsize(path), snapshot_size)
+
+            # Nothing changed, nothing written
+            journal_size = os.path.getsize(journal.journal_path)
+            vm0.status = "Running"
+            self.test_pool.save_persistence()
+            self.assertEqual(os.path.getsize(journal.journal_path), journal_size)
+
+            old_resources, persisted = VMJournal(path).replay()
+            self.assertEqual([(name, vm.id) for name, vm in persisted],
+                             [(self.cloud_name0, "0"), (self.cloud_name1, "2")])
+            self.assertEqual(persisted[0][1].status, "Running")
+            self.assertEqual(persisted[0][1].hostname, "vm0.example.com")
+            self.assertEqual(persisted[0][1].lastpoll, None)
+
+            # A journal written for an earlier snapshot is not replayed
+            shutil.copy(journal.journal_path, path + ".old")
+            vm0.status = "Error"
+            self.test_pool.save_persistence(compact=True)
+            self.assertEqual(journal.journal_records, 0)
+            shutil.copy(path + ".old", journal.journal_path)
+            old_resources, persisted = VMJournal(path).replay()
+            self.assertEqual(persisted[0][1].status, "Error")
+            self.assertEqual(persisted[0][1].lastpoll, 1)
+
+            # An old snapshot is only replaced once a VM is marked changed
+            vm0.lastpoll = 2
+            journal.last_snapshot -= VMJournal.COMPACT_SECONDS + 1
+            self.test_pool.save_persistence()
+            self.assertEqual(VMJournal(path).replay()[1][0][1].lastpoll, 1)
+            vm0.job_run_times.append(30)
+            vm0.mark_changed()
+            self.test_pool.save_persistence()
+            persisted_vm0 = VMJournal(path).replay()[1][0][1]
+            self.assertEqual(persisted_vm0.lastpoll, 2)
+            self.assertEqual(persisted_vm0.job_run_times.values(), [30])
+            self.assertFalse(journal.dirty)
+        finally:
+            self.test_pool.vm_registry.journal = None
+            shutil.rmtree(directory)
+
+    def test_state_store(self):
+        import time
+        import shutil
+        from cloudscheduler.cluster_tools import VM
+        from cloudscheduler.state_store import StateStore
+
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, "state.sqlite")
+        store = StateStore(path)
+        self.test_pool.state_store = store
+        self.test_pool.vm_journal = store
+        self.test_pool.vm_registry.journal = store
+        try:
+            self.assertEqual(store.db.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+            cluster0 = self.test_pool.get_cluster(self.cloud_name0)
+            cluster1 = self.test_pool.get_cluster(self.cloud_name1)
+            vm0 = VM(name="vm0", id="0", vmtype="t", user="alice")
+            vm1 = VM(name="vm1", id="1", vmtype="t", user="bob")
+            cluster0.vms.append(vm0)
+            cluster1.vms.append(vm1)
+            self.test_pool.save_persistence()
+            vm0.status = "Running"
+            cluster1.vms.remove(vm1)
+            self.test_pool.save_persistence()
+
+            self.assertEqual(store.db.execute("SELECT id, status FROM vms").fetchall(),
+                             [("0", "Running")])
+            # A VM changed inside an attribute is written again once marked
+            vm0.job_run_times.append(30)
+            self.test_pool.save_persistence()
+            self.assertEqual(StateStore(path).replay()[1][0][1].job_run_times.values(), [])
+            vm0.mark_changed()
+            self.test_pool.save_persistence()
+            self.assertEqual(StateStore(path).replay()[1][0][1].job_run_times.values(), [30])
+            old_resources, persisted = StateStore(path).replay()
+            self.assertEqual(sorted(cluster.name for cluster in old_resources),
+                             sorted([self.cloud_name0, self.cloud_name1]))
+            self.assertEqual([cluster.vms for cluster in old_resources], [[], []])
+            self.assertEqual([(name, vm.id, vm.status) for name, vm in persisted],
+                             [(self.cloud_name0, "0", "Running")])
+
+            self.test_pool.banned_job_resource = {"img": [self.cloud_name0]}
+            store.save_bans(self.test_pool.banned_job_resource)
+            self.test_pool.banned_job_resource = {"img": [self.cloud_name1]}
+            store.save_bans(self.test_pool.banned_job_resource)
+            self.assertEqual(store.db.execute("SELECT image, cluster FROM bans").fetchall(),
+                             [("img", self.cloud_name1)])
+
+            for success in [True, False, False]:
+                store.record_failure("img", self.cloud_name0, success)
+            self.test_pool.save_persistence()
+            self.assertEqual(store.load_failures(2), {"img": {self.cloud_name0: [False, False]}})
+            self.assertEqual([row[:4] for row in store.failure_history("img")],
+                             [("img", self.cloud_name0, 3, 2)])
+            self.test_pool.load_failure_history()
+            self.assertEqual(self.test_pool.failures["img"][self.cloud_name0].dist_false(), 0.8)
+
+            # Old boot history is pruned once PRUNE_SECONDS have passed
+            with store.db:
+                store.db.execute("INSERT INTO failures VALUES (?,?,?,?)",
+                                 ("old", self.cloud_name1, time.time() - StateStore.HISTORY_SECONDS - 1, 0))
+            store.record_failure("img", self.cloud_name1, True)
+            self.test_pool.save_persistence()
+            self.assertEqual(store.db.execute("SELECT COUNT(*) FROM failures WHERE image = 'old'").fetchone(), (1,))
+            store.last_prune -= StateStore.PRUNE_SECONDS + 1
+            store.record_failure("img", self.cloud_name1, True)
+            self.test_pool.save_persistence()
+            self.assertEqual(store.db.execute("SELECT COUNT(*) FROM failures WHERE image = 'old'").fetchone(), (0,))
+            self.assertEqual(store.load_failures(5)["img"][self.cloud_name1], [True, True])
+
+            # The last attempts of each image and cluster, oldest first
+            for success in [False, True, False, False, True]:
+                store.record_failure("img2", self.cloud_name0, success)
+                store.record_failure("img2", self.cloud_name1, not success)
+            self.test_pool.save_persistence()
+            history = store.load_failures(3)
+            self.assertEqual(history["img2"], {self.cloud_name0: [False, False, True],
+                                               self.cloud_name1: [True, True, False]})
+            self.assertEqual(history["img"][self.cloud_name0], [True, False, False])
+        finally:
+            self.test_pool.vm_registry.journal = None
+            store.close()
+            shutil.rmtree(directory)
+
+    def test_track_failures(self):
+        from cloudscheduler.job_management import Job
+
+        job = Job(GlobalJobId="job#1", Owner="alice", JobStatus=1, VMLoc="http://images/img")
+        clusters = [self.test_pool.get_cluster(self.cloud_name0),
+                    self.test_pool.get_cluster(self.cloud_name1)]
+        ban_file = cloudscheduler.config.ban_file
+        (fd, cloudscheduler.config.ban_file) = tempfile.mkstemp()
+        os.close(fd)
+        try:
+            for x in range(cloudscheduler.config.ban_min_track):
+                self.test_pool.track_failures(job, clusters, False)
+            self.test_pool.track_failures(job, clusters[1:], True)
+            self.assertEqual(sorted(self.test_pool.failures["http://images/img"].keys()),
+                             sorted([self.cloud_name0, self.cloud_name1]))
+            self.test_pool.check_failures()
+            self.assertEqual(self.test_pool.banned_job_resource,
+                             {"http://images/img": [self.cloud_name0]})
+            self.assertEqual(self.test_pool.failures_changed, set())
+        finally:
+            os.remove(cloudscheduler.config.ban_file)
+            cloudscheduler.config.ban_file = ban_file
+
+    def test_incremental_reconfig(self):
+        from cloudscheduler.cluster_tools import VM, VMList
+
+        cluster0 = self.test_pool.get_cluster(self.cloud_name0)
+        cluster1 = self.test_pool.get_cluster(self.cloud_name1)
+        vm0 = VM(name="vm0", id="0", vmtype="t", user="alice", memory=512, storage=10)
+        vm0.network = self.networks0
+        cluster0.resource_checkout(vm0)
+        cluster0.vms.append(vm0)
+        vm1 = VM(name="vm1", id="1", vmtype="t", user="bob", memory=512, storage=10)
+        vm1.network = self.networks1
+        cluster1.resource_checkout(vm1)
+        cluster1.vms.append(vm1)
+
+        # Nothing changed, so nothing is rebuilt
+        self.test_pool.setup()
+        self.assertTrue(self.test_pool.get_cluster(self.cloud_name0) is cluster0)
+        self.assertTrue(self.test_pool.get_cluster(self.cloud_name1) is cluster1)
+        self.assertEqual(cluster0.vm_slots, self.vm_slots0 - 1)
+
+        # A capacity change is applied in place, anything else rebuilds
+        testconfig = ConfigParser.RawConfigParser()
+        testconfig.read(self.configfilename)
+        testconfig.set(self.cloud_name0, 'vm_slots', self.vm_slots0 + 20)
+        testconfig.set(self.cloud_name0, 'memory', self.memory0 + 1024)
+        testconfig.set(self.cloud_name1, 'host', "other.example.com")
+        configfile = open(self.configfilename, 'wb')
+        testconfig.write(configfile)
+        configfile.close()
+        self.test_pool.setup()
+
+        self.assertTrue(self.test_pool.get_cluster(self.cloud_name0) is cluster0)
+        self.assertEqual(cluster0.vm_slots, self.vm_slots0 + 20 - 1)
+        self.assertEqual(cluster0.net_slots, {self.networks0: self.vm_slots0 + 20 - 1})
+        self.assertEqual(cluster0.memory, [self.memory0 + 1024 - 512])
+        self.assertEqual(cluster0.max_slots, self.vm_slots0 + 20)
+        self.assertEqual(self.test_pool.get_cluster_with_vm(vm0), cluster0)
+        new_cluster1 = self.test_pool.get_cluster(self.cloud_name1)
+        self.assertFalse(new_cluster1 is cluster1)
+        self.assertEqual(new_cluster1.network_address, "other.example.com")
+        # The rebuilt cluster's VMs are indexed by the time it is in resources
+        self.assertTrue(isinstance(new_cluster1.vms, VMList))
+        self.assertEqual(self.test_pool.get_cluster_with_vm(vm1), new_cluster1)
+        self.assertEqual(self.test_pool.get_user_vms("bob"), [vm1])
+        self.assertEqual([cluster.name for cluster in self.test_pool.resources],
+                         [self.cloud_name0, self.cloud_name1])
+
+    def test_vm_counters(self):
+        from cloudscheduler.cluster_tools import VM
+
+        cluster0 = self.test_pool.get_cluster(self.cloud_name0)
+        cluster1 = self.test_pool.get_cluster(self.cloud_name1)
+        vm0 = VM(name="vm0", vmtype="t", user="alice", cpucores=4, job_per_core=True)
+        vm1 = VM(name="vm1", vmtype="t", user="alice", cpucores=4)
+        vm2 = VM(name="vm2", vmtype="u", user="bob")
+        cluster0.vms.extend([vm0, vm1])
+        cluster1.vms.append(vm2)
+        self.test_pool.user_vm_limits = {"alice": 2, "bob": 2}
+
+        self.assertEqual(self.test_pool.get_vm_count_user("alice"), 2)
+        self.assertTrue(self.test_pool.user_at_limit("alice"))
+        self.assertFalse(self.test_pool.user_at_limit("bob"))
+        self.assertEqual(dict(self.test_pool.get_vmtypes_count_internal()),
+                         {"alice:t": 2, "bob:u": 1})
+        self.assertEqual(dict(self.test_pool.get_vmtypes_count_cpu_slots()),
+                         {"alice:t": 5, "bob:u": 1})
+        self.assertTrue(self.test_pool.uservmtype_at_limit("alice:t", 2))
+        self.assertFalse(self.test_pool.uservmtype_at_limit("bob:u", -1))
+        self.assertFalse(self.test_pool.uservmtype_at_limit("carol:t", 0))
+
+        vm1.job_per_core = True
+        self.assertEqual(self.test_pool.get_vmtypes_count_cpu_slots()["alice:t"], 8)
+        cluster0.vms.remove(vm0)
+        self.assertEqual(self.test_pool.get_vm_count_user("alice"), 1)
+        self.assertFalse(self.test_pool.user_at_limit("alice"))
+        self.assertEqual(dict(self.test_pool.get_vmtypes_count_cpu_slots()),
+                         {"alice:t": 4, "bob:u": 1})
+
+    def test_fair_share_state(self):
+        from cloudscheduler.cluster_tools import VM
+
+        class JobPoolDistribution:
+            calls = 0
+            def job_type_distribution(self):
+                self.calls += 1
+                return {"alice:t": 0.25, "bob:u": 0.25, "carol:v": 0.5}
+            def get_usertype_limits(self):
+                return {}
+
+        job_pool = JobPoolDistribution()
+        cluster0 = self.test_pool.get_cluster(self.cloud_name0)
+        cluster0.vms.extend([VM(name="vm0", vmtype="t", user="alice"),
+                             VM(name="vm1", vmtype="u", user="bob")])
+        self.test_pool.user_vm_limits = {"bob": 1}
+
+        fair_share = self.test_pool.refresh_fair_share(job_pool)
+        self.assertEqual(fair_share.generation, 1)
+        self.assertEqual(fair_share.current_types, {"alice:t": 0.5, "bob:u": 0.5})
+        self.assertEqual(fair_share.unlimited_diff_types, {"alice:t": 0.25, "bob:u": 0.25, "carol:v": -0.5})
+        # bob is at the user limit, so bob:u is left out of the redistribution
+        self.assertEqual(fair_share.limited_users, ["bob:u"])
+        self.assertEqual(fair_share.diff_types, fair_share.unlimited_diff_types)
+
+        # Readers share the snapshot until the next refresh
+        self.assertTrue(self.test_pool.get_fair_share(job_pool) is fair_share)
+        self.assertEqual(job_pool.calls, 1)
+        self.assertEqual(self.test_pool.refresh_fair_share(job_pool).generation, 2)
+        self.assertEqual(self.test_pool.get_fair_share(job_pool, max_age=-1).generation, 3)
+
+    def test_scheduler_fair_share(self):
+        from cloudscheduler.job_management import Job, JobPool
+
+        script = load_cloud_scheduler()
+        job_pool = JobPool("testpool", condor_query_type="local")
+        # A pending job with a VM type limit, on a network no cluster has
+        job_pool.add_new_job(Job(GlobalJobId="job1", Owner="alice", JobStatus=1, VMType="t",
+                                 VMNetwork="nowhere", VMTypeLimit=2))
+        scheduler = script['Scheduler'](self.test_pool, job_pool)
+        scheduler.scheduler_fair_share()
+        job = job_pool.job_container.get_job_by_id("job1")
+        self.assertEqual(job.status, Job.UNSCHEDULED)
+        self.assertEqual(self.test_pool.vm_count(), 0)
+
+    def test_clean_scheduled_unscheduled(self):
+        from cloudscheduler.cluster_tools import VM
+        from cloudscheduler.job_management import Job, JobPool
+
+        script = load_cloud_scheduler()
+        job_pool = JobPool("testpool", condor_query_type="local")
+        running = Job(GlobalJobId="run1", Owner="alice", JobStatus=2, VMType="t")
+        idle = [Job(GlobalJobId="idle%d" % i, Owner="alice", JobStatus=1, VMType="t")
+                for i in range(2)]
+        for job in [running] + idle:
+            job_pool.add_new_job(job)
+        for job in idle:
+            job_pool.schedule(job)
+        cluster0 = self.test_pool.get_cluster(self.cloud_name0)
+        cluster0.vms.extend([VM(name="vm%d" % i, vmtype="t", user="alice") for i in range(2)])
+
+        # Three jobs want alice:t but there are only two VMs of it, so one
+        # idle job is unscheduled and the running job is scheduled
+        cleanup = script['Cleanup'](self.test_pool, job_pool)
+        cleanup.clean_scheduled_unscheduled()
+        self.assertEqual(running.status, Job.SCHEDULED)
+        self.assertEqual(sorted(job.status for job in idle), [Job.SCHEDULED, Job.UNSCHEDULED])
+        self.assertEqual(len(job_pool.job_container.get_scheduled_jobs()), 2)
+
+    def test_distribution_matches_decimal(self):
+        from decimal import Decimal
+        from cloudscheduler.cluster_tools import VM
+
+        cluster0 = self.test_pool.get_cluster(self.cloud_name0)
+        vms = []
+        for i in xrange(1000):
+            vms.append(VM(name="vm%d" % i, vmtype="type%d" % (i % 50), user="user%d" % (i % 5),
+                          memory=512 * (1 + i % 4), cpucores=1 + i % 2, storage=10 * (i % 3)))
+        cluster0.vms.extend(vms)
+
+        # Reference result: the per-VM scan in Decimal the distribution replaced
+        usage = {}
+        for vm in vms:
+            totals = usage.setdefault(vm.uservmtype, [0, 0, 0])
+            totals[0] += vm.memory
+            totals[1] += vm.cpucores
+            totals[2] += vm.storage
+        total = sum(Decimal(mem * cpu) for mem, cpu, storage in usage.itervalues())
+
+        current = self.test_pool.vmtype_mem_cpu_distribution()
+        vmcount = self.test_pool.get_vmtypes_count_internal()
+        simulated = self.test_pool.vmtype_mem_cpu_distribution(vmcount)
+        slots = self.test_pool.vmtype_slot_distribution()
+        storage = self.test_pool.vmtype_mem_cpu_storage_distribution()
+
+        self.assertEqual(len(current), 50)
+        for uservmtype, (mem, cpu, storage_used) in usage.iteritems():
+            self.assertAlmostEqual(current[uservmtype], float(Decimal(mem * cpu) / total))
+        self.assertAlmostEqual(sum(simulated.itervalues()), 1.0)
+        self.assertAlmostEqual(sum(slots.itervalues()), 1.0)
+        self.assertAlmostEqual(sum(storage.itervalues()), 1.0)
+
 
     def tearDown(self):
+        # ResourcePool.resources is shared between pools, so don't leave
+        # test VMs behind for the next pool's setup to destroy
+        for cluster in self.test_pool.resources:
+            for vm in list(cluster.vms):
+                cluster.vms.remove(vm)
         os.remove(self.configfilename)
 
 class NimbusXMLTests(unittest.TestCase):
@@ -816,6 +1362,111 @@ CanHibernate = true
         self.assertEqual("hermes-xen188", two_machines[0]["Name"])
         self.assertEqual("hermes-xen199", two_machines[1]["Name"])
 
+    def test_vm_machine_stream(self):
+        from cloudscheduler.cloud_management import ResourcePool, VMMachine
+
+        condor_status = """Name = "slot1@vm1.example.com"
+Machine = "vm1.example.com"
+State = "Claimed"
+Activity = "Busy"
+VMType = "testtype"
+Memory = 2048
+RemoteOwner = "user@example.com"
+
+Name = "slot2@vm1.example.com"
+Machine = "vm1.example.com"
+State = "Unclaimed"
+Activity = "Idle"
+
+Name = "nomachine"
+
+"""
+        (status_fd, status_filename) = tempfile.mkstemp()
+        os.write(status_fd, condor_status)
+        os.close(status_fd)
+        try:
+            classads = list(ResourcePool._condor_status_popen("cat %s" % status_filename,
+                                                              VMMachine.CONDOR_ATTRIBUTES.values()))
+        finally:
+            os.remove(status_filename)
+        self.assertEqual(len(classads), 3)
+        # Attributes VMMachine doesn't use are dropped while reading
+        self.assertFalse('Memory' in classads[0])
+
+        vm_machines = list(ResourcePool._classads_to_vmmachines(classads,
+                                                                {'vm1.example.com': '<10.0.0.1:40000>'}))
+        self.assertEqual([machine.name for machine in vm_machines],
+                         ['slot1@vm1.example.com', 'slot2@vm1.example.com'])
+        self.assertEqual(vm_machines[0].remote_owner, 'user@example.com')
+        self.assertEqual(vm_machines[1].address_master, '<10.0.0.1:40000>')
+        self.assertEqual(vm_machines[1].current_time, -1)
+        self.assertEqual(list(ResourcePool._condor_status_popen("false", ['Name'])), [])
+
+    def test_machinelist_to_vmmachinelist(self):
+        from cloudscheduler.cloud_management import ResourcePool
+
+        machines = [{'Name': 'slot1@vm1.example.com', 'Machine': 'vm1.example.com',
+                     'State': 'Claimed', 'Activity': 'Busy', 'VMType': 'testtype',
+                     'MyCurrentTime': '1000', 'RemoteOwner': 'user'}]
+        masters = [{'Machine': 'vm1.example.com', 'MasterIpAddr': '<10.0.0.1:40000>'}]
+        vm_machines = ResourcePool.machinelist_to_vmmachinelist(machines, masters)
+        self.assertEqual(len(vm_machines), 1)
+        self.assertEqual(vm_machines[0].name, 'slot1@vm1.example.com')
+        self.assertEqual(vm_machines[0].state, 'Claimed')
+        self.assertEqual(vm_machines[0].current_time, '1000')
+        self.assertEqual(vm_machines[0].entered_state_time, -1)
+        self.assertEqual(vm_machines[0].address_master, '<10.0.0.1:40000>')
+
+        cloudscheduler.config.condor_query_projection = True
+        try:
+            condor_status = ResourcePool._condor_status_command("condor_status -master -l", ('Machine', 'MasterIpAddr'))
+        finally:
+            cloudscheduler.config.condor_query_projection = False
+        self.assertEqual(condor_status, ['condor_status', '-master', '-l', '-attributes', 'Machine,MasterIpAddr'])
+
+    def test_machine_index(self):
+        from cloudscheduler.cloud_management import MachineIndex, VMMachine
+        from cloudscheduler.utilities import match_host_with_condor_host
+        from cloudscheduler.utilities import match_host_with_condor_host_master
+
+        names = ["vm1.example.com", "slot1@vm2.example.com", "slot2@vm2.example.com",
+                 "vm3.other.org", "10.0.0.4", "slot1@10.0.0.5", "vm6"]
+        machines = [VMMachine(machine_name=name) for name in names]
+        index = MachineIndex(machines)
+        hostnames = ["vm1.example.com", "vm1", "vm2.example.com", "vm2.other.org", "vm3",
+                     "10.0.0.4", "10.0.0.5", "10.9.9.9", "slot3@vm6.example.com", "vm7.example.com"]
+        for hostname in hostnames:
+            expected = None
+            expected_master = None
+            for machine in machines:
+                if expected == None and (match_host_with_condor_host(hostname, machine.machine_name) or
+                                         match_host_with_condor_host_master(hostname, machine.machine_name)):
+                    expected = machine
+                if expected_master == None and match_host_with_condor_host_master(hostname, machine.machine_name):
+                    expected_master = machine
+            self.assertTrue(index.match(hostname) is expected, hostname)
+            self.assertTrue(index.match(hostname, master_only=True) is expected_master, hostname)
+
+    def test_machine_index_find(self):
+        from cloudscheduler.cloud_management import MachineIndex, VMMachine
+
+        machines = []
+        for i in xrange(40):
+            machines.append(VMMachine(name="slot%d@vm%d" % (i % 4, i / 4), machine_name="vm%d" % (i / 4),
+                                      state=("Claimed", "Unclaimed")[i % 2],
+                                      activity=("Busy", "Idle", "Retiring")[i % 3],
+                                      vmtype="type%d" % (i % 5), remote_owner="user%d" % (i % 2)))
+        index = MachineIndex(machines)
+        queries = [{'vmtype': 'type1', 'state': 'Unclaimed', 'activity': 'Idle'},
+                   {'machine_name': 'vm3'}, {'vmtype': 'type2', 'remote_owner': 'user0'},
+                   {'state': 'Claimed'}, {'VMType': 'type1'}, {}]
+        for criteria in queries:
+            expected = [machine for machine in machines
+                        if all(hasattr(machine, key) and getattr(machine, key) == value
+                               for key, value in criteria.iteritems())]
+            self.assertEqual(index.find(criteria), expected)
+        self.assertEqual(len(index.find({'machine_name': 'vm3'})), 4)
+
     def test_condorxml_to_native_empty_list(self):
 
         from cloudscheduler.cloud_management import ResourcePool
@@ -2287,6 +2938,454 @@ xmlns:condor="urn:condor">
         job_pool = cloudscheduler.job_management.JobPool("testpool", condor_query_type="soap")
         self.assertEqual(job_pool.job_query, job_pool.job_query_SOAP)
 
+    def test_condor_q_stream_to_jobs(self):
+        from cloudscheduler.job_management import JobPool
+
+        condor_q_lines = iter(["\n",
+            "-- Submitter: canfarpool.phys.uvic.ca : <142.104.63.28:8080> : canfarpool.phys.uvic.ca\n",
+            'GlobalJobId = "canfarpool.phys.uvic.ca#245.698#1282577354"\n',
+            'Owner = "sharon"\n',
+            'Requirements = ( VMType =?= "canfarbase_seb" && Arch == "INTEL" )\n',
+            "\n",
+            'GlobalJobId = "canfarpool.phys.uvic.ca#245.699#1282577354"\n',
+            'Owner = "sharon"\n',
+            'JobStatus = 2\n'])
+        jobs = JobPool._condor_q_stream_to_jobs(condor_q_lines)
+        first_job = jobs.next()
+        self.assertEqual(first_job.id, "canfarpool.phys.uvic.ca#245.698#1282577354")
+        self.assertEqual(first_job.req_vmtype, "canfarbase_seb")
+        second_job = jobs.next()
+        self.assertEqual(second_job.id, "canfarpool.phys.uvic.ca#245.699#1282577354")
+        self.assertEqual(second_job.job_status, 2)
+        self.assertRaises(StopIteration, jobs.next)
+
+    def test_condor_q_known_jobs_status_only(self):
+        from cloudscheduler.job_management import Job, JobPool, JobStatusUpdate
+
+        condor_q_lines = ['GlobalJobId = "known#1"\n',
+            'Owner = "sharon"\n',
+            'JobStatus = 2\n',
+            'RemoteHost = "slot1@vm.example.com"\n',
+            'ServerTime = 1282683010\n',
+            'JobStartDate = 1282683000\n',
+            "\n",
+            'GlobalJobId = "new#2"\n',
+            'Owner = "sharon"\n',
+            'JobStatus = 1\n']
+        jobs = list(JobPool._condor_q_stream_to_jobs(condor_q_lines, set(["known#1"])))
+        self.assertTrue(isinstance(jobs[0], JobStatusUpdate))
+        self.assertEqual(jobs[0].id, "known#1")
+        self.assertEqual(jobs[0].job_status, 2)
+        self.assertEqual(jobs[0].remote_host, "slot1@vm.example.com")
+        self.assertEqual(jobs[0].servertime, "1282683010")
+        self.assertEqual(jobs[0].jobstarttime, "1282683000")
+        self.assertTrue(isinstance(jobs[1], Job))
+        self.assertEqual(jobs[1].user, "sharon")
+
+        job_pool = JobPool("testpool", condor_query_type="local")
+        job_pool.update_jobs(iter([Job(GlobalJobId="known#1", Owner="sharon", JobStatus=1)]))
+        job_pool.update_jobs(iter(jobs))
+        known_job = job_pool.job_container.get_job_by_id("known#1")
+        self.assertEqual(known_job.job_status, 2)
+        self.assertEqual(known_job.jobstarttime, 1282683000)
+        self.assertTrue(job_pool.job_container.has_job("new#2"))
+
+    def test_condor_q_projection(self):
+        from cloudscheduler.job_management import JobPool, JOB_CLASSAD_ATTRIBUTES
+
+        saved_command = cloudscheduler.config.condor_q_command
+        cloudscheduler.config.condor_q_command = "condor_q -l"
+        cloudscheduler.config.condor_query_projection = True
+        try:
+            job_pool = JobPool("testpool", condor_query_type="local")
+            condor_q = job_pool._condor_q_command("JobStatus == 1")
+        finally:
+            cloudscheduler.config.condor_q_command = saved_command
+            cloudscheduler.config.condor_query_projection = False
+        self.assertFalse("-l" in condor_q)
+        self.assertEqual(condor_q[1:3], ["-constraint", "JobStatus == 1"])
+        self.assertEqual(condor_q[3], "-af:lrng")
+        self.assertEqual(condor_q[4:], JOB_CLASSAD_ATTRIBUTES)
+        self.assertTrue("GlobalJobId" in JOB_CLASSAD_ATTRIBUTES)
+        self.assertTrue("Requirements" in JOB_CLASSAD_ATTRIBUTES)
+
+        # -af:l prints attributes missing from the job as undefined
+        condor_q_af = ['GlobalJobId = "canfarpool.phys.uvic.ca#245.698#1282577354"\n',
+            'Owner = "sharon"\n',
+            'VMMem = undefined\n',
+            'Requirements = ( VMType =?= "canfarbase_seb" )\n',
+            '\n']
+        job = list(JobPool._condor_q_stream_to_jobs(condor_q_af))[0]
+        self.assertEqual(job.req_vmtype, "canfarbase_seb")
+        self.assertEqual(job.req_memory, cloudscheduler.config.default_VMMem)
+
+    def test_multiple_schedd_query(self):
+        from cloudscheduler.job_management import Job, JobPool
+
+        # A fake condor_q: schedA answers straight away, schedB hangs
+        (script_fd, script_name) = tempfile.mkstemp()
+        os.write(script_fd, """#!/bin/sh
+case "$*" in
+  *schedA*) printf 'GlobalJobId = "schedA#1.0#1"\\nOwner = "user"\\nJobStatus = 1\\n' ;;
+  *) exec sleep 5 ;;
+esac
+""")
+        os.close(script_fd)
+        os.chmod(script_name, 0700)
+        saved_command = cloudscheduler.config.condor_q_command
+        cloudscheduler.config.condor_q_command = "%s -l" % script_name
+        cloudscheduler.config.condor_schedds = ["schedA", "schedB"]
+        cloudscheduler.config.condor_q_timeout = 1
+        try:
+            job_pool = JobPool("testpool", condor_query_type="local")
+            self.assertEqual(job_pool.job_query, job_pool.job_query_local_schedds)
+            # A job schedB reported last time must survive schedB timing out
+            job_pool.job_container.add_job(Job(GlobalJobId="schedB#1.0#1", Owner="user", JobStatus=1))
+            job_pool.schedd_job_ids["schedB"] = set(["schedB#1.0#1"])
+            job_pool.update_jobs(job_pool.job_query())
+            self.assertTrue(job_pool.job_container.has_job("schedA#1.0#1"))
+            self.assertTrue(job_pool.job_container.has_job("schedB#1.0#1"))
+            self.assertEqual(job_pool.schedd_job_ids["schedA"], set(["schedA#1.0#1"]))
+        finally:
+            cloudscheduler.config.condor_q_command = saved_command
+            cloudscheduler.config.condor_schedds = []
+            cloudscheduler.config.condor_q_timeout = 600
+            os.remove(script_name)
+
+    def test_schedd_query_stop(self):
+        import Queue
+        from cloudscheduler.job_management import JobPool, ScheddQuery
+
+        saved_command = cloudscheduler.config.condor_q_command
+        cloudscheduler.config.condor_q_command = "sh -c 'exec sleep 5' -l"
+        try:
+            job_pool = JobPool("testpool", condor_query_type="local")
+            # Stopped before condor_q starts: it is killed as soon as it does
+            job_queue = Queue.Queue(1)
+            query = ScheddQuery(job_pool, "schedA", job_queue)
+            query.stop()
+            query.start()
+            query.join(3)
+            self.assertFalse(query.isAlive())
+            self.assertFalse(query.succeeded)
+            self.assertNotEqual(query.process.poll(), None)
+            self.assertTrue(job_queue.empty())
+        finally:
+            cloudscheduler.config.condor_q_command = saved_command
+
+    def test_schedd_query_abandoned(self):
+        import Queue
+        from cloudscheduler.job_management import JobPool, ScheddQuery
+
+        # A fake condor_q printing more jobs than the queue holds
+        (script_fd, script_name) = tempfile.mkstemp()
+        os.write(script_fd, """#!/bin/sh
+for i in 1 2 3 4 5; do
+  printf 'GlobalJobId = "%s#%d.0#1"\\nOwner = "user"\\nJobStatus = 1\\n\\n' "$3" $i
+done
+exec sleep 5
+""")
+        os.close(script_fd)
+        os.chmod(script_name, 0700)
+        saved_command = cloudscheduler.config.condor_q_command
+        cloudscheduler.config.condor_q_command = "%s -l" % script_name
+        try:
+            job_pool = JobPool("testpool", condor_query_type="local")
+            job_queue = Queue.Queue(1)
+            queries = [ScheddQuery(job_pool, schedd, job_queue) for schedd in ["schedA", "schedB"]]
+            jobs = job_pool._schedd_query_jobs(queries, job_queue, set())
+            jobs.next()
+            # Closing the jobs early stops both queries
+            jobs.close()
+            for query in queries:
+                query.join(3)
+                self.assertTrue(query.stopped)
+                self.assertFalse(query.isAlive())
+        finally:
+            cloudscheduler.config.condor_q_command = saved_command
+            os.remove(script_name)
+
+    def test_update_jobs_from_generator(self):
+        from cloudscheduler.job_management import Job, JobPool, JobQueryError
+
+        job_pool = JobPool("testpool", condor_query_type="local")
+        def _query():
+            yield Job(GlobalJobId="job1", Owner="user", JobStatus=1)
+            yield Job(GlobalJobId="job2", Owner="user", JobStatus=4)
+        job_pool.update_jobs(_query())
+        self.assertTrue(job_pool.job_container.has_job("job1"))
+        self.assertFalse(job_pool.job_container.has_job("job2"))
+
+        # A query that fails part way through must not change any jobs
+        def _failed_query():
+            yield Job(GlobalJobId="job3", Owner="user", JobStatus=1)
+            raise JobQueryError("condor_q died")
+        job_pool.update_jobs(_failed_query())
+        self.assertTrue(job_pool.job_container.has_job("job1"))
+        self.assertFalse(job_pool.job_container.has_job("job3"))
+
+        job_pool.update_jobs(iter([Job(GlobalJobId="job1", Owner="user", JobStatus=2),
+                                   Job(GlobalJobId="job3", Owner="user", JobStatus=1)]))
+        self.assertEqual(job_pool.job_container.get_job_by_id("job1").job_status, 2)
+        job_pool.update_jobs(iter([Job(GlobalJobId="job3", Owner="user", JobStatus=2)]))
+        self.assertFalse(job_pool.job_container.has_job("job1"))
+        self.assertEqual(job_pool.job_container.get_job_by_id("job3").job_status, 2)
+
+    def test_update_jobs_add_update_remove(self):
+        from cloudscheduler.job_management import Job, JobPool
+
+        job_pool = JobPool("testpool", condor_query_type="local")
+        job_pool.update_jobs(iter([Job(GlobalJobId="job%d" % i, Owner="user%d" % (i % 3), JobStatus=1)
+                                   for i in range(100)]))
+        self.assertEqual(len(job_pool.job_container.get_all_jobs()), 100)
+
+        # Drop the first ten jobs, start the next ten and add ten new ones
+        jobs = [Job(GlobalJobId="job%d" % i, Owner="user%d" % (i % 3), JobStatus=2 if i < 20 else 1)
+                for i in range(10, 110)]
+        job_pool.update_jobs(iter(jobs))
+        container = job_pool.job_container
+        self.assertEqual(len(container.get_all_jobs()), 100)
+        for i in range(10):
+            self.assertFalse(container.has_job("job%d" % i))
+        for i in range(10, 20):
+            self.assertEqual(container.get_job_by_id("job%d" % i).job_status, 2)
+        for i in range(20, 110):
+            self.assertEqual(container.get_job_by_id("job%d" % i).job_status, 1)
+
+    def test_incremental_job_query(self):
+        from cloudscheduler.job_management import JobPool
+
+        # A fake condor_q: the id listing reports job1 (running) and job2
+        # (idle); a constrained query only returns job2, a full one both.
+        (script_fd, script_name) = tempfile.mkstemp()
+        os.write(script_fd, """#!/bin/sh
+case "$*" in
+  *-format*) printf 'job1 2 1000\\njob2 1 1000\\n' ;;
+  *-constraint*) printf 'GlobalJobId = "job2"\\nOwner = "user"\\nJobStatus = 1\\n' ;;
+  *) printf 'GlobalJobId = "job1"\\nOwner = "user"\\nJobStatus = 2\\n\\nGlobalJobId = "job2"\\nOwner = "user"\\nJobStatus = 1\\n' ;;
+esac
+""")
+        os.close(script_fd)
+        os.chmod(script_name, 0700)
+        saved_command = cloudscheduler.config.condor_q_command
+        cloudscheduler.config.condor_q_command = "%s -l" % script_name
+        try:
+            job_pool = JobPool("testpool", condor_query_type="local")
+            # First poll has no watermark so fetches the whole queue
+            job_pool.update_jobs(job_pool.job_query_local_incremental())
+            self.assertTrue(job_pool.job_container.has_job("job1"))
+            self.assertTrue(job_pool.job_container.has_job("job2"))
+            self.assertEqual(job_pool.servertime_watermark, 1000)
+            # Second poll only fetches job2, but job1 is still in the listing
+            delta = job_pool.job_query_local_incremental()
+            self.assertEqual(job_pool.incremental_polls, 1)
+            self.assertEqual(delta.queued_ids, set(["job1", "job2"]))
+            job_pool.update_jobs(delta)
+            self.assertTrue(job_pool.job_container.has_job("job1"))
+            self.assertTrue(job_pool.job_container.has_job("job2"))
+        finally:
+            cloudscheduler.config.condor_q_command = saved_command
+            os.remove(script_name)
+
+class HashTableJobContainerTests(unittest.TestCase):
+
+    def setUp(self):
+        from cloudscheduler.job_containers import HashTableJobContainer
+        from cloudscheduler.job_management import Job
+
+        self.container = HashTableJobContainer()
+        self.job1 = Job(GlobalJobId="job1", Owner="alice", VMType="typeA", JobStatus=1, JobPrio=1)
+        self.job2 = Job(GlobalJobId="job2", Owner="alice", VMType="typeB", JobStatus=1, JobPrio=5)
+        self.job3 = Job(GlobalJobId="job3", Owner="bob", VMType="typeA", JobStatus=1, VMHighPriority=1)
+        for job in (self.job1, self.job2, self.job3):
+            self.container.add_job(job)
+
+    def test_indexes_follow_changes(self):
+        by_users = self.container.get_unscheduled_jobs_by_users(prioritized=True)
+        self.assertEqual(by_users["alice"], [self.job2, self.job1])
+        self.assertEqual(by_users["bob"], [self.job3])
+        self.assertEqual(sorted(self.container.get_unscheduled_jobs_by_type()["typeA"]), sorted([self.job1, self.job3]))
+        self.assertEqual(self.container.get_unscheduled_jobs_by_usertype()["alice:typeB"], [self.job2])
+        self.assertEqual(self.container.get_unscheduled_high_priority_jobs(), [self.job3])
+
+        self.container.schedule_job("job1")
+        self.container.schedule_job("job3")
+        self.assertEqual(self.container.get_unscheduled_jobs_by_users()["alice"], [self.job2])
+        self.assertFalse("bob" in self.container.get_unscheduled_jobs_by_users())
+        self.assertEqual(self.container.get_scheduled_jobs_by_usertype()["alice:typeA"], [self.job1])
+        self.assertEqual(self.container.get_unscheduled_high_priority_jobs(), [])
+        self.assertEqual(self.container.get_high_priority_jobs(), [self.job3])
+
+        self.container.update_job_status("job1", 2, "slot1@vm", 0, 0)
+        self.assertEqual(self.container.get_running_jobs(), [self.job1])
+        self.assertEqual(sorted(self.container.get_idle_jobs()), sorted([self.job2, self.job3]))
+
+        self.container.unschedule_job("job3")
+        self.container.remove_job(self.job1)
+        self.assertEqual(self.container.get_running_jobs(), [])
+        self.assertEqual(self.container.get_scheduled_jobs_by_users(), {})
+        self.assertEqual(self.container.get_unscheduled_high_priority_jobs(), [self.job3])
+        self.assertEqual(self.container.get_unscheduled_user_jobs_by_type("alice").keys(), ["typeB"])
+
+        self.container.clear()
+        self.assertEqual(self.container.get_unscheduled_jobs_by_users(), {})
+        self.assertEqual(self.container.get_idle_jobs(), [])
+
+    def test_priority_order_follows_changes(self):
+        from cloudscheduler.job_management import Job
+
+        job4 = Job(GlobalJobId="job4", Owner="alice", VMType="typeA", JobStatus=1, JobPrio=5)
+        self.container.add_job(job4)
+        # Equal priorities keep the order the jobs were added in
+        self.assertEqual(self.container.get_unscheduled_jobs_by_users(prioritized=True)["alice"],
+                         [self.job2, job4, self.job1])
+        self.assertEqual(self.container.get_unscheduled_user_jobs_by_type("alice", prioritized=True)["typeA"],
+                         [job4, self.job1])
+
+        self.container.update_job_status("job1", 1, None, 0, 0, 10)
+        self.assertEqual(self.job1.priority, 10)
+        self.assertEqual(self.container.get_unscheduled_jobs_by_users(prioritized=True)["alice"],
+                         [self.job1, self.job2, job4])
+        self.assertEqual(self.container.get_unscheduled_jobs_by_usertype(prioritized=True)["alice:typeA"],
+                         [self.job1, job4])
+        self.assertEqual(self.container.get_unscheduled_head_jobs_by_users(),
+                         {"alice": self.job1, "bob": self.job3})
+
+        # A job that changed priority while scheduled comes back in its new place
+        self.container.schedule_job("job2")
+        self.container.update_job_status("job2", 1, None, 0, 0, 20)
+        self.container.unschedule_job("job2")
+        self.container.remove_job(self.job1)
+        self.assertEqual(self.container.get_unscheduled_jobs_by_users(prioritized=True)["alice"],
+                         [self.job2, job4])
+
+    def test_required_type_counters(self):
+        from cloudscheduler.job_management import Job
+
+        self.assertEqual(self.container.get_required_vmtypes_dict(), {"typeA": 2, "typeB": 1})
+        self.assertEqual(self.container.get_required_uservmtypes_dict(),
+                         {"alice:typeA": 1, "alice:typeB": 1, "bob:typeA": 1})
+        self.assertEqual(self.container.get_usertype_limits(), {})
+
+        self.container.ban_job("job1", "TempBanned")
+        self.assertTrue(self.job1.banned)
+        self.assertEqual(self.job1.override_status, "TempBanned")
+        self.container.update_job_status("job2", 5, None, 0, 0)
+        self.assertEqual(self.container.get_required_vmtypes_dict(), {"typeA": 1})
+        self.container.update_job_status("job2", 1, None, 0, 0)
+        self.container.remove_job(self.job3)
+        self.assertEqual(self.container.get_required_uservmtypes_dict(), {"alice:typeB": 1})
+
+        # The ban lifts on the next status update after job_ban_timeout
+        self.job1.ban_time -= cloudscheduler.config.job_ban_timeout + 1
+        self.container.update_job_status("job1", 1, None, 0, 0)
+        self.assertEqual(self.container.get_required_vmtypes_dict(), {"typeA": 1, "typeB": 1})
+
+        self.container.add_job(Job(GlobalJobId="job4", Owner="bob", VMType="typeA", VMTypeLimit=3))
+        self.assertEqual(self.container.get_usertype_limits(), {"bob:typeA": 3})
+        self.container.remove_job_by_id("job4")
+        self.assertEqual(self.container.get_usertype_limits(), {})
+
+    def test_find_jobs_with_matching_reqs(self):
+        from cloudscheduler.job_management import Job
+
+        job4 = Job(GlobalJobId="job4", Owner="alice", VMType="typeA", JobPrio=3)
+        job5 = Job(GlobalJobId="job5", Owner="alice", VMType="typeA", VMMem=2048)
+        self.container.add_job(job4)
+        self.container.add_job(job5)
+        self.assertTrue(job4.has_same_reqs(self.job1))
+        self.assertFalse(job5.has_same_reqs(self.job1))
+        self.assertFalse(self.job3.has_same_reqs(self.job1))
+
+        find = self.container.find_unscheduled_jobs_with_matching_reqs
+        self.assertEqual(find("alice", self.job1), [job4, self.job1])
+        self.assertEqual(find("alice", self.job1, 1), [job4])
+        self.assertEqual(find("bob", self.job1), [])
+        self.container.schedule_job("job4")
+        self.assertEqual(find("alice", self.job1, 2), [self.job1])
+
+class JobReconcileBenchmark(unittest.TestCase):
+
+    @unittest.skipUnless(RUN_BENCHMARKS, "set CLOUDSCHEDULER_BENCHMARKS to run benchmarks")
+    def test_update_jobs_scales_linearly(self):
+        import gc
+        import copy
+        import time
+        from cloudscheduler.job_management import Job, JobPool
+
+        template = Job(GlobalJobId="template", Owner="user", JobStatus=1)
+        per_job_times = []
+        for job_count in (1000, 10000, 50000, 200000):
+            jobs = []
+            for i in xrange(job_count):
+                job = copy.copy(template)
+                job.id = "job%d" % i
+                job.job_status = 1 + (i % 2)
+                jobs.append(job)
+            job_pool = JobPool("benchpool", condor_query_type="local")
+            job_pool.update_jobs(iter(jobs))
+            # Drop a tenth of the queue so the second pass updates and
+            # removes jobs. The cyclic collector is paused while timing,
+            # since its full passes grow with every live object, not just
+            # the ones update_jobs touches.
+            gc.disable()
+            start = time.time()
+            job_pool.update_jobs(iter(jobs[job_count / 10:]))
+            elapsed = time.time() - start
+            gc.enable()
+            per_job_times.append(elapsed / job_count)
+            print "update_jobs: %7d jobs in %.3fs (%.2f us/job)" % (job_count, elapsed, elapsed / job_count * 1e6)
+            self.assertEqual(len(job_pool.job_container.get_all_jobs()), job_count - job_count / 10)
+        # Linear scaling means the cost per job stays roughly flat
+        self.assertTrue(per_job_times[-1] < per_job_times[0] * 4)
+
+    def test_job_strings_shared(self):
+        from cloudscheduler.job_management import Job
+
+        # Strings repeated across jobs are kept once, and jobs carry no __dict__
+        jobs = [Job(GlobalJobId="schedd#%d.0#1" % i, Owner="user%d" % (i % 2), JobStatus=1,
+                    VMType="type%d" % (i % 2), VMNetwork="%s" % "private")
+                for i in range(4)]
+        self.assertFalse(hasattr(jobs[0], '__dict__'))
+        self.assertTrue(jobs[0].user is jobs[2].user)
+        self.assertTrue(jobs[0].req_vmtype is jobs[2].req_vmtype)
+        self.assertTrue(jobs[0].uservmtype is jobs[2].uservmtype)
+        self.assertTrue(jobs[0].req_network is jobs[1].req_network)
+
+    @unittest.skipUnless(RUN_BENCHMARKS, "set CLOUDSCHEDULER_BENCHMARKS to run benchmarks")
+    def test_job_memory(self):
+        from cloudscheduler.job_management import Job
+
+        # Every string is built per job, the way parsing a queue makes them
+        jobs = []
+        for i in xrange(100000):
+            jobs.append(Job(GlobalJobId="schedd#%d.0#1" % i, Owner="user%d" % (i % 50),
+                            JobStatus=1, VMType="type%d" % (i % 5), VMNetwork="%s" % "private",
+                            VMCPUArch="%s" % "x86_64", VMLoc="http://repo/image%d.img.gz" % (i % 5),
+                            VMHypervisor="%s" % "xen"))
+        # Count each object once: the job, its __dict__ if it has one, its
+        # attribute values and the items of its list and tuple attributes
+        seen = set()
+        def size(obj):
+            if id(obj) in seen:
+                return 0
+            seen.add(id(obj))
+            total = sys.getsizeof(obj)
+            if isinstance(obj, (list, tuple)):
+                total += sum(size(item) for item in obj)
+            return total
+        total = 0
+        for job in jobs:
+            total += size(job)
+            attributes = getattr(job, '__dict__', None)
+            if attributes != None:
+                total += size(attributes)
+            else:
+                attributes = dict((key, getattr(job, key)) for key in Job.__slots__)
+            total += sum(size(value) for value in attributes.itervalues())
+        print "Job memory: %d bytes/job over %d jobs" % (total / len(jobs), len(jobs))
+        self.assertTrue(total / len(jobs) < 2000)
+
 class GetOrNoneTests(unittest.TestCase):
 
     def setUp(self):